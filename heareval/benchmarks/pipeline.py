@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Benchmark the throughput of the embedding pipeline on synthetic tasks.
+
+Generates synthetic tasks (see heareval.benchmarks.synthetic) of files of
+several durations, at several sample rates, and computes their embeddings
+with cheap stub torch and tensorflow models (heareval.benchmarks.stub_torch
+and heareval.benchmarks.stub_tensorflow), so that the time is spent in the
+pipeline rather than in a model. Everything runs on CPU.
+
+Each model is run with the embeddings runner in a fresh interpreter, and
+for each task the clips per second, peak RSS (of the runner and its
+workers) and bytes written are read from its profile.embeddings.json and
+resources.embeddings.json. memmap_embeddings and get_labels_for_timestamps
+are also benchmarked on their own, each in a fresh process.
+
+Save the results of one commit with --output, and compare another commit
+to them with --baseline.
+
+Usage:
+    python3 -m heareval.benchmarks.pipeline --output before.json
+    python3 -m heareval.benchmarks.pipeline --baseline before.json
+"""
+
+import concurrent.futures
+import importlib.util
+import json
+import multiprocessing
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+
+from heareval.resources import GB, ResourceSampler
+
+MODELS = {
+    "torch": "heareval.benchmarks.stub_torch",
+    "tensorflow": "heareval.benchmarks.stub_tensorflow",
+}
+
+
+def dir_bytes(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def peak_rss(resources: Dict[str, Any]) -> float:
+    """
+    The peak RSS in GB of a process and its children, from a
+    ResourceSampler summary.
+    """
+    peak = resources["peak"]
+    return peak.get("rss", 0.0) + peak.get("children_rss", 0.0)
+
+
+def benchmark_embeddings(
+    framework: str,
+    sample_rate: int,
+    embedding_size: int,
+    tasks_dir: Path,
+    embeddings_dir: Path,
+    runner_args: List[str],
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Compute the embeddings of every task in tasks_dir with a stub model,
+    and return the results of each task.
+    """
+    model_options = {"sample_rate": sample_rate, "embedding_size": embedding_size}
+    command = [
+        sys.executable,
+        "-m",
+        "heareval.embeddings.runner",
+        MODELS[framework],
+        "--model-options",
+        json.dumps(model_options),
+        "--tasks-dir",
+        str(tasks_dir),
+        "--embeddings-dir",
+        str(embeddings_dir),
+        "--sample-interval",
+        "0.1",
+        *runner_args,
+    ]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(
+            f"{' '.join(command)} failed:\n{result.stderr[-4000:]}"
+        )
+    print(f"{framework} at {sample_rate} Hz: {time.perf_counter() - start:.1f}s")
+
+    # The runner's only output directory
+    (embed_dir,) = list(embeddings_dir.iterdir())
+    results = {}
+    for embed_task_dir in sorted(embed_dir.iterdir()):
+        if not embed_task_dir.is_dir():
+            continue
+        profile = json.load(embed_task_dir.joinpath("profile.embeddings.json").open())
+        resources = json.load(
+            embed_task_dir.joinpath("resources.embeddings.json").open()
+        )
+        clips = sum(split["clips"] for split in profile["splits"].values())
+        audio_seconds = sum(
+            split["audio_seconds"] for split in profile["splits"].values()
+        )
+        # Excluding setup, e.g. tuning the batch size, see
+        # heareval.embeddings.profiling
+        seconds = sum(split["time_elapsed"] for split in profile["splits"].values())
+        results[f"embeddings/{framework}/{sample_rate}/{embed_task_dir.name}"] = {
+            "seconds": seconds,
+            "clips": clips,
+            "clips_per_sec": clips / seconds,
+            "audio_seconds_per_sec": audio_seconds / seconds,
+            "peak_rss_gb": peak_rss(resources),
+            "bytes_written": dir_bytes(embed_task_dir),
+            "io_write_bytes": resources["peak"].get("write_bytes"),
+        }
+    return results
+
+
+def measured(function: Callable[..., Tuple[int, float]], *args) -> Dict[str, Any]:
+    """
+    Run function(*args), which returns the number of clips it processed
+    and the seconds it took to (excluding any setup), and sample its peak
+    RSS. Run in a fresh process, so that the RSS is only of this function
+    (and the interpreter).
+    """
+    sampler = ResourceSampler(0.01)
+    with sampler:
+        clips, seconds = function(*args)
+    return {
+        "seconds": seconds,
+        "clips": clips,
+        "clips_per_sec": clips / seconds,
+        "peak_rss_gb": peak_rss(sampler.summary()),
+    }
+
+
+def in_fresh_process(
+    function: Callable[..., Tuple[int, float]], *args
+) -> Dict[str, Any]:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(measured, function, *args).result()
+
+
+def memmap_embeddings_case(
+    work_dir: str, nfiles: int, nframes: int, embedding_size: int
+) -> Tuple[int, float]:
+    """
+    Write the embeddings of nfiles files of nframes frames, then time
+    memmap_embeddings on them.
+    """
+    import numpy as np
+
+    from heareval.embeddings.task_embeddings import (
+        SplitEmbeddingWriter,
+        memmap_embeddings,
+    )
+
+    embed_task_dir = Path(work_dir)
+    metadata = {"embedding_type": "event", "prediction_type": "multilabel"}
+    writer = SplitEmbeddingWriter(embed_task_dir, "train", "event")
+    rng = np.random.RandomState(0)
+    filenames = [f"train-{i:06d}.wav" for i in range(nfiles)]
+    timestamps = np.arange(nframes, dtype=np.float32) * 50.0
+    for filename in filenames:
+        embeddings = rng.randn(1, nframes, embedding_size).astype(np.float32)
+        labels = [[["a"]] * nframes]
+        writer.write_timestamp(embeddings, timestamps[None], labels, (filename,))
+    writer.close()
+
+    # Only memmap_embeddings is timed
+    start = time.perf_counter()
+    memmap_embeddings(
+        writer,
+        random.Random(0),
+        metadata,
+        "train",
+        embed_task_dir,
+        dict.fromkeys(filenames, []),
+    )
+    return nfiles, time.perf_counter() - start
+
+
+def labels_case(nfiles: int, nframes: int) -> Tuple[int, float]:
+    """
+    Find the labels of every timestamp of nfiles files of nframes frames,
+    with random events.
+    """
+    import numpy as np
+
+    from heareval.benchmarks.synthetic import random_events
+    from heareval.embeddings.task_embeddings import get_labels_for_timestamps
+
+    prng = random.Random(0)
+    labels = [random_events(prng, nframes * 50.0 / 1000) for _ in range(nfiles)]
+    timestamps = [np.arange(nframes, dtype=np.float64) * 50.0] * nfiles
+    start = time.perf_counter()
+    get_labels_for_timestamps(labels, timestamps)
+    return nfiles, time.perf_counter() - start
+
+
+def timed_memmap_embeddings(
+    nfiles: int, nframes: int, embedding_size: int
+) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = in_fresh_process(
+            memmap_embeddings_case, work_dir, nfiles, nframes, embedding_size
+        )
+        results["bytes_written"] = dir_bytes(Path(work_dir))
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict]):
+    """
+    Print the change in clips per second and peak RSS of every case in
+    both results.
+    """
+    print(f"{'case':<48} {'clips/s':>28} {'peak RSS (GB)':>20}")
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        before = baseline[case]
+        ratio = result["clips_per_sec"] / before["clips_per_sec"]
+        print(
+            f"{case:<48} "
+            f"{before['clips_per_sec']:>9.1f} -> {result['clips_per_sec']:>9.1f} "
+            f"{ratio:>4.2f}x "
+            f"{before['peak_rss_gb']:>8.2f} -> {result['peak_rss_gb']:>8.2f}"
+        )
+
+
+def comma_separated(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+@click.command()
+@click.option(
+    "--frameworks",
+    default="torch,tensorflow",
+    help="Comma-separated stub models to benchmark. Frameworks that are not "
+    "installed are skipped. (Default: torch,tensorflow)",
+    type=str,
+)
+@click.option(
+    "--durations",
+    default="1,10",
+    help="Comma-separated durations in seconds of the files of the synthetic "
+    "tasks. (Default: 1,10)",
+    type=str,
+)
+@click.option(
+    "--sample-rates",
+    default="16000,44100",
+    help="Comma-separated sample rates to benchmark. (Default: 16000,44100)",
+    type=str,
+)
+@click.option(
+    "--files",
+    default=64,
+    help="Number of files in each split of each task. (Default: 64)",
+    type=int,
+)
+@click.option(
+    "--embedding-size",
+    default=512,
+    help="Embedding size of the stub models. (Default: 512)",
+    type=int,
+)
+@click.option(
+    "--runner-args",
+    default="",
+    help='Extra options for the embeddings runner, e.g. "--cpu-replicas 2"',
+    type=str,
+)
+@click.option(
+    "--micro-files",
+    default=2000,
+    help="Number of files of 200 frames to benchmark memmap_embeddings and "
+    "get_labels_for_timestamps on. 0 to skip them. (Default: 2000)",
+    type=int,
+)
+@click.option(
+    "--work-dir",
+    default=None,
+    help="Directory to write the tasks and embeddings to, which is kept. "
+    "(Default: a temporary directory)",
+    type=str,
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Write the results to this JSON file",
+    type=str,
+)
+@click.option(
+    "--baseline",
+    default=None,
+    help="Compare the results to those in this JSON file, from --output",
+    type=str,
+)
+def main(
+    frameworks: str,
+    durations: str,
+    sample_rates: str,
+    files: int,
+    embedding_size: int,
+    runner_args: str,
+    micro_files: int,
+    work_dir: str = None,
+    output: str = None,
+    baseline: str = None,
+):
+    from heareval.benchmarks.synthetic import make_tasks
+
+    for framework in comma_separated(frameworks):
+        if framework not in MODELS:
+            raise click.BadParameter(f"Unknown framework {framework}")
+    results: Dict[str, Any] = {"commit": git_commit(), "cases": {}}
+
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = tempfile.mkdtemp()
+        work_dir = tmp_dir
+    try:
+        tasks_dir = Path(work_dir).joinpath("tasks")
+        start = time.perf_counter()
+        make_tasks(
+            tasks_dir,
+            [float(duration) for duration in comma_separated(durations)],
+            [int(sample_rate) for sample_rate in comma_separated(sample_rates)],
+            files,
+        )
+        print(f"Wrote synthetic tasks in {time.perf_counter() - start:.1f}s")
+
+        for framework in comma_separated(frameworks):
+            if importlib.util.find_spec(framework) is None:
+                print(f"Skipping {framework}, which is not installed")
+                continue
+            for sample_rate in comma_separated(sample_rates):
+                embeddings_dir = Path(work_dir).joinpath(
+                    "embeddings", framework, sample_rate
+                )
+                if embeddings_dir.exists():
+                    shutil.rmtree(embeddings_dir)
+                results["cases"].update(
+                    benchmark_embeddings(
+                        framework,
+                        int(sample_rate),
+                        embedding_size,
+                        tasks_dir,
+                        embeddings_dir,
+                        shlex.split(runner_args),
+                    )
+                )
+
+        if micro_files > 0:
+            results["cases"]["memmap_embeddings"] = timed_memmap_embeddings(
+                micro_files, 200, embedding_size
+            )
+            results["cases"]["get_labels_for_timestamps"] = in_fresh_process(
+                labels_case, micro_files, 200
+            )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    for case, result in results["cases"].items():
+        print(
+            f"{case}: {result['clips_per_sec']:.1f} clips/s, "
+            f"peak RSS {result['peak_rss_gb']:.2f} GB"
+            + (
+                f", {result['bytes_written'] / GB:.3f} GB written"
+                if "bytes_written" in result
+                else ""
+            )
+        )
+    if output is not None:
+        Path(output).write_text(json.dumps(results, indent=4))
+    if baseline is not None:
+        compare(results["cases"], json.load(open(baseline))["cases"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark the startup time of the runners.
+
+Times `--help`, and a run where every task is already done, of the
+embeddings and predictions runners, each in a fresh interpreter. Also
+checks that importing the runners does not import any of the heavy
+libraries, which should only be imported once there is work to do.
+
+Fails if any startup takes longer than --max-seconds, or if a runner
+imports a heavy library at import time.
+
+Usage:
+    python3 -m heareval.benchmarks.startup --max-seconds 5
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import click
+
+# Libraries that take seconds to import
+HEAVY_MODULES = [
+    "tensorflow",
+    "torch",
+    "pytorch_lightning",
+    "sklearn",
+    "sed_eval",
+    "dcase_util",
+    "pandas",
+]
+
+RUNNERS = ["heareval.embeddings.runner", "heareval.predictions.runner"]
+
+
+def time_command(args: List[str], repeats: int) -> float:
+    """
+    Median wall time in seconds to run a python command.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports(module: str) -> List[str]:
+    """
+    The heavy libraries that importing module imports.
+    """
+    code = (
+        "import json, sys\n"
+        f"import {module}\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def done_commands(tmp_dir: Path) -> Dict[str, List[str]]:
+    """
+    Runner commands over one task that is already done.
+    """
+    tasks_dir = tmp_dir.joinpath("tasks")
+    tasks_dir.joinpath("done_task").mkdir(parents=True)
+    # Never imported, because the task is done
+    module = "startup_benchmark_model"
+    embed_task_dir = tmp_dir.joinpath("embeddings", module, "done_task")
+    embed_task_dir.mkdir(parents=True)
+    embed_task_dir.joinpath(".done.embeddings").touch()
+    embed_task_dir.joinpath("prediction-done.json").write_text("{}")
+    return {
+        "heareval.embeddings.runner (done)": [
+            "-m",
+            "heareval.embeddings.runner",
+            module,
+            "--tasks-dir",
+            str(tasks_dir),
+            "--embeddings-dir",
+            str(tmp_dir.joinpath("embeddings")),
+        ],
+        "heareval.predictions.runner (done)": [
+            "-m",
+            "heareval.predictions.runner",
+            str(embed_task_dir),
+        ],
+    }
+
+
+@click.command()
+@click.option(
+    "--repeats",
+    default=3,
+    help="Number of times to time each command. (Default: 3)",
+    type=int,
+)
+@click.option(
+    "--max-seconds",
+    default=None,
+    help="Fail if the median startup time of any command is longer than this. "
+    "(Default: never fail on time)",
+    type=float,
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Write the results to this JSON file",
+    type=str,
+)
+def main(repeats: int, max_seconds: float = None, output: str = None):
+    failures = []
+    results: Dict[str, Dict] = {"seconds": {}, "heavy_imports": {}}
+
+    for module in RUNNERS:
+        imported = heavy_imports(module)
+        results["heavy_imports"][module] = imported
+        print(f"import {module}: imports {imported or 'no heavy libraries'}")
+        if imported:
+            failures.append(f"import {module} imports {', '.join(imported)}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        commands = {f"{module} --help": ["-m", module, "--help"] for module in RUNNERS}
+        commands.update(done_commands(Path(tmp_dir)))
+        commands["python (baseline)"] = ["-c", "pass"]
+        for name, args in commands.items():
+            seconds = time_command(args, repeats)
+            results["seconds"][name] = seconds
+            print(f"{name}: {seconds:.2f}s")
+            if max_seconds is not None and seconds > max_seconds:
+                failures.append(f"{name} took {seconds:.2f}s > {max_seconds}s")
+
+    if output is not None:
+        Path(output).write_text(json.dumps(results, indent=4))
+    if failures:
+        raise click.ClickException("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
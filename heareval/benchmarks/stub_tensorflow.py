@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+A cheap tensorflow model that follows the HEAR API, for benchmarking the
+embedding pipeline rather than a model. Computes the same kind of
+embeddings as heareval.benchmarks.stub_torch.
+
+Usage:
+    python3 -m heareval.embeddings.runner heareval.benchmarks.stub_tensorflow \
+        --model-options '{"sample_rate": 16000}'
+"""
+
+from typing import Tuple
+
+import tensorflow as tf
+
+
+class StubModel(tf.Module):
+    def __init__(self, sample_rate: int, embedding_size: int, hop_ms: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.scene_embedding_size = embedding_size
+        self.timestamp_embedding_size = embedding_size
+        self.hop_ms = hop_ms
+        self.hop = int(round(sample_rate * hop_ms / 1000))
+        # The same weights every time
+        initializer = tf.random.stateless_uniform(
+            (self.hop, embedding_size), seed=(0, 0), minval=-1.0, maxval=1.0
+        )
+        self.projection = tf.Variable(initializer / self.hop**0.5)
+
+
+def load_model(
+    model_file_path: str = "",
+    sample_rate: int = 16000,
+    embedding_size: int = 512,
+    hop_ms: float = 50.0,
+) -> StubModel:
+    return StubModel(sample_rate, embedding_size, hop_ms)
+
+
+def get_timestamp_embeddings(
+    audio: tf.Tensor, model: StubModel
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    hop = model.hop
+    nframes = audio.shape[1] // hop + 1
+    padded = tf.pad(audio, [[0, 0], [hop // 2, hop]])
+    frames = tf.reshape(padded[:, : nframes * hop], (-1, nframes, hop))
+    embeddings = tf.linalg.matmul(frames, model.projection)
+    timestamps = tf.range(nframes, dtype=tf.float32) * model.hop_ms
+    timestamps = tf.tile(tf.expand_dims(timestamps, 0), (tf.shape(audio)[0], 1))
+    return embeddings, timestamps
+
+
+def get_scene_embeddings(audio: tf.Tensor, model: StubModel) -> tf.Tensor:
+    embeddings, _ = get_timestamp_embeddings(audio, model)
+    return tf.reduce_mean(embeddings, axis=1)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+A cheap torch model that follows the HEAR API, for benchmarking the
+embedding pipeline rather than a model.
+
+Each timestamp embedding is a random projection of one hop of audio
+centered on the timestamp, and the scene embedding is their mean.
+
+Usage:
+    python3 -m heareval.embeddings.runner heareval.benchmarks.stub_torch \
+        --model-options '{"sample_rate": 16000}'
+"""
+
+from typing import Tuple
+
+import torch
+
+
+class StubModel(torch.nn.Module):
+    def __init__(self, sample_rate: int, embedding_size: int, hop_ms: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.scene_embedding_size = embedding_size
+        self.timestamp_embedding_size = embedding_size
+        self.hop_ms = hop_ms
+        self.hop = int(round(sample_rate * hop_ms / 1000))
+        self.projection = torch.nn.Linear(self.hop, embedding_size)
+
+
+def load_model(
+    model_file_path: str = "",
+    sample_rate: int = 16000,
+    embedding_size: int = 512,
+    hop_ms: float = 50.0,
+) -> StubModel:
+    # The same weights every time
+    torch.manual_seed(0)
+    return StubModel(sample_rate, embedding_size, hop_ms)
+
+
+def get_timestamp_embeddings(
+    audio: torch.Tensor, model: StubModel
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    hop = model.hop
+    nframes = audio.shape[1] // hop + 1
+    padded = torch.nn.functional.pad(audio, (hop // 2, hop))
+    frames = padded[:, : nframes * hop].reshape(audio.shape[0], nframes, hop)
+    embeddings = model.projection(frames)
+    timestamps = torch.arange(nframes, device=audio.device) * model.hop_ms
+    timestamps = timestamps.unsqueeze(0).expand(audio.shape[0], -1)
+    return embeddings, timestamps
+
+
+def get_scene_embeddings(audio: torch.Tensor, model: StubModel) -> torch.Tensor:
+    embeddings, _ = get_timestamp_embeddings(audio, model)
+    return embeddings.mean(dim=1)
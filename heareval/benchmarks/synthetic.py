@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Synthetic tasks in the layout of preprocessed HEAR tasks, for benchmarking
+without downloading any real task.
+
+A task directory has task_metadata.json, labelvocabulary.csv, a
+{split}.json of the labels of every file, and the WAVs of every split
+at every sample rate, in {sample_rate}/{split}/. The audio is white noise,
+and the labels (and events) are random.
+"""
+
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import soundfile as sf
+
+SPLITS = ["train", "valid", "test"]
+LABELS = ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def random_events(prng: random.Random, duration: float) -> List[Dict]:
+    """
+    Up to 8 random events in duration seconds, in milliseconds.
+    """
+    events = []
+    for _ in range(prng.randint(0, 8)):
+        start = prng.uniform(0, duration * 1000)
+        end = start + prng.uniform(50, 2000)
+        events.append({"label": prng.choice(LABELS), "start": start, "end": end})
+    return events
+
+
+def make_task(
+    tasks_dir: Path,
+    task_name: str,
+    embedding_type: str,
+    sample_duration: Optional[float],
+    sample_rates: Sequence[int],
+    nfiles: int,
+    max_duration: float = 0.0,
+    seed: int = 0,
+) -> Path:
+    """
+    Write a synthetic task with nfiles files in each split, and return its
+    directory.
+
+    Args:
+        embedding_type: "scene" (multiclass) or "event" (multilabel events)
+        sample_duration: the duration of every file in seconds, or None for
+            files of random durations up to max_duration
+        sample_rates: the sample rates to write every file at
+    """
+    if embedding_type not in ["scene", "event"]:
+        raise ValueError(f"Unknown embedding type: {embedding_type}")
+    task_path = tasks_dir.joinpath(task_name)
+    task_path.mkdir(parents=True, exist_ok=True)
+    metadata = {
+        "task_name": task_name,
+        "version": "synthetic",
+        "embedding_type": embedding_type,
+        "prediction_type": "multiclass" if embedding_type == "scene" else "multilabel",
+        "split_mode": "trainvaltest",
+        "splits": SPLITS,
+        "sample_duration": sample_duration,
+        "evaluation": (
+            ["top1_acc"] if embedding_type == "scene" else ["event_onset_200ms_fms"]
+        ),
+    }
+    json.dump(metadata, task_path.joinpath("task_metadata.json").open("wt"), indent=4)
+    task_path.joinpath("labelvocabulary.csv").write_text(
+        "idx,label\n" + "".join(f"{i},{label}\n" for i, label in enumerate(LABELS))
+    )
+
+    prng = random.Random(seed)
+    rng = np.random.RandomState(seed)
+    for split in SPLITS:
+        split_data = {}
+        durations = {}
+        for i in range(nfiles):
+            filename = f"{split}-{i:06d}.wav"
+            duration = sample_duration
+            if duration is None:
+                duration = prng.uniform(max_duration / 10, max_duration)
+            durations[filename] = duration
+            if embedding_type == "scene":
+                split_data[filename] = [prng.choice(LABELS)]
+            else:
+                split_data[filename] = random_events(prng, duration)
+        json.dump(split_data, task_path.joinpath(f"{split}.json").open("wt"))
+
+        for sample_rate in sample_rates:
+            audio_dir = task_path.joinpath(str(sample_rate), split)
+            audio_dir.mkdir(parents=True, exist_ok=True)
+            for filename, duration in durations.items():
+                audio = rng.uniform(-0.5, 0.5, int(round(duration * sample_rate)))
+                sf.write(
+                    audio_dir.joinpath(filename),
+                    audio.astype(np.float32),
+                    sample_rate,
+                    subtype="PCM_16",
+                )
+    return task_path
+
+
+def make_tasks(
+    tasks_dir: Path,
+    durations: Sequence[float],
+    sample_rates: Sequence[int],
+    nfiles: int,
+) -> List[Path]:
+    """
+    A scene and an event task of files of each duration, and an event task
+    of files of random durations up to the longest duration.
+    """
+    tasks = []
+    for duration in durations:
+        for embedding_type in ["scene", "event"]:
+            tasks.append(
+                make_task(
+                    tasks_dir,
+                    f"{embedding_type}-{duration:g}s",
+                    embedding_type,
+                    duration,
+                    sample_rates,
+                    nfiles,
+                )
+            )
+    tasks.append(
+        make_task(
+            tasks_dir,
+            f"event-variable-{max(durations):g}s",
+            "event",
+            None,
+            sample_rates,
+            nfiles,
+            max_duration=max(durations),
+        )
+    )
+    return tasks
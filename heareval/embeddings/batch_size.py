@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Choose the batch size for computing embeddings, and recover from
+out-of-memory errors while computing them.
+
+The batch size is tuned per model by running the model on increasing
+batch sizes of silence until its peak memory use would exceed a budget,
+either of the GPU memory or, on CPU-only machines, of the host memory.
+The tuned batch size is cached per (model, task, sample rate), so it is
+only probed once.
+"""
+
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, Tuple, TypeVar, Union
+
+import numpy as np
+import psutil
+import torch
+
+import heareval.gpu_max_mem as gpu_max_mem
+
+if TYPE_CHECKING:
+    from heareval.embeddings.task_embeddings import Embedding
+
+# Largest batch size that is probed
+MAX_BATCH_SIZE = 512
+# Seconds between samples of the RSS while probing batch sizes on CPU
+RSS_SAMPLE_INTERVAL = 0.005
+
+EmbeddingOutput = TypeVar("EmbeddingOutput", np.ndarray, Tuple[np.ndarray, np.ndarray])
+
+
+def is_out_of_memory(e: BaseException) -> bool:
+    """
+    Is this exception an out-of-memory error, on the GPU or host?
+    """
+    if isinstance(e, MemoryError):
+        return True
+    # tensorflow has only been imported if the model is a tensorflow model
+    tf = sys.modules.get("tensorflow")
+    if tf is not None and isinstance(e, tf.errors.ResourceExhaustedError):
+        return True
+    # torch.cuda.OutOfMemoryError only exists in newer torch versions,
+    # older ones raise a RuntimeError
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+def free_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def split_on_oom(
+    get_embedding: Callable[[Union[np.ndarray, torch.Tensor]], EmbeddingOutput],
+    audio: Union[np.ndarray, torch.Tensor],
+) -> EmbeddingOutput:
+    """
+    Compute get_embedding(audio). If this runs out of memory, split the
+    batch in half and compute each half separately, recursively, and
+    concatenate the results.
+    """
+    try:
+        return get_embedding(audio)
+    except Exception as e:
+        if not is_out_of_memory(e) or len(audio) == 1:
+            raise
+    # Retry outside of the except block, so that the traceback (and the
+    # tensors it refers to) can be freed first.
+    free_memory()
+    half = len(audio) // 2
+    print(
+        f"WARNING: Out of memory computing embeddings with batch size "
+        f"{len(audio)}, retrying with batch sizes {half} and {len(audio) - half}"
+    )
+    first = split_on_oom(get_embedding, audio[:half])
+    second = split_on_oom(get_embedding, audio[half:])
+    if isinstance(first, tuple):
+        # Timestamp embeddings are a tuple of (embeddings, timestamps)
+        return tuple(  # type: ignore
+            np.concatenate(pair) for pair in zip(first, second)
+        )
+    return np.concatenate([first, second])  # type: ignore
+
+
+def on_gpu(embedding: "Embedding") -> bool:
+    from heareval.embeddings.task_embeddings import TORCH
+
+    if embedding.type == TORCH:
+        return embedding.device == "cuda"
+    # The embeddings runner checks that GPUs are available to tensorflow if
+    # they are available to torch.
+    return torch.cuda.is_available()
+
+
+def total_memory(embedding: "Embedding") -> int:
+    """
+    Total memory in bytes of the device the model runs on.
+    """
+    if on_gpu(embedding):
+        return torch.cuda.get_device_properties(0).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class RSSPeak:
+    """
+    The peak RSS of this process since start(), sampled by a thread.
+
+    Unlike ru_maxrss, which is the peak over the life of the process and
+    cannot be reset, this only covers the time since start().
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.peak = 0
+
+    def start(self) -> "RSSPeak":
+        self.peak = self.process.memory_info().rss
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        return self.peak
+
+
+def reset_peak_memory(embedding: "Embedding") -> Optional[RSSPeak]:
+    """
+    Start measuring the peak memory used, see peak_memory. On CPU, this
+    returns the RSSPeak to pass to peak_memory.
+    """
+    from heareval.embeddings.task_embeddings import TENSORFLOW
+
+    free_memory()
+    if on_gpu(embedding):
+        if embedding.type == TENSORFLOW:
+            import tensorflow as tf
+
+            tf.config.experimental.reset_memory_stats("GPU:0")
+        else:
+            torch.cuda.reset_peak_memory_stats()
+        return None
+    return RSSPeak().start()
+
+
+def peak_memory(embedding: "Embedding", rss_peak: Optional[RSSPeak] = None) -> int:
+    """
+    Peak memory in bytes used since reset_peak_memory. On CPU, this is the
+    RSS of the process before reset_peak_memory, plus its largest increase
+    since then.
+    """
+    from heareval.embeddings.task_embeddings import TENSORFLOW
+
+    if on_gpu(embedding):
+        if embedding.type == TENSORFLOW:
+            import tensorflow as tf
+
+            return tf.config.experimental.get_memory_info("GPU:0")["peak"]
+        return torch.cuda.max_memory_reserved()
+    assert rss_peak is not None
+    return rss_peak.stop()
+
+
+def probe_batch_size(
+    embedding: "Embedding",
+    embedding_type: str,
+    nsamples: int,
+    memory_fraction: float,
+    max_batch_size: int = MAX_BATCH_SIZE,
+) -> int:
+    """
+    Find the largest power-of-two batch size of audio clips of nsamples
+    samples whose embeddings can be computed within memory_fraction of
+    the memory of the device.
+    """
+    budget = memory_fraction * total_memory(embedding)
+    if embedding_type == "scene":
+        get_embedding = embedding._get_scene_embedding_as_numpy
+    elif embedding_type == "event":
+        get_embedding = embedding._get_timestamp_embedding_as_numpy  # type: ignore
+    else:
+        raise ValueError(f"Unknown embedding type: {embedding_type}")
+
+    best = 1
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        audio = torch.zeros((batch_size, nsamples), dtype=torch.float32)
+        rss_peak = reset_peak_memory(embedding)
+        try:
+            get_embedding(audio)
+            oom = False
+        except Exception as e:
+            if not is_out_of_memory(e):
+                raise
+            oom = True
+        finally:
+            used = peak_memory(embedding, rss_peak)
+        del audio
+        if oom:
+            break
+        print(
+            f"Batch size {batch_size} used {used / 1024 ** 3:.2f} GB "
+            f"of {budget / 1024 ** 3:.2f} GB budget"
+        )
+        if used > budget:
+            break
+        best = batch_size
+        batch_size *= 2
+    free_memory()
+    return best
+
+
+def tuned_batch_size(
+    embedding: "Embedding",
+    metadata: dict,
+    nsamples: int,
+    cache_path: Path,
+    memory_fraction: float,
+) -> int:
+    """
+    The batch size for computing embeddings for a task with audio clips
+    of nsamples samples, probed the first time it is needed and then
+    read from cache_path, a JSON file shared by all tasks of a model.
+    (Its name should start with a ".", so that globs of the model's task
+    directories don't match it.)
+    """
+    key = (
+        f"{metadata['task_name']}-{embedding.sample_rate}-{nsamples}-"
+        f"{metadata['embedding_type']}-{gpu_max_mem.device_name()}-"
+        f"{memory_fraction}"
+    )
+    batch_sizes = {}
+    if cache_path.exists():
+        batch_sizes = json.load(cache_path.open())
+    if key not in batch_sizes:
+        batch_sizes[key] = probe_batch_size(
+            embedding, metadata["embedding_type"], nsamples, memory_fraction
+        )
+        # Reread, in case another process added a batch size meanwhile
+        if cache_path.exists():
+            batch_sizes = {**json.load(cache_path.open()), key: batch_sizes[key]}
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(batch_sizes, indent=4))
+        os.replace(tmp_path, cache_path)
+    return batch_sizes[key]
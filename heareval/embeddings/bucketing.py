@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Batching of variable-length audio, for tasks without a fixed
+sample_duration.
+
+Clips are sorted by length (read from the audio file headers) and
+grouped into buckets of similar length. Each bucket is one batch, padded
+with zeros to the length of its longest clip. Timestamp embeddings of
+padded clips are then trimmed back to the true length of each clip.
+
+Scene embeddings cannot be trimmed, so scene tasks only batch clips of
+exactly the same length together, which needs no padding.
+"""
+
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import soundfile as sf
+import torch
+from torch.utils.data import Sampler
+
+
+def audio_lengths(audio_dir: Path, filenames: Sequence[str]) -> List[int]:
+    """
+    Length in samples of each audio file, read from its header.
+    """
+    return [sf.info(str(audio_dir.joinpath(filename))).frames for filename in filenames]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields batches of indices of clips of similar length.
+
+    Args:
+        lengths: the length in samples of each clip
+        max_samples: the most samples in one batch, after padding. A clip
+            longer than this is batched alone.
+        max_padding: clips in a batch are at most this fraction longer
+            than the shortest clip in the batch, e.g. 0.1 for 10%
+        window: if given, only clips among the same `window` consecutive
+            clips are batched together, and batches are yielded window by
+            window, e.g. for datasets that are read sequentially
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_samples: int,
+        max_padding: float,
+        window: Optional[int] = None,
+    ):
+        self.batches: List[List[int]] = []
+        if window is None:
+            window = max(len(lengths), 1)
+        for start in range(0, len(lengths), window):
+            batch: List[int] = []
+            window_lengths = lengths[start : start + window]
+            # Stable sort, so that clips of equal length stay in their original
+            # order
+            for idx in np.argsort(window_lengths, kind="stable").tolist():
+                idx += start
+                length = lengths[idx]
+                if batch and (
+                    (len(batch) + 1) * length > max_samples
+                    or length > lengths[batch[0]] * (1 + max_padding)
+                ):
+                    self.batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch:
+                self.batches.append(batch)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+def pad_collate(
+    items: List[Tuple[np.ndarray, str]],
+) -> Tuple[torch.Tensor, List[str], torch.Tensor]:
+    """
+    Collate (audio, filename) pairs into a batch of audio, zero-padded
+    to the length of the longest clip, the filenames and the unpadded
+    length of each clip.
+    """
+    lengths = torch.tensor([len(audio) for audio, _ in items])
+    audios = torch.zeros((len(items), int(lengths.max())), dtype=torch.float32)
+    # Copy through numpy, which also accepts read-only (memory-mapped) audio
+    audios_array = audios.numpy()
+    for i, (audio, _) in enumerate(items):
+        audios_array[i, : len(audio)] = audio
+    return audios, [filename for _, filename in items], lengths
+
+
+def trim_timestamp_embeddings(
+    embeddings: np.ndarray,
+    timestamps: np.ndarray,
+    lengths: torch.Tensor,
+    sample_rate: int,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Drop the frames of each padded clip whose timestamps are past the end
+    of the clip. Returns a list of embeddings and a list of timestamps,
+    with one entry per clip.
+    """
+    trimmed_embeddings = []
+    trimmed_timestamps = []
+    for i, length in enumerate(lengths.tolist()):
+        # Timestamps are in milliseconds
+        keep = timestamps[i] <= length / sample_rate * 1000
+        trimmed_embeddings.append(embeddings[i][keep])
+        trimmed_timestamps.append(timestamps[i][keep])
+    return trimmed_embeddings, trimmed_timestamps
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk cache of embeddings.
+
+The same audio clip often appears in several versions of a task (small
+and full, different hear-preprocess releases), and sometimes several
+times in one task. Embeddings are cached keyed on a hash of the decoded
+audio and of the model (module name, model weights and model options),
+so reruns and overlapping tasks only compute embeddings for clips that
+have never been seen before.
+
+Each entry is stored as its own .npz file. An sqlite index records the
+size and last use of each entry, and the least recently used entries
+are evicted once the cache grows past its quota. The index is safe to
+share between several processes, e.g. when using heareval.multigpu.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+from heareval.embeddings.bucketing import trim_timestamp_embeddings
+
+# Read model weights in chunks of this many bytes when hashing them
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def model_key(
+    module_name: str,
+    model_path: Optional[str] = None,
+    model_options: Optional[Dict[str, Any]] = None,
+    precision: str = "float32",
+) -> str:
+    """
+    Hash of everything that determines the output of a model:
+    its module name, the contents of its weights file, its options and
+    the precision it is run in.
+    """
+    weights_hash = hashlib.sha256()
+    if model_path is not None:
+        with open(model_path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_BYTES), b""):
+                weights_hash.update(chunk)
+    key = {
+        "module": module_name,
+        "weights": weights_hash.hexdigest() if model_path is not None else None,
+        "options": model_options or {},
+    }
+    # float32 is not in the key, so that existing caches stay valid
+    if precision != "float32":
+        key["precision"] = precision
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def audio_key(audio: np.ndarray) -> str:
+    """
+    Hash of the contents of one decoded audio clip.
+    """
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    return hashlib.sha256(audio.tobytes()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A cache of the embeddings of one model, with the same
+    get_*_embedding_as_numpy interface as Embedding.
+
+    Args:
+        cache_dir: directory holding the cache, which can be shared
+            between models, tasks and runs
+        model_key: the key of the model, see model_key()
+        max_bytes: the size quota for the whole cache directory
+    """
+
+    def __init__(self, cache_dir: Path, model_key: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.model_key = model_key
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(
+            str(self.cache_dir.joinpath("index.sqlite")), timeout=60
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, size INTEGER, last_used REAL)"
+        )
+        self.db.commit()
+        # In case the quota was lowered since the last run
+        self._evict()
+
+    def _key(self, kind: str, audio: np.ndarray) -> str:
+        return hashlib.sha256(
+            f"{self.model_key}-{kind}-{audio_key(audio)}".encode()
+        ).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key[:2], f"{key}.npz")
+
+    def _get(self, keys: List[str]) -> List[Optional[Dict[str, np.ndarray]]]:
+        entries: List[Optional[Dict[str, np.ndarray]]] = []
+        used = []
+        now = time.time()
+        for key in keys:
+            try:
+                with np.load(self._path(key)) as npz:
+                    entries.append({name: npz[name] for name in npz.files})
+                used.append((now, key))
+            except (FileNotFoundError, ValueError, OSError):
+                # Missing, evicted by another process, or partially written
+                entries.append(None)
+        if used:
+            self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", used)
+            self.db.commit()
+        return entries
+
+    def _put(self, keys: List[str], entries: List[Dict[str, np.ndarray]]):
+        now = time.time()
+        rows = []
+        for key, entry in zip(keys, entries):
+            path = self._path(key)
+            os.makedirs(path.parent, exist_ok=True)
+            # Write then rename, so other processes never read partial entries
+            tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp.npz")
+            np.savez(tmp_path, **entry)
+            os.replace(tmp_path, path)
+            rows.append((key, path.stat().st_size, now))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)",
+            rows,
+        )
+        self.db.commit()
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove least recently used entries until the cache fits its quota.
+        """
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        ):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append((key,))
+        self.db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self.db.commit()
+
+    def _lookup(
+        self,
+        kind: str,
+        audio: Union[np.ndarray, torch.Tensor],
+        lengths: Optional[Sequence[int]] = None,
+    ) -> Tuple[List[str], List[Optional[Dict[str, np.ndarray]]], List[int]]:
+        """
+        Return the keys and cached entries for a batch of audio, and the
+        indices of the clips that are not cached. Clips are keyed on their
+        audio without the padding of the batch, if their lengths are given.
+        """
+        if isinstance(audio, torch.Tensor):
+            audio = audio.numpy()
+        if lengths is None:
+            lengths = [audio.shape[1]] * len(audio)
+        keys = [self._key(kind, a[:length]) for a, length in zip(audio, lengths)]
+        entries = self._get(keys)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return keys, entries, missing
+
+    def get_scene_embedding_as_numpy(
+        self,
+        embedding,
+        audio: Union[np.ndarray, torch.Tensor],
+        lengths: Optional[Sequence[int]] = None,
+    ) -> np.ndarray:
+        keys, entries, missing = self._lookup("scene", audio, lengths)
+        if missing:
+            computed = embedding.get_scene_embedding_as_numpy(audio[missing])
+            new_entries = [{"embedding": e} for e in computed]
+            self._put([keys[i] for i in missing], new_entries)
+            for i, entry in zip(missing, new_entries):
+                entries[i] = entry
+        return np.stack([entry["embedding"] for entry in entries])  # type: ignore
+
+    def get_timestamp_embedding_as_numpy(
+        self,
+        embedding,
+        audio: Union[np.ndarray, torch.Tensor],
+        lengths: Optional[Sequence[int]] = None,
+    ) -> Tuple[
+        Union[np.ndarray, List[np.ndarray]], Union[np.ndarray, List[np.ndarray]]
+    ]:
+        """
+        With the lengths of padded clips, the embeddings of each clip are
+        cached trimmed to its length, and so the clips of a batch can have
+        different numbers of frames. They are then returned as lists of the
+        embeddings and timestamps of each clip.
+        """
+        keys, entries, missing = self._lookup("timestamp", audio, lengths)
+        if missing:
+            embeddings, timestamps = embedding.get_timestamp_embedding_as_numpy(
+                audio[missing]
+            )
+            if lengths is not None:
+                embeddings, timestamps = trim_timestamp_embeddings(
+                    embeddings,
+                    timestamps,
+                    torch.tensor([lengths[i] for i in missing]),
+                    embedding.sample_rate,
+                )
+            new_entries = [
+                {"embedding": e, "timestamps": t}
+                for e, t in zip(embeddings, timestamps)
+            ]
+            self._put([keys[i] for i in missing], new_entries)
+            for i, entry in zip(missing, new_entries):
+                entries[i] = entry
+        if len({entry["timestamps"].shape for entry in entries}) > 1:  # type: ignore
+            return (
+                [entry["embedding"] for entry in entries],  # type: ignore
+                [entry["timestamps"] for entry in entries],  # type: ignore
+            )
+        return (
+            np.stack([entry["embedding"] for entry in entries]),  # type: ignore
+            np.stack([entry["timestamps"] for entry in entries]),  # type: ignore
+        )
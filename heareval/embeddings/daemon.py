@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+A long-lived embedding worker, which loads its models once and computes
+the embeddings of any number of jobs, instead of reloading the models
+for every run of heareval.embeddings.runner.
+
+Start a worker with the same model options as the runner:
+
+    python3 -m heareval.embeddings.daemon serve MODULE --model WEIGHTS_FILE \
+        --spool-dir spool
+
+and submit jobs, each a tasks directory (or archive) and the embeddings
+directory to write to:
+
+    python3 -m heareval.embeddings.daemon submit --spool-dir spool \
+        --tasks-dir hear-2021.0.3/tasks/ --embeddings-dir embeddings \
+        --options '{"batch_size": 32}'
+    python3 -m heareval.embeddings.daemon status --spool-dir spool
+
+Jobs are JSON files in a spool directory:
+    * spool/queue/JOB.json: jobs waiting for a worker, run in order of
+      submission. A worker claims a job by moving it to spool/running/,
+      so several workers with the same models (e.g. one per GPU) can
+      serve the same spool.
+    * spool/status/JOB.json: the state of each job (queued, running, done
+      or failed), the tasks it has computed, its times and its error.
+
+After --idle-timeout seconds without a job, the worker frees its models,
+and loads them again for the next job (or exits, with --exit-on-idle).
+It also frees them after a failed job.
+
+torch, tensorflow and the embedding models are only imported once there
+is a job to run.
+"""
+
+import gc
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+
+from heareval.embeddings.runner import (
+    LoadedModels,
+    embed_tasks,
+    find_tasks,
+    is_done,
+    model_embed_dirs,
+    parse_models,
+)
+
+# Options of embed_tasks that a job can set, with the runner's defaults
+JOB_OPTIONS: Dict[str, Any] = {
+    "batch_size": None,
+    "memory_fraction": 0.8,
+    "max_padding": 0.1,
+    "decode_workers": 4,
+    "decode_worker_type": "thread",
+    "prefetch": 2,
+    "pin_memory": None,
+    "storage_dtype": "float32",
+    "window_seconds": None,
+    "window_overlap": 1.0,
+    "precision_tolerance": 0.02,
+    "sample_interval": 1.0,
+}
+
+
+def check_job_options(options: Dict[str, Any]):
+    unknown = set(options) - set(JOB_OPTIONS)
+    if unknown:
+        raise ValueError(
+            f"Unknown job options {sorted(unknown)}, should be some of "
+            f"{list(JOB_OPTIONS)}"
+        )
+
+
+def write_json(path: Path, data: Dict[str, Any]):
+    """
+    Write data to path atomically, so that it is never read half-written.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    open(tmp_path, "wt").write(json.dumps(data, indent=4))
+    os.replace(tmp_path, path)
+
+
+class Spool:
+    """
+    The job queue and job statuses in a spool directory.
+    """
+
+    def __init__(self, spool_dir: Path):
+        self.queue_dir = spool_dir.joinpath("queue")
+        self.running_dir = spool_dir.joinpath("running")
+        self.status_dir = spool_dir.joinpath("status")
+        for directory in [self.queue_dir, self.running_dir, self.status_dir]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def status_path(self, job_id: str) -> Path:
+        return self.status_dir.joinpath(f"{job_id}.json")
+
+    def submit(self, job: Dict[str, Any]) -> str:
+        # Job ids sort in order of submission
+        job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        write_json(
+            self.status_path(job_id),
+            {"job": job_id, "state": "queued", "submitted": time.time(), **job},
+        )
+        write_json(self.queue_dir.joinpath(f"{job_id}.json"), job)
+        return job_id
+
+    def claim(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        The id and spec of the oldest queued job, which this worker is the
+        only one to claim, or None if there are no queued jobs.
+        """
+        for job_path in sorted(self.queue_dir.glob("*.json")):
+            running_path = self.running_dir.joinpath(job_path.name)
+            try:
+                os.rename(job_path, running_path)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            return job_path.stem, json.load(running_path.open())
+        return None
+
+    def update(self, job_id: str, **fields):
+        status = json.load(self.status_path(job_id).open())
+        status.update(fields)
+        write_json(self.status_path(job_id), status)
+
+    def finish(self, job_id: str, **fields):
+        self.update(job_id, finished=time.time(), **fields)
+        self.running_dir.joinpath(f"{job_id}.json").unlink()
+
+    def statuses(self) -> List[Dict[str, Any]]:
+        return [
+            json.load(status_path.open())
+            for status_path in sorted(self.status_dir.glob("*.json"))
+        ]
+
+
+def free_models(loaded: LoadedModels):
+    """
+    Free the memory of the models, as far as the frameworks allow.
+    (Tensorflow keeps the GPU memory it has allocated until it exits.)
+    """
+    loaded.close()
+    loaded.embeddings = []
+    gc.collect()
+    if "torch" in sys.modules:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+@click.group()
+def daemon():
+    pass
+
+
+@daemon.command()
+@click.argument("modules", nargs=-1, required=True, type=str)
+@click.option("--spool-dir", required=True, help="Directory of the job queue", type=str)
+@click.option(
+    "--model",
+    multiple=True,
+    help="Location of model weights file. Give it once for all modules, or once "
+    'per module, in the same order, with "" for modules without weights',
+    type=str,
+)
+@click.option(
+    "--model-options",
+    multiple=True,
+    help="A JSON dict of kwargs to pass to load_model. Give it once for all "
+    "modules, or once per module, in the same order",
+    type=str,
+)
+@click.option(
+    "--precision",
+    default="float32",
+    help="Run torch models under autocast to float16 (GPU only) or bfloat16. "
+    "(Default: float32)",
+    type=click.Choice(["float32", "float16", "bfloat16"]),
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Location of an embedding cache, shared across tasks and runs. "
+    "(Default: no cache)",
+    type=str,
+)
+@click.option(
+    "--cache-size",
+    default=100.0,
+    help="Size quota of the embedding cache in GB. (Default: 100)",
+    type=float,
+)
+@click.option(
+    "--cpu-replicas",
+    default=0,
+    help="Compute embeddings on CPU in this many worker processes, each with its "
+    "own replica of the models. (Default: 0)",
+    type=int,
+)
+@click.option(
+    "--threads-per-replica",
+    default=None,
+    help="Intra-op threads of each CPU replica. (Default: the number of cores "
+    "it is pinned to)",
+    type=int,
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only compute the embeddings of shard i/n of the files of every split, "
+    "e.g. 0/4, for every job. (Default: all the files)",
+    type=str,
+)
+@click.option(
+    "--tf-function/--no-tf-function",
+    default=True,
+    help="Run tensorflow models through tf.function, or eagerly. "
+    "(Default: tf.function)",
+)
+@click.option(
+    "--idle-timeout",
+    default=600.0,
+    help="Free the models after this many seconds without a job. (Default: 600)",
+    type=float,
+)
+@click.option(
+    "--exit-on-idle",
+    is_flag=True,
+    help="Exit after --idle-timeout seconds without a job, instead of waiting "
+    "for more jobs",
+)
+@click.option(
+    "--poll-interval",
+    default=1.0,
+    help="Seconds between checks of the job queue. (Default: 1)",
+    type=float,
+)
+def serve(
+    modules: Tuple[str, ...],
+    spool_dir: str,
+    model: Tuple[str, ...] = (),
+    model_options: Tuple[str, ...] = (),
+    precision: str = "float32",
+    cache_dir: str = None,
+    cache_size: float = 100.0,
+    cpu_replicas: int = 0,
+    threads_per_replica: int = None,
+    shard: str = None,
+    tf_function: bool = True,
+    idle_timeout: float = 600.0,
+    exit_on_idle: bool = False,
+    poll_interval: float = 1.0,
+) -> None:
+    """
+    Load the models and compute the embeddings of the jobs in the spool.
+    """
+    model_paths, model_options_dicts = parse_models(modules, model, model_options)
+    shard_nshards = None
+    if shard is not None:
+        from heareval.embeddings.shards import parse_shard
+
+        shard_nshards = parse_shard(shard)
+    # The names of the models' embeddings directories, in any embeddings dir
+    names = [
+        embed_dir.name
+        for embed_dir in model_embed_dirs(
+            Path(), modules, model_options_dicts, precision, shard_nshards
+        )
+    ]
+    spool = Spool(Path(spool_dir))
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    # Stop like on Ctrl-C, recording the job that was interrupted
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    loaded: Optional[LoadedModels] = None
+    last_job = time.time()
+    print(f"Worker {worker} waiting for jobs in {spool_dir}")
+    while True:
+        claimed = spool.claim()
+        if claimed is None:
+            if time.time() - last_job > idle_timeout:
+                if loaded is not None:
+                    print(f"Idle for {idle_timeout} sec, freeing the models")
+                    free_models(loaded)
+                    loaded = None
+                if exit_on_idle:
+                    print(f"Idle for {idle_timeout} sec, exiting")
+                    return
+            time.sleep(poll_interval)
+            continue
+
+        job_id, job = claimed
+        print(f"Running job {job_id}: {json.dumps(job)}")
+        spool.update(job_id, state="running", started=time.time(), worker=worker)
+        try:
+            options = job.get("options", {})
+            check_job_options(options)
+            tasks, archive = find_tasks(Path(job["tasks_dir"]), job.get("task", "all"))
+            embed_dirs = model_embed_dirs(
+                Path(job["embeddings_dir"]),
+                modules,
+                model_options_dicts,
+                precision,
+                shard_nshards,
+            )
+            spool.update(
+                job_id,
+                tasks=[task_path.name for task_path in tasks],
+                embed_dirs=[str(embed_dir) for embed_dir in embed_dirs],
+                tasks_done=[],
+            )
+            if loaded is None:
+                loaded = LoadedModels(
+                    modules,
+                    model_paths,
+                    model_options_dicts,
+                    names,
+                    precision,
+                    cache_dir=cache_dir,
+                    cache_size=cache_size,
+                    cpu_replicas=cpu_replicas,
+                    threads_per_replica=threads_per_replica,
+                    tf_function=tf_function,
+                )
+            tasks_done = []
+            for task_path in tasks:
+                spool.update(job_id, current_task=task_path.name)
+                embed_tasks(
+                    loaded,
+                    [task_path],
+                    embed_dirs,
+                    archive,
+                    shard=shard_nshards,
+                    **{**JOB_OPTIONS, **options},
+                )
+                assert all(is_done(embed_dir, task_path) for embed_dir in embed_dirs)
+                tasks_done.append(task_path.name)
+                spool.update(job_id, tasks_done=tasks_done)
+        except Exception:
+            print(f"Job {job_id} failed")
+            traceback.print_exc()
+            spool.finish(job_id, state="failed", error=traceback.format_exc())
+            # A failed job can leave the models or their replica pools in
+            # any state, so the next job loads them again
+            if loaded is not None:
+                free_models(loaded)
+                loaded = None
+        except KeyboardInterrupt:
+            spool.finish(job_id, state="failed", error="Worker was interrupted")
+            raise
+        else:
+            print(f"Job {job_id} is done")
+            spool.finish(job_id, state="done", current_task=None)
+        last_job = time.time()
+
+
+@daemon.command()
+@click.option("--spool-dir", required=True, help="Directory of the job queue", type=str)
+@click.option(
+    "--tasks-dir",
+    default="tasks",
+    help="Location of tasks to compute embeddings on, either a directory or "
+    "a hear-*.tar.gz (or .tar) archive of tasks",
+    type=str,
+)
+@click.option(
+    "--task",
+    default="all",
+    help="Task to run. (Default: all)",
+    type=str,
+)
+@click.option(
+    "--embeddings-dir", default="embeddings", help="Location to save task embeddings"
+)
+@click.option(
+    "--options",
+    default="{}",
+    help="A JSON dict of runner options for this job, with underscores, e.g. "
+    '\'{"batch_size": 32, "storage_dtype": "float16"}\'',
+    type=str,
+)
+def submit(
+    spool_dir: str,
+    tasks_dir: str = "tasks",
+    task: str = "all",
+    embeddings_dir: str = "embeddings",
+    options: str = "{}",
+) -> None:
+    """
+    Queue a job, and print its id.
+    """
+    options_dict = json.loads(options)
+    if not isinstance(options_dict, dict):
+        raise ValueError("options should be a JSON dict")
+    check_job_options(options_dict)
+    job = {
+        # The worker may run in another directory
+        "tasks_dir": os.path.abspath(tasks_dir),
+        "task": task,
+        "embeddings_dir": os.path.abspath(embeddings_dir),
+        "options": options_dict,
+    }
+    print(Spool(Path(spool_dir)).submit(job))
+
+
+@daemon.command()
+@click.argument("job", required=False, type=str)
+@click.option("--spool-dir", required=True, help="Directory of the job queue", type=str)
+def status(job: Optional[str], spool_dir: str) -> None:
+    """
+    Print the status of every job, or all of JOB's status.
+    """
+    spool = Spool(Path(spool_dir))
+    if job is not None:
+        print(json.dumps(json.load(spool.status_path(job).open()), indent=4))
+        return
+    for job_status in spool.statuses():
+        state = job_status["state"]
+        if "tasks" in job_status:
+            state += (
+                f" {len(job_status['tasks_done'])}/{len(job_status['tasks'])} tasks"
+            )
+        if "started" in job_status:
+            end = job_status.get("finished", time.time())
+            state += f" in {end - job_status['started']:.0f} sec"
+        print(f"{job_status['job']}\t{state}\t{job_status['tasks_dir']}")
+
+
+if __name__ == "__main__":
+    daemon()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Parallel, prefetching audio decoding for computing embeddings.
+
+Audio can be decoded either by torch DataLoader worker processes, or by
+a pool of threads (soundfile releases the GIL while decoding). Threads
+are the default because forking worker processes after tensorflow has
+been initialized is unreliable.
+
+Either way, at most `prefetch` batches (at least one) are decoded ahead
+of the model, and batches can be returned in pinned memory, for faster copies to GPU.
+"""
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Sequence
+
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, SequentialSampler
+
+PROCESS = "process"
+THREAD = "thread"
+
+
+def pin_batch(batch: Sequence[Any]) -> tuple:
+    return tuple(x.pin_memory() if isinstance(x, torch.Tensor) else x for x in batch)
+
+
+class ThreadedDataLoader:
+    """
+    Decodes the items of each batch in a pool of threads, and keeps up to
+    `prefetch` batches decoding ahead of the batch being returned.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_sampler: Iterable[List[int]],
+        collate_fn: Callable,
+        num_workers: int,
+        prefetch: int,
+        pin_memory: bool,
+    ):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.num_workers = num_workers
+        # Without a batch in flight, there would be no batches at all
+        self.prefetch = max(1, prefetch)
+        self.pin_memory = pin_memory
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)  # type: ignore
+
+    def __iter__(self) -> Iterator:
+        batches = iter(self.batch_sampler)
+        pending: Deque[list] = collections.deque()
+        with ThreadPoolExecutor(self.num_workers) as pool:
+
+            def submit():
+                indices = next(batches, None)
+                if indices is not None:
+                    pending.append(
+                        [pool.submit(self.dataset.__getitem__, i) for i in indices]
+                    )
+
+            for _ in range(self.prefetch):
+                submit()
+            while pending:
+                futures = pending.popleft()
+                submit()
+                batch = self.collate_fn([future.result() for future in futures])
+                if self.pin_memory:
+                    batch = pin_batch(batch)
+                yield batch
+
+
+def decoding_dataloader(
+    dataset: Dataset,
+    collate_fn: Callable,
+    batch_size: int,
+    batch_sampler: Iterable[List[int]] = None,
+    num_workers: int = 0,
+    worker_type: str = THREAD,
+    prefetch: int = 2,
+    pin_memory: bool = False,
+):
+    """
+    A loader of batches from dataset, in order, decoded by num_workers
+    worker threads or processes. With no workers, audio is decoded in the
+    main thread.
+    """
+    if batch_sampler is None:
+        batch_sampler = BatchSampler(
+            SequentialSampler(dataset), batch_size=batch_size, drop_last=False
+        )
+    if num_workers > 0 and worker_type == THREAD:
+        return ThreadedDataLoader(
+            dataset, batch_sampler, collate_fn, num_workers, prefetch, pin_memory
+        )
+    elif num_workers == 0 or worker_type == PROCESS:
+        kwargs = {"prefetch_factor": max(1, prefetch)} if num_workers > 0 else {}
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            **kwargs,
+        )
+    else:
+        raise ValueError(f"Unknown decode worker type: {worker_type}")
+
+
+class LoaderTimer:
+    """
+    Wraps a loader to measure how long is spent waiting for it to
+    decode the next batch, versus how long is spent using each batch.
+    """
+
+    def __init__(self, loader: Iterable):
+        self.loader = loader
+        self.decode_time = 0.0
+        self.compute_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self.loader)  # type: ignore
+
+    def __iter__(self) -> Iterator:
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            yielded = time.perf_counter()
+            self.decode_time += yielded - start
+            yield batch
+            self.compute_time += time.perf_counter() - yielded
+
+    def summary(self) -> str:
+        total = self.decode_time + self.compute_time
+        if total == 0:
+            return ""
+        bound = "decode" if self.decode_time > self.compute_time else "compute"
+        return (
+            f"{bound}-bound: waiting for audio {self.decode_time:.1f}s "
+            f"({100 * self.decode_time / total:.0f}%), "
+            f"computing {self.compute_time:.1f}s"
+        )
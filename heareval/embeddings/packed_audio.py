@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Pack the audio of each split of a task into one contiguous file.
+
+Each split directory tasks/<task>/<sample_rate>/<split>/ holds one WAV
+per clip. On network filesystems opening every file dominates the time
+to read them. Packing writes all the clips of a split, decoded to
+float32, into tasks/<task>/<sample_rate>/<split>.packed-audio.f32,
+with an index of the offset and length of every clip in
+<split>.packed-audio-index.json. Computing embeddings then memory-maps
+the packed file, which turns reading audio into large sequential reads.
+
+Usage:
+    python3 -m heareval.embeddings.packed_audio --tasks-dir tasks --sample-rate 16000
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+import soundfile as sf
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+
+def packed_audio_paths(audio_dir: Path) -> Tuple[Path, Path]:
+    """
+    The packed audio file and its index, for a split's audio directory.
+    """
+    return (
+        audio_dir.with_name(f"{audio_dir.name}.packed-audio.f32"),
+        audio_dir.with_name(f"{audio_dir.name}.packed-audio-index.json"),
+    )
+
+
+def has_packed_audio(audio_dir: Path) -> bool:
+    # The index is written last, so it only exists if packing completed
+    return packed_audio_paths(audio_dir)[1].exists()
+
+
+def pack_split(audio_dir: Path, filenames: List[str], sample_rate: int):
+    """
+    Pack the audio files of a split into one file of float32 samples,
+    in the given order, and write the index of every file.
+    """
+    packed_path, index_path = packed_audio_paths(audio_dir)
+    tmp_path = packed_path.with_suffix(".tmp")
+    files: Dict[str, Tuple[int, int]] = {}
+    offset = 0
+    with open(tmp_path, "wb") as fp:
+        for filename in tqdm(filenames):
+            audio, sr = sf.read(str(audio_dir.joinpath(filename)), dtype=np.float32)
+            assert sr == sample_rate, f"{filename} has sample rate {sr}"
+            assert audio.ndim == 1, f"{filename} is not mono"
+            fp.write(audio.tobytes())
+            files[filename] = (offset, len(audio))
+            offset += len(audio)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, packed_path)
+    index = {"sample_rate": sample_rate, "nsamples": offset, "files": files}
+    index_path.write_text(json.dumps(index))
+
+
+def pack_task(task_path: Path, sample_rate: int):
+    metadata = json.load(task_path.joinpath("task_metadata.json").open())
+    for split in metadata["splits"]:
+        audio_dir = task_path.joinpath(str(sample_rate), split)
+        if has_packed_audio(audio_dir):
+            print(f"{audio_dir} is already packed")
+            continue
+        print(f"Packing {audio_dir}")
+        split_data = json.load(task_path.joinpath(f"{split}.json").open())
+        pack_split(audio_dir, list(split_data.keys()), sample_rate)
+
+
+class PackedAudioDataset(Dataset):
+    """
+    Return audio and audio filenames from a split's packed audio file.
+
+    The audio returned is a read-only view into the memory-mapped file,
+    so no copy is made until the audio is collated into a batch.
+    """
+
+    def __init__(self, data: Dict, audio_dir: Path, sample_rate: int):
+        self.filenames = list(data.keys())
+        self.packed_path, index_path = packed_audio_paths(audio_dir)
+        index = json.load(index_path.open())
+        assert index["sample_rate"] == sample_rate
+        self.nsamples = index["nsamples"]
+        self.files = {filename: index["files"][filename] for filename in self.filenames}
+        self.sample_rate = sample_rate
+        # Opened lazily, so that each DataLoader worker process maps the file
+        # itself instead of the samples being pickled to it.
+        self._audio: Optional[np.memmap] = None
+
+    @property
+    def audio(self) -> np.memmap:
+        if self._audio is None:
+            self._audio = np.memmap(
+                self.packed_path, dtype=np.float32, mode="r", shape=(self.nsamples,)
+            )
+        return self._audio
+
+    def __getstate__(self):
+        return {**self.__dict__, "_audio": None}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        offset, length = self.files[self.filenames[idx]]
+        return self.audio[offset : offset + length], self.filenames[idx]
+
+    def lengths(self) -> List[int]:
+        return [self.files[filename][1] for filename in self.filenames]
+
+
+@click.command()
+@click.option(
+    "--tasks-dir",
+    default="tasks",
+    help="Location of tasks to pack the audio of",
+    type=str,
+)
+@click.option(
+    "--task",
+    default="all",
+    help="Task to pack. (Default: all)",
+    type=str,
+)
+@click.option(
+    "--sample-rate",
+    required=True,
+    help="Sample rate of the audio to pack",
+    type=int,
+)
+def main(tasks_dir: str, task: str, sample_rate: int):
+    tasks_dir_path = Path(tasks_dir)
+    if task == "all":
+        tasks = list(tasks_dir_path.iterdir())
+    else:
+        tasks = [tasks_dir_path.joinpath(task)]
+        assert os.path.exists(tasks[0]), f"{tasks[0]} does not exist"
+    for task_path in tasks:
+        pack_task(task_path, sample_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+A background stage of the embedding pipeline.
+
+While the main thread runs the model on one batch, a BackgroundStage
+thread aligns the labels of and writes the previous batches. Its queue
+is bounded, so if writing falls behind, the main thread blocks
+(back-pressure) instead of holding ever more embeddings in memory.
+
+An exception in the background thread is re-raised in the main thread,
+on the next submit() or when the stage is closed.
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+# Tells the background thread to stop
+_STOP = object()
+
+
+class BackgroundStage:
+    """
+    Runs the submitted functions in order in one background thread.
+
+    Args:
+        max_pending: most submitted functions waiting to be run, after
+            which submit() blocks
+        name: name of the stage in summary()
+    """
+
+    def __init__(self, max_pending: int = 4, name: str = "writing"):
+        self.name = name
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.error: Optional[BaseException] = None
+        # Time the caller was blocked in submit() because the queue was full
+        self.blocked_time = 0.0
+        # Time the background thread spent running functions, and waiting for
+        # functions to be submitted
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            started = time.perf_counter()
+            self.idle_time += started - start
+            if item is _STOP:
+                return
+            if self.error is not None:
+                # Keep draining the queue, so that submit() doesn't block
+                continue
+            fn, args = item
+            try:
+                fn(*args)
+            except BaseException as e:
+                self.error = e
+            self.busy_time += time.perf_counter() - started
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if not self.thread.is_alive():
+                    raise RuntimeError(f"The {self.name} thread has stopped")
+        self.blocked_time += time.perf_counter() - start
+
+    def submit(self, fn: Callable, *args: Any):
+        """
+        Run fn(*args) in the background, after all the functions submitted
+        before it.
+        """
+        self._check()
+        self._put((fn, args))
+
+    def close(self):
+        """
+        Wait for all the submitted functions to finish, and re-raise the
+        first exception any of them raised.
+        """
+        if self.thread.is_alive():
+            self._put(_STOP)
+            self.thread.join()
+        self._check()
+
+    def __enter__(self) -> "BackgroundStage":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Finish what was submitted, but don't hide the original exception
+            try:
+                self.close()
+            except BaseException:
+                pass
+
+    def summary(self) -> str:
+        return (
+            f"{self.name} {self.busy_time:.1f}s (idle {self.idle_time:.1f}s), "
+            f"blocked on {self.name} {self.blocked_time:.1f}s"
+        )
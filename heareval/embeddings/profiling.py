@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Per-stage timings of computing the embeddings of a split with one model,
+which are saved in profile.embeddings.json.
+
+The stages are:
+    * decode: waiting for audio to be decoded (shared by the models that
+      share the decoded audio)
+    * host_to_device: copying audio to the model's device
+    * forward: running the model. On GPU, the device is synchronized
+      after the model so that its time isn't counted in device_to_host
+    * device_to_host: copying the embeddings back
+    * trim: dropping the timestamp embeddings of padding
+    * label_alignment: finding the labels of each timestamp
+    * write: writing the embeddings and their manifest
+    * memmap: shuffling the embeddings into their final memmap
+
+Batch latency is the time the model takes on a batch of decoded audio,
+including waiting to hand its embeddings to be written.
+
+Throughput is over the time since the batches started, after setup
+(tuning the batch size and checking reduced precision), whose time is
+reported on its own.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+
+STAGES = [
+    "decode",
+    "host_to_device",
+    "forward",
+    "device_to_host",
+    "trim",
+    "label_alignment",
+    "write",
+    "memmap",
+]
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage, from any thread, and the
+    latency and size of every batch.
+    """
+
+    def __init__(self):
+        self.times: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.lock = threading.Lock()
+        self.batch_latencies: List[float] = []
+        self.clips = 0
+        self.audio_seconds = 0.0
+        self.start = time.perf_counter()
+        self.setup_time = 0.0
+
+    def end_setup(self):
+        """
+        Count the time so far as setup, and time throughput from now.
+        """
+        now = time.perf_counter()
+        self.setup_time += now - self.start
+        self.start = now
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.times[stage] += seconds
+
+    def add_times(self, times: Dict[str, float]):
+        for stage, seconds in times.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add_batch(self, latency: float, clips: int, audio_seconds: float):
+        self.batch_latencies.append(latency)
+        self.clips += clips
+        self.audio_seconds += audio_seconds
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        The timings so far, with throughput over the time since the timer
+        was created, or since end_setup.
+        """
+        elapsed = time.perf_counter() - self.start
+        latency: Dict[str, float] = {}
+        if self.batch_latencies:
+            latencies = np.array(self.batch_latencies)
+            for percentile in [50, 90, 99]:
+                latency[f"p{percentile}"] = float(np.percentile(latencies, percentile))
+            latency["max"] = float(latencies.max())
+            latency["mean"] = float(latencies.mean())
+        return {
+            "time_elapsed": elapsed,
+            "setup_time": self.setup_time,
+            "stages": dict(self.times),
+            "batches": len(self.batch_latencies),
+            "batch_latency": latency,
+            "clips": self.clips,
+            "audio_seconds": self.audio_seconds,
+            "clips_per_sec": self.clips / elapsed if elapsed > 0 else 0.0,
+            "audio_seconds_per_sec": (
+                self.audio_seconds / elapsed if elapsed > 0 else 0.0
+            ),
+        }
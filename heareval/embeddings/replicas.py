@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Compute embeddings on CPU with several replicas of the models, each in
+its own worker process.
+
+torch's intra-op parallelism scales poorly past a few cores for the small
+batches of most embedding models. Instead, each replica is pinned to its
+own slice of the CPU cores, and uses that many intra-op threads. The
+batches of a split are sharded round-robin across the replicas, which
+decode their own audio and run the models on it. Results are returned
+in batch order, so they are written exactly as in a single-process run.
+
+The models are only loaded by the replicas. The runner process has a
+ReplicaEmbedding for each model instead, whose batch size is tuned,
+and whose reduced precision is checked, by the first replica, on CPU
+like the replicas that compute its embeddings.
+"""
+
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from torch.utils.data import Dataset
+
+# Results each replica can compute ahead of the batch being written
+MAX_PENDING_RESULTS = 2
+
+
+class ModelSpec(NamedTuple):
+    """
+    Everything a replica needs to load a model and its cache.
+
+    name is the name of the model's embeddings directory, and cache is
+    (cache_dir, model_key, max_bytes) if the model has an embedding cache.
+    """
+
+    name: str
+    module: str
+    model_path: Optional[str]
+    model_options: Dict[str, Any]
+    cache: Optional[Tuple[str, str, int]]
+    precision: str = "float32"
+    tf_function: bool = True
+
+
+def core_slices(nreplicas: int) -> List[List[int]]:
+    """
+    Split the cores this process may run on into nreplicas contiguous
+    slices of (nearly) equal size. If there are fewer cores than replicas,
+    replicas share cores.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < nreplicas:
+        print(f"WARNING: {nreplicas} replicas share {len(cores)} cores")
+        return [[cores[i % len(cores)]] for i in range(nreplicas)]
+    slices = []
+    for i in range(nreplicas):
+        slices.append(
+            cores[i * len(cores) // nreplicas : (i + 1) * len(cores) // nreplicas]
+        )
+    return slices
+
+
+def _replica_main(
+    rank: int,
+    cores: List[int],
+    threads: int,
+    specs: List[ModelSpec],
+    jobs: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+):
+    # Replicas run on CPU, even if there is a GPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+
+    torch.set_num_threads(threads)
+
+    from heareval.embeddings.bucketing import pad_collate
+    from heareval.embeddings.cache import EmbeddingCache
+    from heareval.embeddings.profiling import StageTimer
+    from heareval.embeddings.task_embeddings import (
+        Embedding,
+        batch_chunks,
+        compute_embeddings,
+    )
+
+    try:
+        embeddings = {}
+        caches = {}
+        for spec in specs:
+            embeddings[spec.name] = Embedding(
+                spec.module,
+                spec.model_path,
+                spec.model_options,
+                spec.precision,
+                spec.tf_function,
+            )
+            caches[spec.name] = None
+            if spec.cache is not None:
+                cache_dir, model_key, max_bytes = spec.cache
+                caches[spec.name] = EmbeddingCache(
+                    Path(cache_dir), model_key, max_bytes
+                )
+        results.put(
+            (
+                "ready",
+                {name: embedding.sample_rate for name, embedding in embeddings.items()},
+            )
+        )
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            kind, payload = job
+            if kind == "call":
+                name, method, args = payload
+                results.put(("result", getattr(embeddings[name], method)(*args)))
+                continue
+            dataset, batches, embedding_type, models, window = payload
+            for batch_index, indices in batches:
+                start = time.perf_counter()
+                audios, filenames, clip_lengths = pad_collate(
+                    [dataset[i] for i in indices]
+                )
+                decode_time = time.perf_counter() - start
+                outputs = []
+                for name, batch_size, remaining in models:
+                    cache = caches[name]
+                    if cache is not None:
+                        hits, misses = cache.hits, cache.misses
+                    start = time.perf_counter()
+                    timer = StageTimer()
+                    embeddings[name].timer = timer
+                    chunks = []
+                    for chunk_audios, chunk_filenames, chunk_lengths in batch_chunks(
+                        audios, filenames, clip_lengths, remaining, batch_size
+                    ):
+                        chunk_embeddings, chunk_timestamps = compute_embeddings(
+                            embeddings[name],
+                            cache,
+                            embedding_type,
+                            chunk_audios,
+                            window,
+                            batch_size,
+                            chunk_lengths,
+                        )
+                        chunks.append(
+                            (
+                                chunk_embeddings,
+                                chunk_timestamps,
+                                chunk_filenames,
+                                chunk_lengths,
+                                chunk_audios.shape[1],
+                            )
+                        )
+                    cache_counts = None
+                    if cache is not None:
+                        cache_counts = (cache.hits - hits, cache.misses - misses)
+                    latency = time.perf_counter() - start
+                    outputs.append((chunks, cache_counts, timer.times, latency))
+                results.put(("batch", (batch_index, decode_time, outputs)))
+    except BaseException:
+        results.put(("error", traceback.format_exc()))
+
+
+class ReplicaPool:
+    """
+    Worker processes that each load every model of specs, pinned to
+    their own slice of cores. Once they are ready, sample_rates is the
+    sample rate of each model, by name.
+
+    Args:
+        specs: the models
+        nreplicas: number of worker processes
+        threads: intra-op threads of each replica. (Default: the number
+            of cores it is pinned to)
+    """
+
+    def __init__(
+        self, specs: List[ModelSpec], nreplicas: int, threads: Optional[int] = None
+    ):
+        self.specs = specs
+        self.nreplicas = nreplicas
+        self.closed = False
+        # Spawn, because forking a process that has initialized torch or
+        # tensorflow is unreliable
+        context = multiprocessing.get_context("spawn")
+        self.jobs = [context.Queue() for _ in range(nreplicas)]
+        self.results = [
+            context.Queue(maxsize=MAX_PENDING_RESULTS) for _ in range(nreplicas)
+        ]
+        self.processes = []
+        for rank, cores in enumerate(core_slices(nreplicas)):
+            replica_threads = threads if threads is not None else len(cores)
+            print(
+                f"Starting replica {rank} on cores {cores} with "
+                f"{replica_threads} threads"
+            )
+            process = context.Process(
+                target=_replica_main,
+                args=(
+                    rank,
+                    cores,
+                    replica_threads,
+                    specs,
+                    self.jobs[rank],
+                    self.results[rank],
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.sample_rates: Dict[str, int] = {}
+        for rank in range(nreplicas):
+            self.sample_rates = self._get(rank)
+
+    def _get(self, rank: int) -> Any:
+        while True:
+            try:
+                kind, payload = self.results[rank].get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.processes[rank].is_alive():
+                    self.close()
+                    raise RuntimeError(f"Replica {rank} exited unexpectedly")
+        if kind == "error":
+            self.close()
+            raise RuntimeError(f"Replica {rank} failed:\n{payload}")
+        return payload
+
+    def call(self, name: str, method: str, *args) -> Any:
+        """
+        Call a method of the Embedding of model name in the first replica,
+        and return its result.
+        """
+        if self.closed:
+            raise RuntimeError("The replica pool is closed")
+        self.jobs[0].put(("call", (name, method, args)))
+        return self._get(0)
+
+    def embed_batches(
+        self,
+        dataset: Dataset,
+        batches: List[List[int]],
+        embedding_type: str,
+        models: List[Tuple[str, int, Set[str]]],
+        window: Optional[Tuple[int, int]] = None,
+    ) -> Iterator[Tuple[float, List]]:
+        """
+        Compute the embeddings of every batch of dataset, with batch i
+        computed by replica i % nreplicas.
+
+        models is the (name, batch size, files still needed) of each model
+        to compute the embeddings of. For each batch, in order, yields the
+        time to decode it, and a list with (chunks, cache hits and misses or
+        None, stage times, latency) for each model. Each chunk is (embeddings,
+        timestamps or None, filenames, clip lengths, padded length).
+        window is passed to compute_embeddings.
+
+        If this is not iterated to the end, e.g. because the caller failed,
+        the replicas are still computing the rest of their shards, so the
+        pool is closed.
+        """
+        if self.closed:
+            raise RuntimeError("The replica pool is closed")
+        for rank in range(self.nreplicas):
+            shard = [(i, batches[i]) for i in range(rank, len(batches), self.nreplicas)]
+            self.jobs[rank].put(
+                ("embed", (dataset, shard, embedding_type, models, window))
+            )
+        finished = False
+        try:
+            for i in range(len(batches)):
+                batch_index, decode_time, outputs = self._get(i % self.nreplicas)
+                assert batch_index == i
+                yield decode_time, outputs
+            finished = True
+        finally:
+            if not finished:
+                self.close(terminate=True)
+
+    def __len__(self) -> int:
+        return self.nreplicas
+
+    def close(self, terminate: bool = False):
+        """
+        Stop the replicas once they have finished their jobs, or right away
+        if terminate, e.g. if they may be blocked on results nobody reads.
+        """
+        self.closed = True
+        for rank, process in enumerate(self.processes):
+            if process.is_alive():
+                if terminate:
+                    process.terminate()
+                else:
+                    self.jobs[rank].put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+class ReplicaEmbedding:
+    """
+    Stands in for the Embedding of a model in the runner process, when
+    only the replicas of pool load it. Batch sizes are tuned and reduced
+    precision is checked in the pool's first replica.
+
+    Args:
+        name: the name of the model in pool, see ModelSpec
+    """
+
+    def __init__(self, pool: ReplicaPool, name: str, precision: str = "float32"):
+        self.pool = pool
+        self.name = name
+        self.sample_rate = pool.sample_rates[name]
+        self.precision = precision
+        # Set by check_precision()
+        self.precision_check: Optional[Dict[str, float]] = None
+
+    def tuned_batch_size(
+        self, metadata: Dict, nsamples: int, cache_path: Path, memory_fraction: float
+    ) -> int:
+        return self.pool.call(
+            self.name,
+            "tuned_batch_size",
+            metadata,
+            nsamples,
+            cache_path,
+            memory_fraction,
+        )
+
+    def check_precision(
+        self, audio: Any, embedding_type: str, tolerance: float
+    ) -> Dict[str, float]:
+        self.precision_check = self.pool.call(
+            self.name, "check_precision", audio, embedding_type, tolerance
+        )
+        return self.precision_check
@@ -1,41 +1,401 @@
 #!/usr/bin/env python3
 """
 Computes embeddings on a set of tasks
+
+Several embedding modules (or the same module with different weights or
+options) can be given at once. Models with the same sample rate then
+share one pass of audio decoding per task, and the embeddings of each
+model are written to its own directory.
+
+torch, tensorflow and the embedding model are only imported once there
+are tasks left to compute embeddings for, so that --help, or rerunning
+on tasks that are already done, is fast.
 """
 
 import json
 import os
-import shutil
 import time
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import click
-import tensorflow as tf
-import torch
 from slugify import slugify
 from tqdm import tqdm
 
 import heareval.gpu_max_mem as gpu_max_mem
-from heareval.embeddings.task_embeddings import Embedding, task_embeddings
+from heareval.resources import ResourceSampler
+
+
+def check_tensorflow_gpus():
+    import tensorflow as tf
+    import torch
+
+    if torch.cuda.is_available() and not tf.test.is_gpu_available(
+        cuda_only=False, min_cuda_compute_capability=None
+    ):
+        raise ValueError("GPUs not available in tensorflow, but found by pytorch")
+
+
+def options_slug(model_options_dict: Dict[str, Any]) -> str:
+    if model_options_dict:
+        return "-" + "-".join(
+            [
+                "%s=%s" % (slugify(k), slugify(str(v)))
+                for k, v in model_options_dict.items()
+            ]
+        )
+    else:
+        return ""
+
+
+def per_module(name: str, values: Tuple[str, ...], modules: Tuple[str, ...]) -> List:
+    """
+    An option given either not at all, once for all modules, or once per
+    module, as a list with one value (or None) per module.
+    """
+    if len(values) == 0:
+        return [None] * len(modules)
+    elif len(values) == 1:
+        return list(values) * len(modules)
+    elif len(values) == len(modules):
+        return list(values)
+    else:
+        raise ValueError(
+            f"{name} should be given once, or once for each of the {len(modules)} "
+            f"modules, but was given {len(values)} times"
+        )
+
+
+def parse_models(
+    modules: Tuple[str, ...], model: Tuple[str, ...], model_options: Tuple[str, ...]
+) -> Tuple[List[Optional[str]], List[Dict[str, Any]]]:
+    """
+    The weights file (or None) and the load_model options of every module,
+    from --model and --model-options.
+    """
+    model_paths: List[Optional[str]] = []
+    for model_path in per_module("--model", model, modules):
+        if model_path and not os.path.exists(model_path):
+            raise ValueError(f"Model weights file {model_path} does not exist")
+        model_paths.append(model_path or None)
+
+    model_options_dicts: List[Dict[str, Any]] = []
+    for options in per_module("--model-options", model_options, modules):
+        model_options_dict = json.loads(options or "{}")
+        if not isinstance(model_options_dict, dict):
+            raise ValueError("model_options should be a JSON dict")
+        model_options_dicts.append(model_options_dict)
+    return model_paths, model_options_dicts
+
+
+def find_tasks(tasks_dir_path: Path, task: str) -> Tuple[List[Path], Any]:
+    """
+    The task directories to compute embeddings on, and the TaskArchive they
+    are read from if tasks_dir_path is an archive of tasks (else None).
+    """
+    archive = None
+    if tasks_dir_path.is_file():
+        from heareval.embeddings.tar_audio import TaskArchive, is_task_archive
+
+        if not is_task_archive(tasks_dir_path):
+            raise ValueError(f"{tasks_dir_path} is not a .tar or .tar.gz archive")
+        archive = TaskArchive(tasks_dir_path)
+    elif not tasks_dir_path.is_dir():
+        raise ValueError(
+            "Cannot locate directory containing tasks. "
+            f"Ensure that directory named {tasks_dir_path} exists or specify a folder "
+            f"containing HEAR tasks using the argument --tasks-dir"
+        )
+
+    if archive is not None:
+        tasks = [
+            task_path
+            for task_path in archive.tasks()
+            if task == "all" or task_path.name == task
+        ]
+        assert tasks, f"{task} is not in {tasks_dir_path}"
+    elif task == "all":
+        tasks = list(tasks_dir_path.iterdir())
+    else:
+        tasks = [tasks_dir_path.joinpath(task)]
+        assert os.path.exists(tasks[0]), f"{tasks[0]} does not exist"
+    return tasks, archive
+
+
+def model_embed_dirs(
+    embeddings_dir_path: Path,
+    modules: Sequence[str],
+    model_options_dicts: Sequence[Dict[str, Any]],
+    precision: str = "float32",
+    shard: Optional[Tuple[int, int]] = None,
+) -> List[Path]:
+    """
+    The embeddings directory of every module.
+    """
+    # TODO: Would be good to include the version here
+    # https://github.com/hearbenchmark/hear2021-eval-kit/issues/37
+    # (This is Embedding.name, the name of the embedding module.)
+    precision_slug = "" if precision == "float32" else f"-precision={precision}"
+    embed_dirs = [
+        embeddings_dir_path.joinpath(
+            module + options_slug(model_options_dict) + precision_slug
+        )
+        for module, model_options_dict in zip(modules, model_options_dicts)
+    ]
+    if shard is not None:
+        from heareval.embeddings.shards import shard_embed_dir
+
+        embed_dirs = [shard_embed_dir(embed_dir, *shard) for embed_dir in embed_dirs]
+    if len(set(embed_dirs)) != len(embed_dirs):
+        raise ValueError(
+            "Modules with the same name and options would write their embeddings "
+            "to the same directory"
+        )
+    return embed_dirs
+
+
+def is_done(embed_dir: Path, task_path: Path) -> bool:
+    return embed_dir.joinpath(task_path.name, ".done.embeddings").exists()
+
+
+class LoadedModels:
+    """
+    The embedding models of a run, with their embedding caches and, with
+    cpu_replicas, a pool of CPU replicas. They are loaded once, and can
+    compute the embeddings of any number of tasks with embed_tasks.
+
+    With cpu_replicas, only the replicas load the models, and embeddings
+    are their ReplicaEmbeddings.
+
+    Args:
+        names: the name of each model's embeddings directory, by which the
+            replicas know each model
+    """
+
+    def __init__(
+        self,
+        modules: Sequence[str],
+        model_paths: Sequence[Optional[str]],
+        model_options_dicts: Sequence[Dict[str, Any]],
+        names: Sequence[str],
+        precision: str = "float32",
+        cache_dir: Optional[str] = None,
+        cache_size: float = 100.0,
+        cpu_replicas: int = 0,
+        threads_per_replica: Optional[int] = None,
+        tf_function: bool = True,
+    ):
+        from heareval.embeddings.cache import EmbeddingCache, model_key
+        from heareval.embeddings.replicas import (
+            ModelSpec,
+            ReplicaEmbedding,
+            ReplicaPool,
+        )
+        from heareval.embeddings.task_embeddings import TENSORFLOW, Embedding
+
+        self.modules = list(modules)
+        self.model_options_dicts = list(model_options_dicts)
+        self.precision = precision
+        self.cpu_replicas = cpu_replicas
+
+        self.caches: List[Optional[EmbeddingCache]] = [None] * len(modules)
+        if cache_dir is not None:
+            self.caches = [
+                EmbeddingCache(
+                    Path(cache_dir),
+                    model_key(module, model_path, model_options_dict, precision),
+                    max_bytes=int(cache_size * 1024 * 1024 * 1024),
+                )
+                for module, model_path, model_options_dict in zip(
+                    modules, model_paths, model_options_dicts
+                )
+            ]
+
+        self.embeddings: List[Union[Embedding, ReplicaEmbedding]] = []
+        self.pool: Optional[ReplicaPool] = None
+        if cpu_replicas > 0:
+            # The replicas load every model on CPU. Loading them here too
+            # would only take memory, and tune their batch sizes for the
+            # wrong device.
+            specs = []
+            for i in range(len(modules)):
+                cache = self.caches[i]
+                cache_spec = None
+                if cache is not None:
+                    cache_spec = (cache_dir, cache.model_key, cache.max_bytes)
+                specs.append(
+                    ModelSpec(
+                        names[i],
+                        modules[i],
+                        model_paths[i],
+                        model_options_dicts[i],
+                        cache_spec,
+                        precision,
+                        tf_function,
+                    )
+                )
+            self.pool = ReplicaPool(specs, cpu_replicas, threads_per_replica)
+            self.embeddings = [
+                ReplicaEmbedding(self.pool, name, precision) for name in names
+            ]
+        else:
+            # Load the embedding models
+            self.embeddings = [
+                Embedding(
+                    module, model_path, model_options_dict, precision, tf_function
+                )
+                for module, model_path, model_options_dict in zip(
+                    modules, model_paths, model_options_dicts
+                )
+            ]
+            if any(
+                isinstance(embedding, Embedding) and embedding.type == TENSORFLOW
+                for embedding in self.embeddings
+            ):
+                check_tensorflow_gpus()
 
-if torch.cuda.is_available() and not tf.test.is_gpu_available(
-    cuda_only=False, min_cuda_compute_capability=None
+        # Models with the same sample rate share the decoded audio
+        self.sample_rate_models: Dict[int, List[int]] = {}
+        for i, embedding in enumerate(self.embeddings):
+            self.sample_rate_models.setdefault(embedding.sample_rate, []).append(i)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+
+def embed_tasks(
+    loaded: LoadedModels,
+    tasks: Sequence[Path],
+    embed_dirs: Sequence[Path],
+    archive: Any = None,
+    batch_size: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    max_padding: float = 0.1,
+    decode_workers: int = 4,
+    decode_worker_type: str = "thread",
+    prefetch: int = 2,
+    pin_memory: Optional[bool] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    storage_dtype: str = "float32",
+    window_seconds: Optional[float] = None,
+    window_overlap: float = 1.0,
+    precision_tolerance: float = 0.02,
+    sample_interval: float = 1.0,
 ):
-    raise ValueError("GPUs not available in tensorflow, but found by pytorch")
+    """
+    Compute the embeddings of every model on every task, into the model's
+    directory of embed_dirs, skipping the tasks that are already done.
+    The options are those of the runner.
+    """
+    import torch
+
+    from heareval.embeddings.task_embeddings import task_embeddings
+
+    modules = loaded.modules
+    model_options_dicts = loaded.model_options_dicts
+    embeddings = loaded.embeddings
+    caches = loaded.caches
+    precision = loaded.precision
+    if loaded.cpu_replicas > 0:
+        # The replicas share the host memory, so each tunes its batch size
+        # to its share of memory_fraction.
+        memory_fraction /= loaded.cpu_replicas
+
+    for task_path in tqdm(tasks):
+        for sample_rate, models in loaded.sample_rate_models.items():
+            models = [i for i in models if not is_done(embed_dirs[i], task_path)]
+            if not models:
+                continue
+            embed_task_dirs = [embed_dirs[i].joinpath(task_path.name) for i in models]
+
+            # If an embed_task_dir already exists, a previous run was interrupted.
+            # task_embeddings resumes it from the last committed batch.
+
+            start = time.time()
+            gpu_max_mem.reset()
+            sampler = ResourceSampler(sample_interval) if sample_interval > 0 else None
+            if sampler is not None:
+                sampler.start()
+
+            try:
+                profiles = task_embeddings(
+                    [embeddings[i] for i in models],
+                    task_path,
+                    embed_task_dirs,
+                    [caches[i] for i in models],
+                    batch_size=batch_size,
+                    memory_fraction=memory_fraction,
+                    max_padding=max_padding,
+                    decode_workers=decode_workers,
+                    decode_worker_type=decode_worker_type,
+                    prefetch=prefetch,
+                    pin_memory=(
+                        torch.cuda.is_available() if pin_memory is None else pin_memory
+                    ),
+                    archive=archive,
+                    replicas=loaded.pool,
+                    shard=shard,
+                    storage_dtype=storage_dtype,
+                    window_seconds=window_seconds,
+                    window_overlap=window_overlap,
+                    precision_tolerance=precision_tolerance,
+                )
+            finally:
+                # Stop sampling even if the task failed, e.g. in the daemon,
+                # which carries on with the next job
+                if sampler is not None:
+                    sampler.stop()
+
+            time_elapsed = time.time() - start
+            gpu_max_mem_used = gpu_max_mem.measure()
+            for i, embed_task_dir, profile in zip(models, embed_task_dirs, profiles):
+                print(
+                    f"...computed embeddings in {time_elapsed} sec "
+                    f"(GPU max mem {gpu_max_mem_used}) "
+                    f"for {task_path.name} using {modules[i]} "
+                    f"{json.dumps(model_options_dicts[i])}"
+                )
+                # When models share decoding, the time and memory are of all
+                # of them together. The timings of each split are of this model.
+                open(embed_task_dir.joinpath("profile.embeddings.json"), "wt").write(
+                    json.dumps(
+                        {
+                            "time_elapsed": time_elapsed,
+                            "gpu_max_mem": gpu_max_mem_used,
+                            "gpu_device_name": gpu_max_mem.device_name(),
+                            "precision": precision,
+                            "precision_check": embeddings[i].precision_check,
+                            "splits": profile,
+                        },
+                        indent=4,
+                    )
+                )
+
+                if sampler is not None:
+                    sampler.save(embed_task_dir.joinpath("resources.embeddings.json"))
+
+                # Touch this file to indicate that processing completed
+                # successfully
+                open(embed_task_dir.joinpath(".done.embeddings"), "wt")
 
 
 @click.command()
-@click.argument("module", type=str)
+@click.argument("modules", nargs=-1, required=True, type=str)
 @click.option(
     "--model",
-    default=None,
-    help="Location of model weights file",
-    type=click.Path(exists=True),
+    multiple=True,
+    help="Location of model weights file. Give it once for all modules, or once "
+    'per module, in the same order, with "" for modules without weights',
+    type=str,
 )
 @click.option(
     "--tasks-dir",
     default="tasks",
-    help="Location of tasks to compute embeddings on",
+    help="Location of tasks to compute embeddings on, either a directory or "
+    "a hear-*.tar.gz (or .tar) archive of tasks, which is read without "
+    "extracting it",
     type=str,
 )
 @click.option(
@@ -48,89 +408,237 @@ if torch.cuda.is_available() and not tf.test.is_gpu_available(
     "--embeddings-dir", default="embeddings", help="Location to save task embeddings"
 )
 @click.option(
-    "--model-options", default="{}", help="A JSON dict of kwargs to pass to load_model"
+    "--model-options",
+    multiple=True,
+    help="A JSON dict of kwargs to pass to load_model. Give it once for all "
+    "modules, or once per module, in the same order",
+    type=str,
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Location of an embedding cache, shared across tasks and runs. "
+    "(Default: no cache)",
+    type=str,
+)
+@click.option(
+    "--cache-size",
+    default=100.0,
+    help="Size quota of the embedding cache in GB, after which the least "
+    "recently used embeddings are evicted. (Default: 100)",
+    type=float,
+)
+@click.option(
+    "--batch-size",
+    default=None,
+    help="Batch size for computing embeddings. (Default: the largest batch "
+    "size that fits in --memory-fraction of GPU memory, or of host memory "
+    "without a GPU, probed once per model, task and sample rate)",
+    type=int,
+)
+@click.option(
+    "--memory-fraction",
+    default=0.8,
+    help="Fraction of memory to use when tuning the batch size. (Default: 0.8)",
+    type=float,
+)
+@click.option(
+    "--max-padding",
+    default=0.1,
+    help="For event tasks with audio of different lengths, files batched "
+    "together are at most this fraction longer than the shortest. (Default: 0.1)",
+    type=float,
+)
+@click.option(
+    "--decode-workers",
+    default=4,
+    help="Number of threads or processes decoding audio. (Default: 4)",
+    type=int,
+)
+@click.option(
+    "--decode-worker-type",
+    default="thread",
+    help="Decode audio in threads or (torch DataLoader) processes. (Default: thread)",
+    type=click.Choice(["thread", "process"]),
+)
+@click.option(
+    "--prefetch",
+    default=2,
+    help="Number of batches of audio to decode ahead of the model. (Default: 2)",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--pin-memory",
+    default=None,
+    help="Decode audio into pinned memory. (Default: True if a GPU is available)",
+    type=click.BOOL,
+)
+@click.option(
+    "--cpu-replicas",
+    default=0,
+    help="Compute embeddings on CPU in this many worker processes, each with its "
+    "own replica of the models, pinned to its own slice of cores. "
+    "(Default: 0, compute embeddings in the runner process)",
+    type=int,
+)
+@click.option(
+    "--threads-per-replica",
+    default=None,
+    help="Intra-op threads of each CPU replica. (Default: the number of cores "
+    "it is pinned to)",
+    type=int,
+)
+@click.option(
+    "--shard",
+    default=None,
+    help="Only compute the embeddings of shard i/n of the files of every split, "
+    "e.g. 0/4, into embeddings/MODULE.shard-i-of-n. Merge the shards with "
+    "heareval.embeddings.shards. (Default: all the files)",
+    type=str,
+)
+@click.option(
+    "--storage-dtype",
+    default="float32",
+    help="Store embeddings as float32, float16, bfloat16 or int8 (scaled per "
+    "dimension). Reduced precision is dequantized when embeddings are read "
+    "for downstream training. (Default: float32)",
+    type=click.Choice(["float32", "float16", "bfloat16", "int8"]),
+)
+@click.option(
+    "--window-seconds",
+    default=None,
+    help="For event tasks, compute the timestamp embeddings of longer audio in "
+    "windows of this many seconds, which bounds the model's memory for very "
+    "long files. Should be a multiple of the model's hop size. "
+    "(Default: whole files)",
+    type=float,
+)
+@click.option(
+    "--window-overlap",
+    default=1.0,
+    help="Seconds of overlap between windows. Each window's timestamps "
+    "closest to its edges are replaced by those of its neighbours. (Default: 1)",
+    type=float,
+)
+@click.option(
+    "--precision",
+    default="float32",
+    help="Run torch models under autocast to float16 (GPU only) or bfloat16. "
+    "Embeddings are written to MODULE-precision=PRECISION. (Default: float32)",
+    type=click.Choice(["float32", "float16", "bfloat16"]),
+)
+@click.option(
+    "--precision-tolerance",
+    default=0.02,
+    help="With reduced --precision, stop if the RMS error of a few clips' "
+    "embeddings, relative to float32, is more than this. (Default: 0.02)",
+    type=float,
+)
+@click.option(
+    "--sample-interval",
+    default=1.0,
+    help="Seconds between samples of GPU memory, RSS, CPU and I/O, saved in "
+    "resources.embeddings.json for each task. 0 to not sample. (Default: 1)",
+    type=float,
+)
+@click.option(
+    "--tf-function/--no-tf-function",
+    default=True,
+    help="Run tensorflow models through tf.function, or eagerly. Models that "
+    "fail with tf.function are run eagerly anyway. (Default: tf.function)",
 )
 def runner(
-    module: str,
-    model: str = None,
+    modules: Tuple[str, ...],
+    model: Tuple[str, ...] = (),
     tasks_dir: str = "tasks",
     task: str = "tasks",
     embeddings_dir: str = "embeddings",
-    model_options: str = "{}",
+    model_options: Tuple[str, ...] = (),
+    cache_dir: str = None,
+    cache_size: float = 100.0,
+    batch_size: int = None,
+    memory_fraction: float = 0.8,
+    max_padding: float = 0.1,
+    decode_workers: int = 4,
+    decode_worker_type: str = "thread",
+    prefetch: int = 2,
+    pin_memory: bool = None,
+    cpu_replicas: int = 0,
+    threads_per_replica: int = None,
+    shard: str = None,
+    storage_dtype: str = "float32",
+    window_seconds: float = None,
+    window_overlap: float = 1.0,
+    precision: str = "float32",
+    precision_tolerance: float = 0.02,
+    sample_interval: float = 1.0,
+    tf_function: bool = True,
 ) -> None:
-    model_options_dict = json.loads(model_options)
-    if isinstance(model_options_dict, dict):
-        if model_options_dict:
-            options_str = "-" + "-".join(
-                [
-                    "%s=%s" % (slugify(k), slugify(str(v)))
-                    for k, v in model_options_dict.items()
-                ]
-            )
-        else:
-            options_str = ""
-    else:
-        raise ValueError("model_options should be a JSON dict")
+    model_paths, model_options_dicts = parse_models(modules, model, model_options)
 
     # Check for directory containing the tasks
-    tasks_dir_path = Path(tasks_dir)
     embeddings_dir_path = Path(embeddings_dir)
     print(embeddings_dir_path)
-    if not tasks_dir_path.is_dir():
-        raise ValueError(
-            "Cannot locate directory containing tasks. "
-            f"Ensure that directory named {tasks_dir_path} exists or specify a folder "
-            f"containing HEAR tasks using the argument --tasks-dir"
-        )
-
-    # Load the embedding model
-    embedding = Embedding(module, model, model_options_dict)
-
-    if task == "all":
-        tasks = list(tasks_dir_path.iterdir())
-    else:
-        tasks = [tasks_dir_path.joinpath(task)]
-        assert os.path.exists(tasks[0]), f"{tasks[0]} does not exist"
-    for task_path in tqdm(tasks):
-        # TODO: Would be good to include the version here
-        # https://github.com/hearbenchmark/hear2021-eval-kit/issues/37
-        embed_dir = embeddings_dir_path.joinpath(embedding.name + options_str)
+    tasks, archive = find_tasks(Path(tasks_dir), task)
 
-        task_name = task_path.name
-        embed_task_dir = embed_dir.joinpath(task_name)
+    shard_nshards = None
+    if shard is not None:
+        from heareval.embeddings.shards import parse_shard
 
-        done_embeddings = embed_task_dir.joinpath(".done.embeddings")
-        if os.path.exists(done_embeddings):
-            continue
+        shard_nshards = parse_shard(shard)
+    embed_dirs = model_embed_dirs(
+        embeddings_dir_path,
+        modules,
+        model_options_dicts,
+        precision,
+        shard_nshards,
+    )
 
-        if os.path.exists(embed_task_dir):
-            shutil.rmtree(embed_task_dir)
+    tasks = [
+        task_path
+        for task_path in tasks
+        if not all(is_done(embed_dir, task_path) for embed_dir in embed_dirs)
+    ]
+    if not tasks:
+        print("Embeddings for every task are already in:")
+        for embed_dir in embed_dirs:
+            print(f"    {embed_dir}")
+        return
 
-        start = time.time()
-        gpu_max_mem.reset()
-
-        task_embeddings(embedding, task_path, embed_task_dir)
-
-        time_elapsed = time.time() - start
-        gpu_max_mem_used = gpu_max_mem.measure()
-        print(
-            f"...computed embeddings in {time_elapsed} sec "
-            f"(GPU max mem {gpu_max_mem_used}) "
-            f"for {task_path.name} using {module} {model_options}"
+    loaded = LoadedModels(
+        modules,
+        model_paths,
+        model_options_dicts,
+        [embed_dir.name for embed_dir in embed_dirs],
+        precision,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        cpu_replicas=cpu_replicas,
+        threads_per_replica=threads_per_replica,
+        tf_function=tf_function,
+    )
+    try:
+        embed_tasks(
+            loaded,
+            tasks,
+            embed_dirs,
+            archive,
+            batch_size=batch_size,
+            memory_fraction=memory_fraction,
+            max_padding=max_padding,
+            decode_workers=decode_workers,
+            decode_worker_type=decode_worker_type,
+            prefetch=prefetch,
+            pin_memory=pin_memory,
+            shard=shard_nshards,
+            storage_dtype=storage_dtype,
+            window_seconds=window_seconds,
+            window_overlap=window_overlap,
+            precision_tolerance=precision_tolerance,
+            sample_interval=sample_interval,
         )
-        open(embed_task_dir.joinpath("profile.embeddings.json"), "wt").write(
-            json.dumps(
-                {
-                    "time_elapsed": time_elapsed,
-                    "gpu_max_mem": gpu_max_mem_used,
-                    "gpu_device_name": gpu_max_mem.device_name(),
-                },
-                indent=4,
-            )
-        )
-
-        # Touch this file to indicate that processing completed successfully
-        open(done_embeddings, "wt")
+    finally:
+        loaded.close()
 
 
 if __name__ == "__main__":
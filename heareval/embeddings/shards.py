@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Merge the embeddings of a model computed in shards, e.g. on several
+machines, with:
+
+    python3 -m heareval.embeddings.runner MODULE --shard 0/4 ...
+
+which writes the unshuffled embeddings of the first of 4 shards of every
+split to embeddings/MODULE.shard-0-of-4/TASK. Once the shard directories
+of every shard are in the same embeddings directory:
+
+    python3 -m heareval.embeddings.shards embeddings/MODULE --shards 4
+
+writes the embeddings of each task to embeddings/MODULE/TASK, in the same
+order as if they were computed in one run: the files of every split are
+shuffled in the same seed 0 order. The embeddings themselves can differ
+slightly from those of one run, as files are batched differently in each
+shard: by float rounding, and for tasks with audio of different lengths,
+by the padding of each batch (see heareval.embeddings.bucketing). Once
+every task is merged, the shard directories are removed.
+
+torch and the task_embeddings module are only imported once there is a
+task to merge.
+"""
+
+import json
+import random
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as "i/n", the i-th (counting from 0) of n shards.
+    """
+    try:
+        i, n = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard should be given as i/n, not {shard}")
+    if not 0 <= i < n:
+        raise ValueError(f"Shard {i} is not one of {n} shards")
+    return i, n
+
+
+def shard_embed_dir(embed_dir: Path, shard: int, nshards: int) -> Path:
+    """
+    The embeddings directory of a model's shard, next to the model's own
+    embeddings directory.
+    """
+    return embed_dir.parent.joinpath(f"{embed_dir.name}.shard-{shard}-of-{nshards}")
+
+
+class _ShardRows:
+    """
+    The unshuffled embeddings memmaps of every shard, indexed as if they
+    were concatenated.
+    """
+
+    def __init__(self, memmaps: List[Optional[np.memmap]], ndim: int):
+        self.memmaps = memmaps
+        self.ndim = ndim
+
+    def __getitem__(self, rows: np.ndarray) -> np.ndarray:
+        embeddings = np.empty((len(rows), self.ndim), dtype=np.float32)
+        first_row = 0
+        for memmap in self.memmaps:
+            if memmap is None:
+                continue
+            in_shard = (rows >= first_row) & (rows < first_row + len(memmap))
+            embeddings[in_shard] = memmap[rows[in_shard] - first_row]
+            first_row += len(memmap)
+        return embeddings
+
+
+class ShardedSplitEmbeddings:
+    """
+    The unshuffled embeddings of one split, from the writers of every shard,
+    combined so they can be shuffled by memmap_embeddings like those of a
+    single SplitEmbeddingWriter.
+
+    Args:
+        shard_task_dirs: the task's embeddings directory of every shard
+        split_name: name of the split, e.g. "train"
+        embedding_type: "scene" or "event"
+    """
+
+    def __init__(
+        self, shard_task_dirs: List[Path], split_name: str, embedding_type: str
+    ):
+        from heareval.embeddings.task_embeddings import SplitEmbeddingWriter
+
+        self.writers = []
+        for shard_task_dir in shard_task_dirs:
+            writer = SplitEmbeddingWriter(shard_task_dir, split_name, embedding_type)
+            writer.close()
+            self.writers.append(writer)
+
+        self.ndim: Optional[int] = None
+        self.nembeddings = 0
+        self.rows: Dict[str, Tuple[int, int]] = {}
+        self.labels: Dict[str, List] = {}
+        self.timestamps: Dict[str, List[float]] = {}
+        for writer in self.writers:
+            if writer.ndim is not None:
+                if self.ndim is None:
+                    self.ndim = writer.ndim
+                assert writer.ndim == self.ndim
+            for filename, (first_row, nrows) in writer.rows.items():
+                assert filename not in self.rows, f"{filename} is in several shards"
+                self.rows[filename] = (self.nembeddings + first_row, nrows)
+            self.labels.update(writer.labels)
+            self.timestamps.update(writer.timestamps)
+            self.nembeddings += writer.nembeddings
+
+    def memmap(self) -> _ShardRows:
+        assert self.ndim is not None, "No embeddings were written"
+        return _ShardRows(
+            [
+                writer.memmap() if writer.ndim is not None else None
+                for writer in self.writers
+            ],
+            self.ndim,
+        )
+
+    def delete(self):
+        for writer in self.writers:
+            writer.delete()
+
+
+def merge_task_shards(
+    embed_task_dir: Path, shard_task_dirs: List[Path], storage_dtype: str = "float32"
+):
+    """
+    Merge the embeddings of every split of a task from the directories of
+    every shard into embed_task_dir, shuffled as by task_embeddings, and
+    stored as storage_dtype.
+    """
+    from heareval.embeddings.task_embeddings import memmap_embeddings
+
+    for shard_task_dir in shard_task_dirs:
+        if not shard_task_dir.joinpath(".done.embeddings").exists():
+            raise ValueError(f"Shard {shard_task_dir} has not finished")
+
+    embed_task_dir.mkdir(parents=True, exist_ok=True)
+    for filename in ["task_metadata.json", "labelvocabulary.csv"]:
+        shutil.copy(shard_task_dirs[0].joinpath(filename), embed_task_dir)
+    metadata = json.load(embed_task_dir.joinpath("task_metadata.json").open())
+
+    # As in task_embeddings, one prng shuffles every split in turn
+    prng = random.Random()
+    prng.seed(0)
+    for split in metadata["splits"]:
+        print(f"Merging embeddings for split: {split}")
+        shutil.copy(shard_task_dirs[0].joinpath(f"{split}.json"), embed_task_dir)
+        split_data = json.load(embed_task_dir.joinpath(f"{split}.json").open())
+        done_split = embed_task_dir.joinpath(f".done.{split}.embeddings")
+        if done_split.exists():
+            prng.shuffle(list(split_data.keys()))
+            continue
+        sharded = ShardedSplitEmbeddings(
+            shard_task_dirs, split, metadata["embedding_type"]
+        )
+        memmap_embeddings(
+            sharded,  # type: ignore
+            prng,
+            metadata,
+            split,
+            embed_task_dir,
+            split_data,
+            storage_dtype=storage_dtype,
+        )
+        open(done_split, "wt")
+
+    # The time of the shards together, and the memory of the largest
+    profiles: List[Dict[str, Any]] = [
+        json.load(shard_task_dir.joinpath("profile.embeddings.json").open())
+        for shard_task_dir in shard_task_dirs
+    ]
+    gpu_max_mems = [
+        profile["gpu_max_mem"]
+        for profile in profiles
+        if profile["gpu_max_mem"] is not None
+    ]
+    open(embed_task_dir.joinpath("profile.embeddings.json"), "wt").write(
+        json.dumps(
+            {
+                "time_elapsed": sum(profile["time_elapsed"] for profile in profiles),
+                "gpu_max_mem": max(gpu_max_mems) if gpu_max_mems else None,
+                "gpu_device_name": profiles[0]["gpu_device_name"],
+                "shards": profiles,
+            },
+            indent=4,
+        )
+    )
+    open(embed_task_dir.joinpath(".done.embeddings"), "wt")
+    for shard_task_dir in shard_task_dirs:
+        shutil.rmtree(shard_task_dir)
+
+
+@click.command()
+@click.argument("embed_dir", type=str)
+@click.option(
+    "--shards",
+    required=True,
+    help="Number of shards the embeddings were computed in",
+    type=int,
+)
+@click.option(
+    "--task",
+    default="all",
+    help="Task to merge. (Default: all)",
+    type=str,
+)
+@click.option(
+    "--storage-dtype",
+    default="float32",
+    help="Store the merged embeddings as float32, float16, bfloat16 or int8. "
+    "(Default: float32)",
+    type=click.Choice(["float32", "float16", "bfloat16", "int8"]),
+)
+def main(
+    embed_dir: str, shards: int, task: str = "all", storage_dtype: str = "float32"
+):
+    embed_dir_path = Path(embed_dir)
+    shard_dirs = [shard_embed_dir(embed_dir_path, i, shards) for i in range(shards)]
+    for shard_dir in shard_dirs:
+        if not shard_dir.is_dir():
+            raise ValueError(f"Cannot find the embeddings of shard {shard_dir}")
+
+    tasks = sorted(
+        task_dir.name
+        for task_dir in shard_dirs[0].iterdir()
+        if task_dir.is_dir() and (task == "all" or task_dir.name == task)
+    )
+    assert tasks, f"{task} is not in {shard_dirs[0]}"
+    for task_name in tqdm(tasks):
+        embed_task_dir = embed_dir_path.joinpath(task_name)
+        if embed_task_dir.joinpath(".done.embeddings").exists():
+            print(f"...skipping {task_name}, which is already merged")
+            continue
+        merge_task_shards(
+            embed_task_dir,
+            [shard_dir.joinpath(task_name) for shard_dir in shard_dirs],
+            storage_dtype,
+        )
+        print(f"...merged {shards} shards of {task_name} into {embed_task_dir}")
+
+    for shard_dir in shard_dirs:
+        # Once no task is left in it, only e.g. its batch size cache is
+        if not any(path.is_dir() for path in shard_dir.iterdir()):
+            shutil.rmtree(shard_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Compact, memory-mappable labels and frame metadata of a split's embeddings.
+
+The labels of every row of {split}.embeddings.npy are stored in CSR form:
+    * {split}.label-names.json: every distinct label, in order of first
+      appearance
+    * {split}.label-offsets.npy: int64, the labels of row i are
+      label-ids[label-offsets[i]:label-offsets[i + 1]]
+    * {split}.label-ids.npy: int32, indices into label-names
+
+For event embeddings, the file and timestamp of every row are stored as:
+    * {split}.filenames.json: the slug of every file, see memmap_embeddings
+    * {split}.file-ids.npy: int32, the index of each row's file in filenames
+    * {split}.timestamps.npy: float32, each row's timestamp in milliseconds
+
+These replace {split}.target-labels.pkl and {split}.filename-timestamps.json,
+which for event tasks have a list and a JSON pair for every frame.
+load_labels and load_filename_timestamps also read embeddings written in
+that format.
+"""
+
+import json
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+
+class SplitLabels:
+    """
+    The list of labels of every row of a split, in CSR form.
+
+    Args:
+        names: every distinct label
+        offsets: the labels of row i are ids[offsets[i]:offsets[i + 1]]
+        ids: indices into names
+    """
+
+    def __init__(self, names: List[Any], offsets: np.ndarray, ids: np.ndarray):
+        assert offsets[0] == 0 and offsets[-1] == len(ids)
+        self.names = names
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def from_lists(cls, labels: Sequence[Sequence[Any]]) -> "SplitLabels":
+        name_to_id: Dict[Any, int] = {}
+        names: List[Any] = []
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        ids = []
+        for i, row_labels in enumerate(labels):
+            for label in row_labels:
+                # Labels are compared as strings downstream, but keep their type
+                key = (type(label).__name__, label)
+                if key not in name_to_id:
+                    name_to_id[key] = len(names)
+                    names.append(label)
+                ids.append(name_to_id[key])
+            offsets[i + 1] = len(ids)
+        return cls(names, offsets, np.array(ids, dtype=np.int32))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> List[Any]:
+        return [
+            self.names[i] for i in self.ids[self.offsets[idx] : self.offsets[idx + 1]]
+        ]
+
+    def __iter__(self) -> Iterator[List[Any]]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def rows(self) -> np.ndarray:
+        """
+        The row of every label id.
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def save(self, embed_task_dir: Path, split_name: str):
+        open(embed_task_dir.joinpath(f"{split_name}.label-names.json"), "wt").write(
+            json.dumps(self.names)
+        )
+        np.save(
+            embed_task_dir.joinpath(f"{split_name}.label-offsets.npy"), self.offsets
+        )
+        np.save(embed_task_dir.joinpath(f"{split_name}.label-ids.npy"), self.ids)
+
+
+class FrameMetadata:
+    """
+    The file and timestamp of every row of a split's event embeddings.
+
+    Args:
+        filenames: the slug of every file
+        file_ids: the index in filenames of every row's file
+        timestamps: every row's timestamp in milliseconds, saved as float32
+    """
+
+    def __init__(
+        self, filenames: List[str], file_ids: np.ndarray, timestamps: np.ndarray
+    ):
+        assert len(file_ids) == len(timestamps)
+        self.filenames = filenames
+        self.file_ids = file_ids
+        self.timestamps = timestamps
+
+    @classmethod
+    def from_pairs(
+        cls, filename_timestamps: Sequence[Tuple[str, float]]
+    ) -> "FrameMetadata":
+        """
+        From the (filename, timestamp) of every row. The timestamps are kept
+        in float64, as they were given.
+        """
+        filename_to_id: Dict[str, int] = {}
+        file_ids = np.empty(len(filename_timestamps), dtype=np.int32)
+        for i, (filename, _) in enumerate(filename_timestamps):
+            file_ids[i] = filename_to_id.setdefault(filename, len(filename_to_id))
+        return cls(
+            list(filename_to_id.keys()),
+            file_ids,
+            np.array(
+                [timestamp for _, timestamp in filename_timestamps], dtype=np.float64
+            ),
+        )
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    def __getitem__(self, idx: int) -> Tuple[str, float]:
+        return self.filenames[self.file_ids[idx]], float(self.timestamps[idx])
+
+    def __iter__(self) -> Iterator[Tuple[str, float]]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def save(self, embed_task_dir: Path, split_name: str):
+        open(embed_task_dir.joinpath(f"{split_name}.filenames.json"), "wt").write(
+            json.dumps(self.filenames)
+        )
+        np.save(embed_task_dir.joinpath(f"{split_name}.file-ids.npy"), self.file_ids)
+        np.save(
+            embed_task_dir.joinpath(f"{split_name}.timestamps.npy"),
+            np.asarray(self.timestamps, dtype=np.float32),
+        )
+
+
+def load_labels(embed_task_dir: Path, split_name: str) -> SplitLabels:
+    """
+    The labels of every row of a split, memory-mapped, or converted from
+    the {split}.target-labels.pkl of older embeddings.
+    """
+    names_path = embed_task_dir.joinpath(f"{split_name}.label-names.json")
+    if not names_path.exists():
+        return SplitLabels.from_lists(
+            pickle.load(
+                open(embed_task_dir.joinpath(f"{split_name}.target-labels.pkl"), "rb")
+            )
+        )
+    return SplitLabels(
+        json.load(names_path.open()),
+        np.load(
+            embed_task_dir.joinpath(f"{split_name}.label-offsets.npy"), mmap_mode="r"
+        ),
+        np.load(embed_task_dir.joinpath(f"{split_name}.label-ids.npy"), mmap_mode="r"),
+    )
+
+
+def load_filename_timestamps(embed_task_dir: Path, split_name: str) -> FrameMetadata:
+    """
+    The file and timestamp of every row of a split's event embeddings,
+    memory-mapped, or converted from the {split}.filename-timestamps.json
+    of older embeddings.
+    """
+    filenames_path = embed_task_dir.joinpath(f"{split_name}.filenames.json")
+    if not filenames_path.exists():
+        return FrameMetadata.from_pairs(
+            json.load(
+                embed_task_dir.joinpath(f"{split_name}.filename-timestamps.json").open()
+            )
+        )
+    return FrameMetadata(
+        json.load(filenames_path.open()),
+        np.load(embed_task_dir.joinpath(f"{split_name}.file-ids.npy"), mmap_mode="r"),
+        np.load(embed_task_dir.joinpath(f"{split_name}.timestamps.npy"), mmap_mode="r"),
+    )
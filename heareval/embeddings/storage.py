@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Reduced-precision storage of embeddings.
+
+By default, {split}.embeddings.npy is a float32 memmap. Embeddings can
+instead be stored as:
+    * float16
+    * bfloat16, stored as the upper 16 bits of the float32 (uint16)
+    * int8, scaled and offset per dimension to the range of the split's
+      embeddings in that dimension
+
+which halves (or quarters) the disk space, and the memory of downstream
+training with --in-memory. The storage dtype, and for int8 the scale
+and offset of every dimension, are then in {split}.embedding-storage.json.
+Without it, the embeddings are float32.
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+STORAGE_DTYPES = ["float32", "float16", "bfloat16", "int8"]
+
+# How each storage dtype is stored in the memmap
+NUMPY_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.uint16,
+    "int8": np.int8,
+}
+
+INT8_MAX = 127
+
+
+class EmbeddingStorage:
+    """
+    Encodes float32 embeddings to their storage dtype, and decodes them back.
+
+    While encoding, the error of the stored embeddings is accumulated, see
+    error_summary().
+
+    Args:
+        dtype: one of STORAGE_DTYPES
+        scale: for int8, the size of one step in every dimension
+        offset: for int8, the value of 0 in every dimension
+    """
+
+    def __init__(
+        self,
+        dtype: str = "float32",
+        scale: Optional[np.ndarray] = None,
+        offset: Optional[np.ndarray] = None,
+    ):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype: {dtype}")
+        if dtype == "int8":
+            assert scale is not None and offset is not None
+        self.dtype = dtype
+        self.numpy_dtype = NUMPY_DTYPES[dtype]
+        self.scale = scale
+        self.offset = offset
+        self.max_abs_error = 0.0
+        self.squared_error = 0.0
+        self.squared_value = 0.0
+
+    @classmethod
+    def fit(cls, dtype: str, chunks: Iterable[np.ndarray]) -> "EmbeddingStorage":
+        """
+        The storage of embeddings given in chunks of rows. For int8, the
+        range of every dimension is scaled to the range of int8.
+        """
+        if dtype != "int8":
+            return cls(dtype)
+        low: Optional[np.ndarray] = None
+        high: Optional[np.ndarray] = None
+        for chunk in chunks:
+            if low is None or high is None:
+                low, high = chunk.min(axis=0), chunk.max(axis=0)
+            else:
+                low = np.minimum(low, chunk.min(axis=0))
+                high = np.maximum(high, chunk.max(axis=0))
+        assert low is not None and high is not None, "No embeddings to fit"
+        offset = ((low.astype(np.float64) + high) / 2).astype(np.float32)
+        scale = ((high.astype(np.float64) - low) / (2 * INT8_MAX)).astype(np.float32)
+        # Constant dimensions are stored exactly as their offset
+        scale[scale == 0] = 1.0
+        return cls(dtype, scale, offset)
+
+    @classmethod
+    def load(cls, embedding_path: Path, split_name: str) -> "EmbeddingStorage":
+        """
+        The storage of a split's embeddings, float32 if it has no
+        {split}.embedding-storage.json.
+        """
+        storage_path = embedding_path.joinpath(f"{split_name}.embedding-storage.json")
+        if not storage_path.exists():
+            return cls()
+        return cls.from_json(json.load(storage_path.open()))
+
+    @classmethod
+    def from_json(cls, storage: Dict[str, Any]) -> "EmbeddingStorage":
+        if storage["dtype"] == "int8":
+            return cls(
+                storage["dtype"],
+                np.array(storage["scale"], dtype=np.float32),
+                np.array(storage["offset"], dtype=np.float32),
+            )
+        return cls(storage["dtype"])
+
+    def to_json(self) -> Dict[str, Any]:
+        storage: Dict[str, Any] = {"dtype": self.dtype}
+        if self.dtype != "float32":
+            storage.update(self.errors())
+        if self.dtype == "int8":
+            assert self.scale is not None and self.offset is not None
+            storage["scale"] = self.scale.tolist()
+            storage["offset"] = self.offset.tolist()
+        return storage
+
+    def save(self, embedding_path: Path, split_name: str):
+        """
+        Write {split}.embedding-storage.json, unless the embeddings are
+        stored as float32.
+        """
+        if self.dtype == "float32":
+            return
+        open(
+            embedding_path.joinpath(f"{split_name}.embedding-storage.json"), "wt"
+        ).write(json.dumps(self.to_json()))
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.dtype == "float32":
+            return embeddings
+        elif self.dtype == "float16":
+            stored = embeddings.astype(np.float16)
+            if not np.isfinite(stored).all():
+                raise ValueError(
+                    "Embeddings overflow float16, store them as bfloat16 or int8"
+                )
+        elif self.dtype == "bfloat16":
+            # Round to nearest, ties to even, then keep the upper 16 bits
+            bits = embeddings.view(np.uint32)
+            rounded = bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+            stored = (rounded >> 16).astype(np.uint16)
+        elif self.dtype == "int8":
+            stored = np.clip(
+                np.rint((embeddings - self.offset) / self.scale), -INT8_MAX, INT8_MAX
+            ).astype(np.int8)
+        else:
+            raise ValueError(f"Unknown storage dtype: {self.dtype}")
+
+        error = self.decode(stored).astype(np.float64) - embeddings
+        if error.size:
+            self.max_abs_error = max(self.max_abs_error, float(np.abs(error).max()))
+        self.squared_error += float(np.square(error).sum())
+        self.squared_value += float(np.square(embeddings, dtype=np.float64).sum())
+        return stored
+
+    def decode(self, stored: np.ndarray) -> np.ndarray:
+        """
+        The float32 embeddings of stored rows.
+        """
+        if self.dtype == "float32":
+            return stored
+        elif self.dtype == "float16":
+            return stored.astype(np.float32)
+        elif self.dtype == "bfloat16":
+            return (stored.astype(np.uint32) << 16).view(np.float32)
+        elif self.dtype == "int8":
+            return stored.astype(np.float32) * self.scale + self.offset
+        else:
+            raise ValueError(f"Unknown storage dtype: {self.dtype}")
+
+    def errors(self) -> Dict[str, float]:
+        """
+        The largest absolute error, and the RMS error relative to the RMS
+        of the embeddings, of everything encoded so far.
+        """
+        relative_rms_error = 0.0
+        if self.squared_value > 0:
+            relative_rms_error = float(np.sqrt(self.squared_error / self.squared_value))
+        return {
+            "max_abs_error": self.max_abs_error,
+            "relative_rms_error": relative_rms_error,
+        }
+
+    def error_summary(self) -> str:
+        errors = self.errors()
+        return (
+            f"Stored as {self.dtype}, max absolute error "
+            f"{errors['max_abs_error']:.3g}, relative RMS error "
+            f"{errors['relative_rms_error']:.3g}"
+        )
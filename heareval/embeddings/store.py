@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+A chunked, optionally compressed, single-file store of the embeddings
+of a split, {split}.embeddings.store, indexed by filename.
+
+{split}.embeddings.npy is raw rows with no header: its shape is in
+{split}.embedding-dimensions.json, and the rows of a file can only be
+found by replaying the file of every row (see
+heareval.embeddings.sidecars). A store instead
+holds, in one file:
+    * the rows, in chunks of chunk_rows rows, each compressed with zlib
+      or stored raw
+    * a footer with the shape, the storage dtype (see
+      heareval.embeddings.storage), the byte range of every chunk and
+      the row range of every file
+
+Chunks are compressed and decompressed in parallel threads (zlib
+releases the GIL). Rows can be read by file, by row range, or in
+sequential batches.
+
+Existing embeddings directories are converted with:
+
+    python3 -m heareval.embeddings.store embeddings/MODULE_NAME/*
+
+after which SplitMemmapDataset reads the store instead of the memmap.
+"""
+
+import json
+import os
+import random
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+from heareval.embeddings.sidecars import load_filename_timestamps
+from heareval.embeddings.storage import EmbeddingStorage
+
+MAGIC = b"HEAREMB1"
+# The footer's offset and the magic again, at the end of the file
+TRAILER = struct.Struct("<Q8s")
+COMPRESSIONS = ["zlib", "none"]
+# Default chunk size, before compression
+CHUNK_BYTES = 1 << 20
+
+
+def store_path(embed_task_dir: Path, split_name: str) -> Path:
+    return embed_task_dir.joinpath(f"{split_name}.embeddings.store")
+
+
+def write_store(
+    path: Path,
+    embeddings: np.ndarray,
+    files: Dict[str, Tuple[int, int]],
+    storage: Optional[EmbeddingStorage] = None,
+    compression: str = "zlib",
+    level: int = 1,
+    chunk_rows: Optional[int] = None,
+    workers: int = 4,
+):
+    """
+    Write a store of embeddings, rows already in their storage dtype
+    (e.g. a memmap), where files maps each filename to its (first row,
+    number of rows).
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if storage is None:
+        storage = EmbeddingStorage()
+    assert embeddings.ndim == 2
+    assert embeddings.dtype == storage.numpy_dtype
+    nrows, ndim = embeddings.shape
+    if chunk_rows is None:
+        chunk_rows = max(1, CHUNK_BYTES // max(1, ndim * embeddings.itemsize))
+
+    def encode(start: int) -> bytes:
+        chunk = np.ascontiguousarray(embeddings[start : start + chunk_rows])
+        if compression == "zlib":
+            return zlib.compress(chunk.tobytes(), level)
+        return chunk.tobytes()
+
+    chunks: List[Tuple[int, int]] = []
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp, ThreadPoolExecutor(workers) as executor:
+        fp.write(MAGIC)
+        starts = list(range(0, nrows, chunk_rows))
+        # Compress a window of chunks at a time, to bound the memory used
+        window = 2 * workers
+        for i in tqdm(range(0, len(starts), window)):
+            for data in executor.map(encode, starts[i : i + window]):
+                chunks.append((fp.tell(), len(data)))
+                fp.write(data)
+        footer = {
+            "shape": [nrows, ndim],
+            "storage": storage.to_json(),
+            "compression": compression,
+            "chunk_rows": chunk_rows,
+            "chunks": chunks,
+            "files": files,
+        }
+        footer_offset = fp.tell()
+        fp.write(json.dumps(footer).encode("utf-8"))
+        fp.write(TRAILER.pack(footer_offset, MAGIC))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore:
+    """
+    Reads a store written by write_store(). Rows are returned in their
+    storage dtype, see self.storage to dequantize them.
+
+    Indexing a row, as SplitMemmapDataset does, decompresses its chunk,
+    and keeps the last chunk decompressed for the rows that follow.
+
+    Args:
+        path: the store's file
+        workers: number of threads decompressing chunks
+    """
+
+    def __init__(self, path: Path, workers: int = 4):
+        self.path = path
+        self.workers = workers
+        self.fp = open(path, "rb")
+        self.lock = threading.Lock()
+        if self.fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an embeddings store")
+        self.fp.seek(-TRAILER.size, os.SEEK_END)
+        footer_end = self.fp.tell()
+        footer_offset, magic = TRAILER.unpack(self.fp.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated")
+        self.fp.seek(footer_offset)
+        footer = json.loads(self.fp.read(footer_end - footer_offset))
+
+        self.shape: Tuple[int, int] = tuple(footer["shape"])  # type: ignore
+        self.storage = EmbeddingStorage.from_json(footer["storage"])
+        self.dtype = np.dtype(self.storage.numpy_dtype)
+        self.compression: str = footer["compression"]
+        self.chunk_rows: int = footer["chunk_rows"]
+        self.chunks: List[Tuple[int, int]] = [tuple(c) for c in footer["chunks"]]
+        self.files: Dict[str, Tuple[int, int]] = {
+            filename: tuple(rows) for filename, rows in footer["files"].items()
+        }
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._last_chunk: Tuple[int, Optional[np.ndarray]] = (-1, None)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # DataLoader worker processes reopen the file
+        state = self.__dict__.copy()
+        for unpicklable in ["fp", "lock", "executor"]:
+            del state[unpicklable]
+        state["_last_chunk"] = (-1, None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.fp = open(self.path, "rb")
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _chunk(self, i: int) -> np.ndarray:
+        offset, nbytes = self.chunks[i]
+        with self.lock:
+            self.fp.seek(offset)
+            data = self.fp.read(nbytes)
+        if self.compression == "zlib":
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(-1, self.shape[1])
+
+    def _map_chunks(self, chunk_ids: List[int]) -> Iterator[np.ndarray]:
+        """
+        The decompressed chunks, in order. Chunks are decompressed in
+        parallel, a window of a few chunks at a time so that the chunks
+        waiting to be used are bounded.
+        """
+        if self.workers <= 1 or len(chunk_ids) <= 1:
+            yield from map(self._chunk, chunk_ids)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+        window = 2 * self.workers
+        for i in range(0, len(chunk_ids), window):
+            yield from self.executor.map(self._chunk, chunk_ids[i : i + window])
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Row {idx} is out of range")
+        chunk_id = idx // self.chunk_rows
+        last_id, chunk = self._last_chunk
+        if last_id != chunk_id or chunk is None:
+            chunk = self._chunk(chunk_id)
+            self._last_chunk = (chunk_id, chunk)
+        return chunk[idx - chunk_id * self.chunk_rows]
+
+    def read_rows(self, start: int, end: int) -> np.ndarray:
+        """
+        Rows start to end, decompressing their chunks in parallel.
+        """
+        end = min(end, len(self))
+        if start >= end:
+            return np.empty((0, self.shape[1]), dtype=self.dtype)
+        first_chunk = start // self.chunk_rows
+        last_chunk = (end - 1) // self.chunk_rows
+        # Fill the rows chunk by chunk, rather than holding every chunk and
+        # then concatenating them
+        rows = np.empty((end - start, self.shape[1]), dtype=self.dtype)
+        chunk_ids = list(range(first_chunk, last_chunk + 1))
+        for chunk_id, chunk in zip(chunk_ids, self._map_chunks(chunk_ids)):
+            chunk_start = chunk_id * self.chunk_rows
+            lo = max(start, chunk_start)
+            hi = min(end, chunk_start + len(chunk))
+            rows[lo - start : hi - start] = chunk[lo - chunk_start : hi - chunk_start]
+        return rows
+
+    def read_file(self, filename: str) -> np.ndarray:
+        """
+        The rows of one file of the split.
+        """
+        first_row, nrows = self.files[filename]
+        return self.read_rows(first_row, first_row + nrows)
+
+    def read_all(self) -> np.ndarray:
+        return self.read_rows(0, len(self))
+
+    def iter_batches(self, batch_rows: int) -> Iterator[np.ndarray]:
+        """
+        All the rows, in order, in batches of batch_rows. Chunks are
+        decompressed in parallel, a few ahead of the batch being read.
+        """
+        pending = np.empty((0, self.shape[1]), dtype=self.dtype)
+        for chunk in self._map_chunks(list(range(len(self.chunks)))):
+            pending = np.concatenate([pending, chunk])
+            while len(pending) >= batch_rows:
+                yield pending[:batch_rows]
+                pending = pending[batch_rows:]
+        if len(pending):
+            yield pending
+
+    def close(self):
+        self.fp.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def split_file_rows(
+    embed_task_dir: Path, split_name: str, metadata: Dict, prng: random.Random
+) -> Dict[str, Tuple[int, int]]:
+    """
+    The row range of every file of a split written by memmap_embeddings,
+    whose files are in the order the prng shuffles them (see
+    task_embeddings). The prng must have shuffled the previous splits.
+    """
+    split_data = json.load(embed_task_dir.joinpath(f"{split_name}.json").open())
+    filenames = list(split_data.keys())
+    prng.shuffle(filenames)
+    if metadata["embedding_type"] == "scene":
+        return {filename: (i, 1) for i, filename in enumerate(filenames)}
+
+    # Event embeddings have one row per timestamp, and the rows of each
+    # file are together.
+    frames = load_filename_timestamps(embed_task_dir, split_name)
+    file_ids = np.asarray(frames.file_ids)
+    counts = np.bincount(file_ids, minlength=len(frames.filenames))
+    name_to_id = {Path(slug).name: i for i, slug in enumerate(frames.filenames)}
+    files: Dict[str, Tuple[int, int]] = {}
+    first_row = 0
+    for filename in filenames:
+        nrows = int(counts[name_to_id[filename]]) if filename in name_to_id else 0
+        files[filename] = (first_row, nrows)
+        first_row += nrows
+    ordered_ids = [
+        name_to_id[filename] for filename in filenames if filename in name_to_id
+    ]
+    if not np.array_equal(file_ids, np.repeat(ordered_ids, counts[ordered_ids])):
+        raise ValueError(
+            f"The rows of {split_name} in {embed_task_dir} are not in the order "
+            "of the shuffled files"
+        )
+    return files
+
+
+def convert_task(
+    embed_task_dir: Path,
+    compression: str = "zlib",
+    level: int = 1,
+    chunk_rows: Optional[int] = None,
+    delete_memmap: bool = False,
+):
+    """
+    Write a store for every split of an embeddings directory, from its
+    {split}.embeddings.npy.
+    """
+    metadata = json.load(embed_task_dir.joinpath("task_metadata.json").open())
+    # As in task_embeddings, one prng shuffles every split in turn
+    prng = random.Random()
+    prng.seed(0)
+    for split in metadata["splits"]:
+        files = split_file_rows(embed_task_dir, split, metadata, prng)
+        memmap_path = embed_task_dir.joinpath(f"{split}.embeddings.npy")
+        if not memmap_path.exists():
+            print(f"...skipping {memmap_path}, which does not exist")
+            continue
+        storage = EmbeddingStorage.load(embed_task_dir, split)
+        dim = tuple(
+            json.load(
+                embed_task_dir.joinpath(f"{split}.embedding-dimensions.json").open()
+            )
+        )
+        embeddings = np.memmap(
+            filename=memmap_path, dtype=storage.numpy_dtype, mode="r", shape=dim
+        )
+        path = store_path(embed_task_dir, split)
+        write_store(path, embeddings, files, storage, compression, level, chunk_rows)
+        print(
+            f"...converted {memmap_path} ({os.path.getsize(memmap_path)} bytes) "
+            f"to {path} ({os.path.getsize(path)} bytes)"
+        )
+        del embeddings
+        if delete_memmap:
+            os.remove(memmap_path)
+
+
+@click.command()
+@click.argument("embed_task_dirs", nargs=-1, required=True)
+@click.option(
+    "--compression",
+    default="zlib",
+    help="Compression of each chunk. (Default: zlib)",
+    type=click.Choice(COMPRESSIONS),
+)
+@click.option(
+    "--level",
+    default=1,
+    help="zlib compression level, from 1 (fastest) to 9 (smallest). (Default: 1)",
+    type=int,
+)
+@click.option(
+    "--chunk-rows",
+    default=None,
+    help="Number of rows in each chunk. (Default: about 1MB of rows)",
+    type=int,
+)
+@click.option(
+    "--delete-memmap",
+    default=False,
+    help="Delete {split}.embeddings.npy once it is converted. (Default: False)",
+    type=click.BOOL,
+)
+def main(
+    embed_task_dirs: Tuple[str, ...],
+    compression: str = "zlib",
+    level: int = 1,
+    chunk_rows: Optional[int] = None,
+    delete_memmap: bool = False,
+):
+    for embed_task_dir in embed_task_dirs:
+        path = Path(embed_task_dir)
+        if not path.joinpath("task_metadata.json").exists():
+            print(f"...skipping {path}, which is not an embeddings directory")
+            continue
+        convert_task(path, compression, level, chunk_rows, delete_memmap)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Read tasks directly from the distributed hear-*.tar.gz (or .tar) archives,
+without extracting them.
+
+The first time an archive is opened, one pass over it builds an index of
+every member: its offset and size in the (decompressed) archive, and
+the number of samples of every WAV file. The index is saved next to the
+archive as <archive>.index.json, so later passes seek directly to each
+member instead of parsing the archive again.
+
+A gzipped archive can only be read forwards efficiently, so
+TarAudioDataset orders a split's files as they appear in the archive
+and reads ahead sequentially, keeping files that were read ahead until
+they are requested. Batches should therefore visit files roughly in
+dataset order, e.g. LengthBucketBatchSampler with window=READ_WINDOW.
+"""
+
+import gzip
+import io
+import json
+import os
+import tarfile
+import threading
+from pathlib import Path, PurePosixPath
+from typing import IO, Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz")
+
+# Number of consecutive files that length-bucketed batches of a gzipped
+# archive are drawn from, bounding how far the dataset reads ahead.
+READ_WINDOW = 256
+
+
+def is_task_archive(path: Path) -> bool:
+    return path.is_file() and path.name.endswith(ARCHIVE_SUFFIXES)
+
+
+class TaskArchive:
+    """
+    An indexed tar archive of HEAR tasks.
+
+    Args:
+        archive_path: the .tar, .tar.gz or .tgz archive
+        index_path: where to save the index. (Default: next to the archive)
+    """
+
+    def __init__(self, archive_path: Path, index_path: Optional[Path] = None):
+        self.archive_path = archive_path
+        if index_path is None:
+            index_path = archive_path.with_name(f"{archive_path.name}.index.json")
+        self.index_path = index_path
+        with open(archive_path, "rb") as fp:
+            self.compressed = fp.read(2) == b"\x1f\x8b"
+
+        stat = os.stat(archive_path)
+        index = None
+        if index_path.exists():
+            index = json.load(index_path.open())
+            if (index["size"], index["mtime"]) != (stat.st_size, stat.st_mtime):
+                print(f"{archive_path} changed since it was indexed")
+                index = None
+        if index is None:
+            index = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "members": self._build_index(),
+            }
+            tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(index))
+            os.replace(tmp_path, index_path)
+        # name -> (offset of data, size, number of samples for WAV files)
+        self.members: Dict[str, Tuple[int, int, Optional[int]]] = {
+            name: tuple(member) for name, member in index["members"].items()
+        }
+
+    def _build_index(self) -> Dict[str, Tuple[int, int, Optional[int]]]:
+        print(f"Indexing {self.archive_path}")
+        members = {}
+        # Stream mode, which reads the archive strictly sequentially
+        with tarfile.open(self.archive_path, "r|*") as tar:
+            for member in tqdm(tar):
+                if not member.isfile():
+                    continue
+                nframes = None
+                if member.name.endswith(".wav"):
+                    data = tar.extractfile(member).read()  # type: ignore
+                    nframes = sf.info(io.BytesIO(data)).frames
+                members[member.name] = (member.offset_data, member.size, nframes)
+        return members
+
+    def tasks(self) -> List[PurePosixPath]:
+        """
+        The directory of each task in the archive.
+        """
+        return sorted(
+            PurePosixPath(name).parent
+            for name in self.members
+            if PurePosixPath(name).name == "task_metadata.json"
+        )
+
+    def open(self) -> IO[bytes]:
+        if self.compressed:
+            return gzip.open(self.archive_path, "rb")  # type: ignore
+        return open(self.archive_path, "rb")
+
+    def read(self, name: str) -> bytes:
+        """
+        The contents of one member. Use TarAudioDataset to read many.
+        """
+        offset, size, _ = self.members[name]
+        with self.open() as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+
+class TarAudioDataset(Dataset):
+    """
+    Return audio and audio filenames from a split's directory in a task
+    archive, ordered as they are in the archive.
+    """
+
+    def __init__(
+        self,
+        data: Dict,
+        archive: TaskArchive,
+        audio_dir: PurePosixPath,
+        sample_rate: int,
+    ):
+        self.archive = archive
+        self.sample_rate = sample_rate
+        self.members = {
+            filename: str(audio_dir.joinpath(filename)) for filename in data
+        }
+        for member in self.members.values():
+            assert member in archive.members, f"{member} is not in the archive"
+        self.filenames = sorted(
+            data.keys(), key=lambda filename: archive.members[self.members[filename]][0]
+        )
+        self._init_reader()
+
+    def _init_reader(self):
+        self._lock = threading.Lock()
+        self._fp: Optional[IO[bytes]] = None
+        # Index of the next file to read ahead, and files read ahead of time
+        self._next = 0
+        self._read_ahead: Dict[int, bytes] = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for attr in ["_lock", "_fp", "_next", "_read_ahead"]:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_reader()
+
+    def _read_member(self, idx: int) -> bytes:
+        offset, size, _ = self.archive.members[self.members[self.filenames[idx]]]
+        if self._fp is None:
+            self._fp = self.archive.open()
+        # Seeking a gzip file forwards decompresses up to the offset. Seeking
+        # backwards restarts from the beginning of the archive.
+        self._fp.seek(offset)
+        return self._fp.read(size)
+
+    def _read(self, idx: int) -> bytes:
+        with self._lock:
+            if not self.archive.compressed:
+                return self._read_member(idx)
+            if idx not in self._read_ahead:
+                if idx < self._next:
+                    # Already read and returned, e.g. in a previous pass
+                    self._next = idx
+                while self._next <= idx:
+                    self._read_ahead[self._next] = self._read_member(self._next)
+                    self._next += 1
+            return self._read_ahead.pop(idx)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        audio, sr = sf.read(io.BytesIO(self._read(idx)), dtype=np.float32)
+        assert sr == self.sample_rate
+        return audio, self.filenames[idx]
+
+    def lengths(self) -> List[int]:
+        return [
+            self.archive.members[self.members[filename]][2]  # type: ignore
+            for filename in self.filenames
+        ]
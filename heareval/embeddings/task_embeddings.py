@@ -10,50 +10,99 @@ One benefit of this approach is that since all embeddings are cached
 as numpy arrays, the final training code can be pytorch-only,
 regardless of whether the embedding model is tensorflow based.
 
+Tensorflow models are run through tf.function, and their audio is
+decoded with tf.data, see heareval.embeddings.tf_inference.
+
 TODO:
     * Ideally, we would run this within a docker container, for
     security. https://github.com/hearbenchmark/hear2021-eval-kit/issues/51
-    * Profiling should occur here (both embedding time AFTER loading
-    to GPU, and complete wall time include disk writes).
-    * This is currently pytorch only.
-    https://github.com/hearbenchmark/hear2021-eval-kit/issues/52
-    Using the included get_audio_embedding_numpy, we could instead
-    have this work both for pytorch and tensorflow.
-    https://github.com/hearbenchmark/hear2021-eval-kit/issues/49
 """
+
 import json
 import os.path
-import pickle
 import random
 import shutil
+import sys
+import time
+from contextlib import ExitStack, nullcontext
+from functools import partial
 from importlib import import_module
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from pathlib import Path, PurePosixPath
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import soundfile as sf
-import tensorflow as tf
 import torch
-from intervaltree import IntervalTree
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
 # import wandb
 import heareval.gpu_max_mem as gpu_max_mem
+from heareval.embeddings.batch_size import split_on_oom, tuned_batch_size
+from heareval.embeddings.bucketing import (
+    LengthBucketBatchSampler,
+    audio_lengths,
+    pad_collate,
+    trim_timestamp_embeddings,
+)
+from heareval.embeddings.cache import EmbeddingCache
+from heareval.embeddings.decoding import (
+    PROCESS,
+    THREAD,
+    LoaderTimer,
+    decoding_dataloader,
+)
+from heareval.embeddings.packed_audio import PackedAudioDataset, has_packed_audio
+from heareval.embeddings.pipeline import BackgroundStage
+from heareval.embeddings.profiling import StageTimer
+from heareval.embeddings.replicas import ReplicaEmbedding, ReplicaPool
+from heareval.embeddings.sidecars import FrameMetadata, SplitLabels
+from heareval.embeddings.storage import STORAGE_DTYPES, EmbeddingStorage
+from heareval.embeddings.tar_audio import READ_WINDOW, TarAudioDataset, TaskArchive
+from heareval.embeddings.tf_inference import TFDataLoader, TracedModel
+from heareval.embeddings.transfer import (
+    DevicePrefetcher,
+    DeviceTransfer,
+    to_tensorflow,
+)
+from heareval.embeddings.windowing import (
+    window_starts,
+    windowed_timestamp_embeddings,
+)
 
 TORCH = "torch"
 TENSORFLOW = "tf"
 
+# Precisions torch models can be run in, with autocast
+PRECISIONS = ["float32", "float16", "bfloat16"]
+# Number of clips that reduced precision is checked against float32 on
+PRECISION_CHECK_CLIPS = 8
+
 
 class Embedding:
     """
     A wrapper class to help with loading embedding models and computing embeddings
     using the HEAR 2021 API for both torch and tensorflow models.
-    # TODO: Still need to implement and test this with TensorFlow
 
     Args:
         module_name: the import name for the embedding module
         model_path: location to load the model from
+        precision: one of PRECISIONS. Torch models are run under autocast to
+            float16 (GPU only) or bfloat16, see check_precision()
+        tf_function: run tensorflow models through tf.function, or eagerly
     """
 
     def __init__(
@@ -61,6 +110,8 @@ class Embedding:
         module_name: str,
         model_path: str = None,
         model_options: Optional[Dict[str, Any]] = None,
+        precision: str = "float32",
+        tf_function: bool = True,
     ):
         print(f"Importing {module_name}")
         self.module = import_module(module_name)
@@ -75,18 +126,43 @@ class Embedding:
         else:
             self.model = self.module.load_model(**model_options)  # type: ignore
 
-        # Check to see what type of model this is: torch or tensorflow
+        # Check to see what type of model this is: torch or tensorflow.
+        # tensorflow is only imported (by the model's module) for tensorflow
+        # models, so there is no need to import it here otherwise.
+        tf = sys.modules.get("tensorflow")
         if isinstance(self.model, torch.nn.Module):
             self.type = TORCH
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
             self.model.to(self.device)
-        elif isinstance(self.model, tf.Module):
+            self.transfer = DeviceTransfer(self.device)
+        elif tf is not None and isinstance(self.model, tf.Module):
             self.type = TENSORFLOW
             # Tensorflow automatically manages data transfers to device,
             # so we don't need to set self.device
+            self.traced = TracedModel(self.module, self.model, trace=tf_function)
         else:
             raise TypeError(f"Unsupported model type received: {type(self.model)}")
 
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        if precision != "float32":
+            if self.type != TORCH:
+                raise ValueError("Reduced precision is only supported for torch models")
+            if precision == "float16" and self.device == "cpu":
+                raise ValueError("float16 needs a GPU, use bfloat16 on CPU")
+            if (
+                precision == "bfloat16"
+                and self.device == "cuda"
+                and not torch.cuda.is_bf16_supported()
+            ):
+                raise ValueError("This GPU does not support bfloat16")
+        self.precision = precision
+        # Set by check_precision()
+        self.precision_check: Optional[Dict[str, float]] = None
+
+        # Set by SplitEmbedder, to time the stages of computing embeddings
+        self.timer: Optional[StageTimer] = None
+
     @property
     def name(self):
         # TODO: would be nice to include version in this string, a versioned string.
@@ -100,71 +176,179 @@ class Embedding:
 
     def as_tensor(self, x: Union[np.ndarray, torch.Tensor]):
         if self.type == TORCH:
-            # Load array as tensor onto device
-            if isinstance(x, np.ndarray):
-                x = torch.tensor(x, device=self.device)
-            elif isinstance(x, torch.Tensor):
-                x = x.to(self.device)
-            else:
-                raise TypeError(
-                    "Input must be one of np.ndarray or torch.Tensor for"
-                    f"torch audio embedding models. "
-                    f"Received: {type(x)}"
-                )
-
+            # Load array as tensor onto device, see heareval.embeddings.transfer
+            x = self.transfer.to_device(x)
         elif self.type == TENSORFLOW:
-            # Load array as tensor onto device
-
-            if not isinstance(x, np.ndarray):
-                x = x.numpy()
-            x = tf.convert_to_tensor(x)
+            # Tensorflow copies the tensor to the device itself
+            x = to_tensorflow(x)
         else:
             raise AssertionError("Unknown type")
 
         return x
 
+    def _stage(self, stage: str) -> ContextManager:
+        if self.timer is None:
+            return nullcontext()
+        return self.timer.stage(stage)
+
+    def _inference(self) -> ContextManager:
+        """
+        Run the model without tracking gradients, and under autocast in
+        reduced precision.
+        """
+        stack = ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.precision != "float32":
+            stack.enter_context(
+                torch.autocast(self.device, dtype=getattr(torch, self.precision))
+            )
+        return stack
+
+    @staticmethod
+    def _to_numpy(x: torch.Tensor) -> np.ndarray:
+        # numpy has no bfloat16
+        if x.dtype in [torch.float16, torch.bfloat16]:
+            x = x.float()
+        return x.detach().cpu().numpy()
+
+    def _synchronize(self):
+        # When timing, wait for the model on GPU, so that its time is not
+        # counted as device_to_host
+        if self.timer is not None and self.type == TORCH and self.device == "cuda":
+            torch.cuda.synchronize()
+
     def get_scene_embedding_as_numpy(
         self, audio: Union[np.ndarray, torch.Tensor]
     ) -> np.ndarray:
-        audio = self.as_tensor(audio)
+        """
+        If the batch runs out of memory, it is split in half and retried.
+        """
+        return split_on_oom(self._get_scene_embedding_as_numpy, audio)
+
+    def get_timestamp_embedding_as_numpy(
+        self, audio: Union[np.ndarray, torch.Tensor]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        If the batch runs out of memory, it is split in half and retried.
+        """
+        return split_on_oom(self._get_timestamp_embedding_as_numpy, audio)
+
+    def tuned_batch_size(
+        self, metadata: Dict, nsamples: int, cache_path: Path, memory_fraction: float
+    ) -> int:
+        """
+        See heareval.embeddings.batch_size.tuned_batch_size.
+        """
+        return tuned_batch_size(self, metadata, nsamples, cache_path, memory_fraction)
+
+    def check_precision(
+        self, audio: torch.Tensor, embedding_type: str, tolerance: float
+    ) -> Dict[str, float]:
+        """
+        Compare the embeddings of a batch of audio in self.precision to
+        those in float32, and time both. Raises a ValueError if the RMS
+        error, relative to the RMS of the float32 embeddings, is more than
+        tolerance. The errors and the speedup are saved in
+        self.precision_check.
+        """
+        get_embedding: Callable[[torch.Tensor], np.ndarray]
+        if embedding_type == "scene":
+            get_embedding = self.get_scene_embedding_as_numpy
+        else:
+
+            def get_embedding(audio: torch.Tensor) -> np.ndarray:
+                return self.get_timestamp_embedding_as_numpy(audio)[0]
+
+        precision, timer = self.precision, self.timer
+        self.timer = None
+        try:
+            self.precision = "float32"
+            start = time.perf_counter()
+            reference = get_embedding(audio).astype(np.float64)
+            fp32_seconds = time.perf_counter() - start
+            self.precision = precision
+            # Warm up the reduced-precision kernels
+            get_embedding(audio)
+            start = time.perf_counter()
+            embeddings = get_embedding(audio)
+            seconds = time.perf_counter() - start
+        finally:
+            self.precision, self.timer = precision, timer
+
+        error = embeddings - reference
+        rms = np.sqrt(np.mean(np.square(reference)))
+        self.precision_check = {
+            "max_abs_error": float(np.abs(error).max()),
+            "relative_rms_error": (
+                float(np.sqrt(np.mean(np.square(error))) / rms) if rms > 0 else 0.0
+            ),
+            "fp32_seconds": fp32_seconds,
+            "seconds": seconds,
+            "speedup": fp32_seconds / seconds if seconds > 0 else 0.0,
+        }
+        print(
+            f"{precision} vs float32 on {len(audio)} clips: relative RMS error "
+            f"{self.precision_check['relative_rms_error']:.3g}, "
+            f"speedup {self.precision_check['speedup']:.2f}x"
+        )
+        if not np.isfinite(embeddings).all() or not (
+            self.precision_check["relative_rms_error"] <= tolerance
+        ):
+            raise ValueError(
+                f"Embeddings in {precision} differ from float32 by a relative "
+                f"RMS error of {self.precision_check['relative_rms_error']:.3g}, "
+                f"more than the tolerance of {tolerance}"
+            )
+        return self.precision_check
+
+    def _get_scene_embedding_as_numpy(
+        self, audio: Union[np.ndarray, torch.Tensor]
+    ) -> np.ndarray:
+        with self._stage("host_to_device"):
+            audio = self.as_tensor(audio)
         if self.type == TORCH:
-            with torch.no_grad():
-                embeddings = self.module.get_scene_embeddings(  # type: ignore
-                    audio, self.model
-                )
-                return embeddings.detach().cpu().numpy()
+            with self._inference():
+                with self._stage("forward"):
+                    embeddings = self.module.get_scene_embeddings(  # type: ignore
+                        audio, self.model
+                    )
+                    self._synchronize()
+                with self._stage("device_to_host"):
+                    return self._to_numpy(embeddings)
         elif self.type == TENSORFLOW:
-            embeddings = self.module.get_scene_embeddings(  # type: ignore
-                audio, self.model
-            )
-            return embeddings.numpy()
+            with self._stage("forward"):
+                embeddings = self.traced.scene(audio)
+            with self._stage("device_to_host"):
+                return embeddings.numpy()
         else:
             raise NotImplementedError("Unknown type")
 
-    def get_timestamp_embedding_as_numpy(
+    def _get_timestamp_embedding_as_numpy(
         self, audio: Union[np.ndarray, torch.Tensor]
     ) -> Tuple[np.ndarray, np.ndarray]:
-        audio = self.as_tensor(audio)
+        with self._stage("host_to_device"):
+            audio = self.as_tensor(audio)
         if self.type == TORCH:
-            with torch.no_grad():
-                # flake8: noqa
-                embeddings, timestamps = self.module.get_timestamp_embeddings(  # type: ignore
-                    audio,
-                    self.model,
-                )
+            with self._inference():
+                with self._stage("forward"):
+                    # flake8: noqa
+                    embeddings, timestamps = self.module.get_timestamp_embeddings(  # type: ignore
+                        audio,
+                        self.model,
+                    )
+                    self._synchronize()
                 gpu_max_mem.measure()
-                embeddings = embeddings.detach().cpu().numpy()
-                timestamps = timestamps.detach().cpu().numpy()
+                with self._stage("device_to_host"):
+                    embeddings = self._to_numpy(embeddings)
+                    timestamps = self._to_numpy(timestamps)
                 return embeddings, timestamps
         elif self.type == TENSORFLOW:
-            # flake8: noqa
-            embeddings, timestamps = self.module.get_timestamp_embeddings(  # type: ignore
-                audio,
-                self.model,
-            )
+            with self._stage("forward"):
+                embeddings, timestamps = self.traced.timestamp(audio)
             gpu_max_mem.measure()
-            embeddings = embeddings.numpy()
-            timestamps = timestamps.numpy()
+            with self._stage("device_to_host"):
+                embeddings = embeddings.numpy()
+                timestamps = timestamps.numpy()
             return embeddings, timestamps
         else:
             raise NotImplementedError("Unknown type")
@@ -192,134 +376,428 @@ class AudioFileDataset(Dataset):
         assert sr == self.sample_rate
         return audio, self.filenames[idx]
 
+    def lengths(self) -> List[int]:
+        """
+        Length in samples of each audio file, read from its header.
+        """
+        return audio_lengths(self.audio_dir, self.filenames)
+
+
+def get_audio_dataset(
+    data: Dict, audio_dir: Path, sample_rate: int
+) -> Union[AudioFileDataset, PackedAudioDataset]:
+    """
+    Read the split's packed audio file if it has been packed with
+    heareval.embeddings.packed_audio, or else its audio files.
+    """
+    if has_packed_audio(audio_dir):
+        return PackedAudioDataset(data, audio_dir, sample_rate)
+    return AudioFileDataset(data, audio_dir, sample_rate)
+
+
+def copy_task_file(
+    task_path: Union[Path, PurePosixPath],
+    filename: str,
+    embed_task_dir: Path,
+    archive: Optional[TaskArchive] = None,
+) -> Path:
+    """
+    Copy a file of the task, from the task directory or from the task
+    archive, to the embeddings directory and return the copy.
+    """
+    if archive is None:
+        shutil.copy(task_path.joinpath(filename), embed_task_dir)
+    else:
+        embed_task_dir.joinpath(filename).write_bytes(
+            archive.read(str(task_path.joinpath(filename)))
+        )
+    return embed_task_dir.joinpath(filename)
+
 
 def get_dataloader_for_embedding(
-    data: Dict, audio_dir: Path, embedding: Embedding, batch_size: int = 64
+    dataset: Union[AudioFileDataset, PackedAudioDataset, TarAudioDataset],
+    embedding: Embedding,
+    batch_size: int = 64,
+    batch_sampler: Optional[Iterable[List[int]]] = None,
+    num_workers: int = 0,
+    worker_type: str = THREAD,
+    prefetch: int = 2,
+    pin_memory: bool = False,
 ):
+    """
+    Batches are (audio, filenames, lengths), where audio is zero-padded
+    to the longest clip in the batch when clips have different lengths.
+    If batch_sampler is given, it determines the batches instead of
+    batch_size.
+
+    Audio is decoded by num_workers threads or processes (worker_type),
+    up to prefetch batches ahead, see heareval.embeddings.decoding.
+    """
     if embedding.type == TORCH or embedding.type == TENSORFLOW:
-        return DataLoader(
-            AudioFileDataset(data, audio_dir, embedding.sample_rate),
+        return decoding_dataloader(
+            dataset,
+            collate_fn=pad_collate,
             batch_size=batch_size,
-            shuffle=False,
+            batch_sampler=batch_sampler,
+            num_workers=num_workers,
+            worker_type=worker_type,
+            prefetch=prefetch,
+            pin_memory=pin_memory,
         )
 
     else:
         raise AssertionError("Unknown embedding type")
 
 
-def save_scene_embedding_and_labels(
-    embeddings: np.ndarray, labels: List[Dict], filenames: Tuple[str], outdir: Path
-):
-    assert len(embeddings) == len(filenames)
-    assert len(labels) == len(filenames)
-    for i, filename in enumerate(filenames):
-        out_file = outdir.joinpath(f"{filename}")
-        np.save(f"{out_file}.embedding.npy", embeddings[i])
-        json.dump(labels[i], open(f"{out_file}.target-labels.json", "w"))
-
-
-def save_timestamp_embedding_and_labels(
-    embeddings: np.ndarray,
-    timestamps: np.ndarray,
-    labels: np.ndarray,
-    filename: Tuple[str],
-    outdir: Path,
-):
-    for i, file in enumerate(filename):
-        out_file = outdir.joinpath(f"{file}")
-        np.save(f"{out_file}.embedding.npy", embeddings[i])
-        assert len(timestamps[i].shape) == 1
-        json.dump(timestamps[i].tolist(), open(f"{out_file}.timestamps.json", "w"))
-        json.dump(labels[i], open(f"{out_file}.target-labels.json", "w"), indent=4)
+class SplitEmbeddingWriter:
+    """
+    Streams the embeddings for one split into a single growable memmap,
+    in the order they are computed, while keeping the labels (and
+    timestamps for event embeddings) in memory.
+    (We assume labels can fit in memory.)
 
+    The row range of every file is recorded, so memmap_embeddings can
+    shuffle a row index instead of re-reading per-file embeddings.
 
-def get_labels_for_timestamps(labels: List, timestamps: np.ndarray) -> List:
-    # -> List[List[List[str]]]:
-    # -> List[List[str]]:
-    # TODO: Is this function redundant?
-    # A list of labels present at each timestamp
-    timestamp_labels = []
+    Every file written is also recorded in a manifest, with its byte
+    offset in the memmap. Every commit_every batches the memmap and
+    then the manifest are fsynced. If a previous run of this split
+    crashed, the writer reopens the memmap at the last committed batch,
+    and the caller should only embed the files not in self.rows.
+
+    Args:
+        embed_task_dir: directory the split's embeddings are written to
+        split_name: name of the split, e.g. "train"
+        embedding_type: "scene" or "event"
+        commit_every: number of batches between fsyncs of the manifest
+    """
 
+    def __init__(
+        self,
+        embed_task_dir: Path,
+        split_name: str,
+        embedding_type: str,
+        commit_every: int = 16,
+    ):
+        if embedding_type not in ["scene", "event"]:
+            raise ValueError(f"Unknown embedding type: {embedding_type}")
+        self.embedding_type = embedding_type
+        self.path = embed_task_dir.joinpath(f"{split_name}.embeddings-unshuffled.npy")
+        self.manifest_path = embed_task_dir.joinpath(
+            f"{split_name}.embeddings-manifest.jsonl"
+        )
+        self.commit_every = commit_every
+        self.ndim: Optional[int] = None
+        self.nembeddings = 0
+        # filename -> (first row, number of rows) in the unshuffled memmap
+        self.rows: Dict[str, Tuple[int, int]] = {}
+        self.labels: Dict[str, List] = {}
+        self.timestamps: Dict[str, List[float]] = {}
+        # Manifest records of batches that have not been committed yet
+        self.uncommitted: List[Dict[str, Any]] = []
+        self.uncommitted_batches = 0
+
+        if self.path.exists() and self.manifest_path.exists():
+            self._resume()
+            self.fp = open(self.path, "r+b")
+            # Drop any rows written after the last commit
+            self.fp.truncate(self.nembeddings * self._row_bytes())
+            self.fp.seek(0, os.SEEK_END)
+            self.manifest = open(self.manifest_path, "at")
+        else:
+            self.fp = open(self.path, "wb")
+            self.manifest = open(self.manifest_path, "wt")
+
+    def _row_bytes(self) -> int:
+        if self.ndim is None:
+            return 0
+        return self.ndim * np.dtype(np.float32).itemsize
+
+    def _resume(self):
+        """
+        Restore the files committed to the manifest by a previous run.
+        """
+        manifest = self.manifest_path.read_bytes()
+        # A crash while writing the manifest can leave a partial last line
+        committed = manifest[: manifest.rfind(b"\n") + 1]
+        if len(committed) != len(manifest):
+            with open(self.manifest_path, "r+b") as fp:
+                fp.truncate(len(committed))
+        for line in committed.decode("utf-8").splitlines():
+            record = json.loads(line)
+            self._add(record)
+        if self.rows:
+            print(f"Resuming from {len(self.rows)} files in {self.manifest_path}")
+
+    def _add(self, record: Dict[str, Any]):
+        if self.ndim is None:
+            self.ndim = record["ndim"]
+        assert record["ndim"] == self.ndim
+        first_row = record["offset"] // self._row_bytes()
+        assert first_row == self.nembeddings
+        filename = record["filename"]
+        self.rows[filename] = (first_row, record["rows"])
+        self.labels[filename] = record["labels"]
+        if self.embedding_type == "event":
+            self.timestamps[filename] = record["timestamps"]
+        self.nembeddings += record["rows"]
+
+    def _append(self, embeddings: np.ndarray) -> int:
+        """
+        Append a batch of embeddings of shape (..., ndim) to the end of
+        the memmap, and return the first row they were written to.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.ndim is None:
+            self.ndim = embeddings.shape[-1]
+        assert embeddings.shape[-1] == self.ndim
+        self.fp.write(embeddings.tobytes())
+        return self.nembeddings
+
+    def _record(self, filename: str, nrows: int, labels: List, **kwargs):
+        record = {
+            "filename": filename,
+            "offset": self.nembeddings * self._row_bytes(),
+            "rows": nrows,
+            "ndim": self.ndim,
+            "labels": labels,
+            **kwargs,
+        }
+        self._add(record)
+        self.uncommitted.append(record)
+
+    def _batch_written(self):
+        self.uncommitted_batches += 1
+        if self.uncommitted_batches >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """
+        Make everything written so far durable. The memmap is fsynced
+        before the manifest, so the manifest never refers to rows that
+        are not on disk.
+        """
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        for record in self.uncommitted:
+            self.manifest.write(json.dumps(record) + "\n")
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.uncommitted = []
+        self.uncommitted_batches = 0
+
+    def write_scene(
+        self, embeddings: np.ndarray, labels: List[List], filenames: Tuple[str]
+    ):
+        assert self.embedding_type == "scene"
+        assert embeddings.ndim == 2
+        assert len(embeddings) == len(filenames)
+        assert len(labels) == len(filenames)
+        self._append(embeddings)
+        for i, filename in enumerate(filenames):
+            self._record(filename, 1, labels[i])
+        self._batch_written()
+
+    def write_timestamp(
+        self,
+        embeddings: Union[np.ndarray, List[np.ndarray]],
+        timestamps: Union[np.ndarray, List[np.ndarray]],
+        labels: List[List[List[str]]],
+        filenames: Tuple[str],
+    ):
+        """
+        embeddings and timestamps are either arrays with one row per file,
+        or lists with one array per file if files have different numbers
+        of frames.
+        """
+        assert self.embedding_type == "event"
+        assert len(embeddings) == len(filenames)
+        assert len(labels) == len(filenames)
+        if isinstance(embeddings, np.ndarray):
+            self._append(embeddings)
+        else:
+            for file_embeddings in embeddings:
+                self._append(file_embeddings)
+        for i, filename in enumerate(filenames):
+            assert embeddings[i].ndim == 2
+            assert len(timestamps[i].shape) == 1
+            nrows = embeddings[i].shape[0]
+            assert nrows == len(timestamps[i]), f"{nrows} != {len(timestamps[i])}"
+            assert len(labels[i]) == nrows, f"{len(labels[i])} != {nrows}"
+            self._record(filename, nrows, labels[i], timestamps=timestamps[i].tolist())
+        self._batch_written()
+
+    def close(self):
+        self.commit()
+        self.fp.close()
+        self.manifest.close()
+
+    def memmap(self) -> np.memmap:
+        """
+        A read-only view of all the embeddings written so far, in the
+        order they were written.
+        """
+        assert self.fp.closed
+        assert self.ndim is not None, "No embeddings were written"
+        return np.memmap(
+            filename=self.path,
+            dtype=np.float32,
+            mode="r",
+            shape=(self.nembeddings, self.ndim),
+        )
+
+    def delete(self):
+        """
+        Remove the unshuffled memmap and the manifest.
+        """
+        os.remove(self.path)
+        os.remove(self.manifest_path)
+
+
+def _timestamp_label_counts(
+    labels: List, timestamps: Sequence[np.ndarray], label_to_idx: Dict[str, int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Count the events of each label present at each timestamp, for a batch
+    of files at once.
+
+    An event is present at timestamp t if start <= t < end + 0.0001
+    (so that the end also includes the event), like an IntervalTree of
+    the events. Identical events are counted once, as an IntervalTree
+    does, while overlapping events of the same label are each counted.
+
+    Returns an array of shape (total number of timestamps, number of
+    labels) of the timestamps of all files concatenated, and the offset
+    of each file's timestamps in it.
+    """
     # NOTE: Make sure dataset events are specified in ms.
     assert len(labels) == len(timestamps)
-    for i, label in enumerate(labels):
-        tree = IntervalTree()
-        # Add all events to the label tree
-        for event in label:
-            # We add 0.0001 so that the end also includes the event
-            tree.addi(event["start"], event["end"] + 0.0001, event["label"])
+    offsets = np.zeros(len(timestamps) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(file_timestamps) for file_timestamps in timestamps])
+    # Events add 1 from the first sorted timestamp they include, and subtract
+    # 1 from the first sorted timestamp after them. The cumulative sum of
+    # this is then the count of events at each sorted timestamp.
+    diffs = np.zeros((offsets[-1] + 1, len(label_to_idx)), dtype=np.int64)
+    # Sorted position -> position of each timestamp
+    order = np.arange(offsets[-1])
+    for i, (file_labels, file_timestamps) in enumerate(zip(labels, timestamps)):
+        events = {
+            (event["start"], event["end"] + 0.0001, str(event["label"]))
+            for event in file_labels
+        }
+        if not events:
+            continue
+        starts, ends, names = zip(*sorted(events))
+        starts = np.array(starts, dtype=np.float64)
+        ends = np.array(ends, dtype=np.float64)
+        if np.any(starts >= ends):
+            raise ValueError(f"Event starts after it ends: {file_labels}")
+        columns = np.array([label_to_idx[name] for name in names], dtype=np.int64)
+
+        file_timestamps = np.asarray(file_timestamps, dtype=np.float64)
+        file_order = np.argsort(file_timestamps, kind="stable")
+        sorted_timestamps = file_timestamps[file_order]
+        order[offsets[i] : offsets[i + 1]] = offsets[i] + file_order
+        first = np.searchsorted(sorted_timestamps, starts, side="left")
+        after = np.searchsorted(sorted_timestamps, ends, side="left")
+        np.add.at(diffs, (offsets[i] + first, columns), 1)
+        np.add.at(diffs, (offsets[i] + after, columns), -1)
+
+    counts = np.empty((offsets[-1], len(label_to_idx)), dtype=np.int64)
+    counts[order] = np.cumsum(diffs[:-1], axis=0)
+    return counts, offsets
+
+
+def get_labels_for_timestamps(labels: List, timestamps: Sequence[np.ndarray]) -> List:
+    """
+    A list of the labels present at each timestamp, for each file.
+    A label appears once for each distinct event of it at the timestamp,
+    and the labels of a timestamp are sorted (as strings), so that they
+    don't depend on which files are aligned together.
+    """
+    # -> List[List[List[str]]]:
+    names: Dict[str, Any] = {}
+    for file_labels in labels:
+        for event in file_labels:
+            names.setdefault(str(event["label"]), event["label"])
+    label_to_idx = {name: i for i, name in enumerate(sorted(names))}
+    idx_to_label = [names[name] for name in sorted(names)]
+
+    counts, offsets = _timestamp_label_counts(labels, timestamps, label_to_idx)
+    timestamp_labels: List[List[str]] = [[] for _ in range(len(counts))]
+    rows, columns = np.nonzero(counts)
+    for row, column, count in zip(
+        rows.tolist(), columns.tolist(), counts[rows, columns].tolist()
+    ):
+        timestamp_labels[row] += [idx_to_label[column]] * count
 
-        labels_for_sound = []
-        # Update the binary vector of labels with intervals for each timestamp
-        for j, t in enumerate(timestamps[i]):
-            interval_labels: List[str] = [interval.data for interval in tree[t]]
-            labels_for_sound.append(interval_labels)
-            # If we want to store the timestamp too
-            # labels_for_sound.append([float(t), interval_labels])
+    labels_for_files = [
+        timestamp_labels[offsets[i] : offsets[i + 1]] for i in range(len(labels))
+    ]
+    assert len(labels_for_files) == len(timestamps)
+    return labels_for_files
 
-        timestamp_labels.append(labels_for_sound)
 
-    assert len(timestamp_labels) == len(timestamps)
-    return timestamp_labels
+def get_multihot_for_timestamps(
+    labels: List, timestamps: Sequence[np.ndarray], label_to_idx: Dict[str, int]
+) -> List[np.ndarray]:
+    """
+    A multi-hot array of shape (number of timestamps, number of labels) of
+    the labels present at each timestamp, for each file.
+    """
+    counts, offsets = _timestamp_label_counts(labels, timestamps, label_to_idx)
+    multihot = (counts > 0).astype(np.float32)
+    return [multihot[offsets[i] : offsets[i + 1]] for i in range(len(labels))]
 
 
 def memmap_embeddings(
-    outdir: Path,
+    writer: SplitEmbeddingWriter,
     prng: random.Random,
     metadata: Dict,
     split_name: str,
     embed_task_dir: Path,
     split_data: Dict,
+    chunk_rows: int = 65536,
+    storage_dtype: str = "float32",
 ):
     """
-    Memmap all the embeddings to one file, and pickle all the labels.
+    Shuffle the embeddings streamed by the writer into one memmap,
+    and save the labels (and files and timestamps) of every row, see
+    heareval.embeddings.sidecars.
     (We assume labels can fit in memory.)
-    TODO: This writes things to disk double, we could clean that up after.
-    We might also be able to get away with writing to disk only once.
+
+    The memmap is stored as storage_dtype, see heareval.embeddings.storage,
+    and the error of reduced-precision storage is reported.
+
+    The files are shuffled exactly as if their per-file embeddings were
+    shuffled, but only a row index into the writer's memmap is permuted.
+    The embeddings are then gathered chunk by chunk into their final
+    order and the writer's memmap and manifest are deleted.
+    Because files are looked up by name, the output does not depend on
+    the order they were written in, e.g. across resumed runs.
     """
-    embedding_files = [outdir.joinpath(f"{f}.embedding.npy") for f in split_data.keys()]
-    prng.shuffle(embedding_files)
-
-    # First count the number of embeddings total
-    nembeddings = 0
-    ndim: int
-    for embedding_file in tqdm(embedding_files):
-        assert embedding_file.exists()
-        emb = np.load(embedding_file).astype(np.float32)
-        if metadata["embedding_type"] == "scene":
-            assert emb.ndim == 1
-            nembeddings += 1
-            ndim = emb.shape[0]
-            assert emb.dtype == np.float32
-        elif metadata["embedding_type"] == "event":
-            assert emb.ndim == 2
-            nembeddings += emb.shape[0]
-            ndim = emb.shape[1]
-            assert emb.dtype == np.float32
-        else:
-            raise ValueError(f"Unknown embedding type: {metadata['embedding_type']}")
+    filenames = list(split_data.keys())
+    assert set(writer.rows.keys()) == set(filenames)
+    prng.shuffle(filenames)
 
+    nembeddings = writer.nembeddings
+    ndim = writer.ndim
     open(
         embed_task_dir.joinpath(f"{split_name}.embedding-dimensions.json"), "wt"
     ).write(json.dumps((nembeddings, ndim)))
-    embedding_memmap = np.memmap(
-        filename=embed_task_dir.joinpath(f"{split_name}.embeddings.npy"),
-        dtype=np.float32,
-        mode="w+",
-        shape=(nembeddings, ndim),
-    )
+
+    row_index = np.empty(nembeddings, dtype=np.int64)
     idx = 0
     labels = []
-    filename_timestamps = []
-    for embedding_file in tqdm(embedding_files):
-        emb = np.load(embedding_file)
-        lbl = json.load(
-            open(str(embedding_file).replace("embedding.npy", "target-labels.json"))
-        )
-
+    slugs = []
+    file_ids = np.empty(nembeddings, dtype=np.int32)
+    timestamps = np.empty(nembeddings, dtype=np.float32)
+    for filename in filenames:
+        first_row, nrows = writer.rows[filename]
+        row_index[idx : idx + nrows] = np.arange(first_row, first_row + nrows)
+
+        lbl = writer.labels[filename]
         if metadata["embedding_type"] == "scene":
-            assert emb.ndim == 1
-            embedding_memmap[idx] = emb
             # lbl will be a list of labels, make sure that it has exactly one label
             # for multiclass problems. Will be a list of zero or more for multilabel.
             if metadata["prediction_type"] == "multiclass":
@@ -331,135 +809,697 @@ def memmap_embeddings(
                     "Only multiclass and multilabel prediction types"
                     f"implemented for scene embeddings. Received {metadata['prediction_type']}"
                 )
-
             labels.append(lbl)
-            idx += 1
         elif metadata["embedding_type"] == "event":
-            assert emb.ndim == 2
-            embedding_memmap[idx : idx + emb.shape[0]] = emb
-            assert emb.shape[0] == len(lbl)
             labels += lbl
-
-            timestamps = json.load(
-                open(str(embedding_file).replace("embedding.npy", "timestamps.json"))
-            )
-            slug = str(embedding_file).replace(".embedding.npy", "")
-            filename_timestamps += [(slug, timestamp) for timestamp in timestamps]
-            assert emb.shape[0] == len(
-                timestamps
-            ), f"{emb.shape[0]} != {len(timestamps)}"
-            assert len(lbl) == len(timestamps), f"{len(lbl)} != {len(timestamps)}"
-
-            idx += emb.shape[0]
+            file_ids[idx : idx + nrows] = len(slugs)
+            timestamps[idx : idx + nrows] = writer.timestamps[filename]
+            slugs.append(str(embed_task_dir.joinpath(split_name, filename)))
         else:
             raise ValueError(f"Unknown embedding type: {metadata['embedding_type']}")
+        idx += nrows
+    assert idx == nembeddings
+
+    unshuffled = writer.memmap()
+    storage = EmbeddingStorage.fit(
+        storage_dtype,
+        (
+            unshuffled[row_index[start : start + chunk_rows]]
+            for start in range(0, nembeddings, chunk_rows)
+        ),
+    )
+    embedding_memmap = np.memmap(
+        filename=embed_task_dir.joinpath(f"{split_name}.embeddings.npy"),
+        dtype=storage.numpy_dtype,
+        mode="w+",
+        shape=(nembeddings, ndim),
+    )
+    for start in tqdm(range(0, nembeddings, chunk_rows)):
+        end = min(start + chunk_rows, nembeddings)
+        embedding_memmap[start:end] = storage.encode(unshuffled[row_index[start:end]])
 
     # Write changes to disk
     embedding_memmap.flush()
-    # TODO: Convert labels to indices?
-    pickle.dump(
-        labels,
-        open(
-            embed_task_dir.joinpath(f"{split_name}.target-labels.pkl"),
-            "wb",
-        ),
-    )
+    if storage.dtype != "float32":
+        print(f"Split {split_name}: {storage.error_summary()}")
+    storage.save(embed_task_dir, split_name)
+    del unshuffled
+    writer.delete()
+    assert len(labels) == nembeddings
+    SplitLabels.from_lists(labels).save(embed_task_dir, split_name)
     if metadata["embedding_type"] == "event":
-        assert len(labels) == len(filename_timestamps)
-        open(
-            embed_task_dir.joinpath(f"{split_name}.filename-timestamps.json"),
-            "wt",
-        ).write(json.dumps(filename_timestamps, indent=4))
+        FrameMetadata(slugs, file_ids, timestamps).save(embed_task_dir, split_name)
 
 
-def task_embeddings(
+def shard_split_data(split_data: Dict, shard: int, nshards: int) -> Dict:
+    """
+    The files of a split in its shard-th of nshards shards. Files are
+    dealt out round-robin, in the order of the split's json, so every
+    machine computes the same shards.
+    """
+    if not 0 <= shard < nshards:
+        raise ValueError(f"Shard {shard} is not one of {nshards} shards")
+    return {
+        file: label
+        for i, (file, label) in enumerate(split_data.items())
+        if i % nshards == shard
+    }
+
+
+def batch_chunks(
+    audios: torch.Tensor,
+    filenames: List[str],
+    clip_lengths: torch.Tensor,
+    remaining: Set[str],
+    batch_size: int,
+) -> Iterator[Tuple[torch.Tensor, List[str], torch.Tensor]]:
+    """
+    The files of a batch that are in remaining, in batches of at most
+    batch_size files.
+    """
+    keep = [i for i, file in enumerate(filenames) if file in remaining]
+    if len(keep) < len(filenames):
+        audios = audios[keep]
+        clip_lengths = clip_lengths[keep]
+        filenames = [filenames[i] for i in keep]
+    for start in range(0, len(filenames), batch_size):
+        end = start + batch_size
+        yield audios[start:end], filenames[start:end], clip_lengths[start:end]
+
+
+def compute_embeddings(
     embedding: Embedding,
-    task_path: Path,
-    embed_task_dir: Path,
-):
-    prng = random.Random()
-    prng.seed(0)
+    cache: Optional[EmbeddingCache],
+    embedding_type: str,
+    audios: torch.Tensor,
+    window: Optional[Tuple[int, int]] = None,
+    batch_size: Optional[int] = None,
+    clip_lengths: Optional[torch.Tensor] = None,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Scene embeddings and None, or timestamp embeddings and their
+    timestamps, of a batch of audio.
 
-    metadata_path = task_path.joinpath("task_metadata.json")
-    metadata = json.load(metadata_path.open())
-    label_vocab_path = task_path.joinpath("labelvocabulary.csv")
+    The cache keys clips on their audio without padding, given their
+    clip_lengths, and can then return the timestamp embeddings of each
+    clip trimmed to its length, see EmbeddingCache.
+
+    If window is (window, overlap) in samples, timestamp embeddings of
+    longer audio are computed window by window, in batches of batch_size
+    windows (default: as many as there are clips), see
+    heareval.embeddings.windowing.
+    """
+    lengths = None if clip_lengths is None else clip_lengths.tolist()
+    if embedding_type == "scene":
+        if cache is not None:
+            return cache.get_scene_embedding_as_numpy(embedding, audios, lengths), None
+        return embedding.get_scene_embedding_as_numpy(audios), None
+    elif embedding_type == "event":
+        get_embedding: Callable[[torch.Tensor], Tuple[np.ndarray, np.ndarray]]
+        if cache is not None:
+            # Windows are cached by their own audio
+            get_embedding = partial(
+                cache.get_timestamp_embedding_as_numpy,
+                embedding,
+                lengths=lengths if window is None else None,
+            )
+        else:
+            get_embedding = embedding.get_timestamp_embedding_as_numpy
+        if window is not None:
+            return windowed_timestamp_embeddings(
+                get_embedding,
+                audios,
+                *window,
+                embedding.sample_rate,
+                batch_size or len(audios),
+            )
+        return get_embedding(audios)
+    else:
+        raise ValueError(f"Unknown embedding type: {embedding_type}")
+
+
+class SplitEmbedder:
+    """
+    Computes the embeddings of one split with one model, and writes them
+    to the model's embeddings directory. Batches of audio can be shared
+    with the SplitEmbedders of other models of the same sample rate, so
+    that the audio is only decoded once for all of them.
+
+    The model is run in the calling thread, while labels are aligned and
+    embeddings are written by a BackgroundStage. The time of each stage is
+    kept in self.timer, and summarized in self.profile once the split is
+    finished.
+
+    Args:
+        embedding: the embedding model, or its ReplicaEmbedding if it is only
+            run by replicas (which then only use submit() and add_batch())
+        cache: an optional embedding cache to consult before inference
+        embed_task_dir: directory to write the embeddings to
+        split: name of the split, e.g. "train"
+        metadata: the task metadata
+        split_data: the split's labels of each file
+        storage_dtype: dtype to store the embeddings as, see
+            heareval.embeddings.storage
+        window: (window, overlap) in samples, to compute timestamp embeddings
+            of longer audio window by window
+    """
+
+    def __init__(
+        self,
+        embedding: Union[Embedding, ReplicaEmbedding],
+        cache: Optional[EmbeddingCache],
+        embed_task_dir: Path,
+        split: str,
+        metadata: Dict,
+        split_data: Dict,
+        storage_dtype: str = "float32",
+        window: Optional[Tuple[int, int]] = None,
+    ):
+        self.embedding = embedding
+        self.cache = cache
+        self.embed_task_dir = embed_task_dir
+        self.split = split
+        self.metadata = metadata
+        self.split_data = split_data
+        self.storage_dtype = storage_dtype
+        self.window = window
+        self.writer = SplitEmbeddingWriter(
+            embed_task_dir, split, metadata["embedding_type"]
+        )
+        # Skip files that a previous, interrupted run already embedded
+        self.remaining = {file for file in split_data if file not in self.writer.rows}
+        # The model's name and options, as in its embeddings directory
+        self.name = embed_task_dir.parent.name
+        self.batch_size: Optional[int] = None
+        if cache is not None:
+            self.cache_hits, self.cache_misses = cache.hits, cache.misses
+        self.timer = StageTimer()
+        self.profile: Optional[Dict[str, Any]] = None
+
+    def tune_batch_size(
+        self, batch_size: Optional[int], nsamples: int, memory_fraction: float
+    ) -> int:
+        if batch_size is not None:
+            self.batch_size = batch_size
+        else:
+            self.batch_size = self.embedding.tuned_batch_size(
+                self.metadata,
+                nsamples,
+                self.embed_task_dir.parent.joinpath(".batch-sizes.json"),
+                memory_fraction,
+            )
+        return self.batch_size
+
+    def embed(
+        self,
+        audios: torch.Tensor,
+        filenames: List[str],
+        clip_lengths: torch.Tensor,
+        writes: BackgroundStage,
+    ):
+        """
+        Compute the embeddings of the files of a batch that this model still
+        needs, in batches of at most self.batch_size files, and submit them
+        to be written by writes.
+        """
+        assert self.batch_size is not None
+        # Replicas compute their own embeddings, see task_embeddings()
+        assert isinstance(self.embedding, Embedding)
+        start = time.perf_counter()
+        self.embedding.timer = self.timer
+        nclips = 0
+        nsamples = 0
+        for chunk_audios, chunk_filenames, chunk_lengths in batch_chunks(
+            audios, filenames, clip_lengths, self.remaining, self.batch_size
+        ):
+            embeddings, timestamps = compute_embeddings(
+                self.embedding,
+                self.cache,
+                self.metadata["embedding_type"],
+                chunk_audios,
+                self.window,
+                self.batch_size,
+                chunk_lengths,
+            )
+            self.submit(
+                embeddings,
+                timestamps,
+                chunk_filenames,
+                chunk_lengths,
+                chunk_audios.shape[1],
+                writes,
+            )
+            nclips += len(chunk_filenames)
+            nsamples += int(chunk_lengths.sum())
+        self.embedding.timer = None
+        if nclips:
+            self.add_batch(time.perf_counter() - start, nclips, nsamples)
+
+    def add_batch(self, latency: float, nclips: int, nsamples: int):
+        """
+        Record the latency of the model on a batch of nclips files with
+        nsamples samples of audio in total.
+        """
+        self.timer.add_batch(latency, nclips, nsamples / self.embedding.sample_rate)
+
+    def submit(
+        self,
+        embeddings: np.ndarray,
+        timestamps: Optional[np.ndarray],
+        filenames: List[str],
+        clip_lengths: torch.Tensor,
+        padded_length: int,
+        writes: BackgroundStage,
+    ):
+        """
+        Submit the computed embeddings of files to be written by writes.
+        """
+        if self.metadata["embedding_type"] == "scene":
+            writes.submit(self._write_scene, embeddings, filenames)
+        elif self.metadata["embedding_type"] == "event":
+            writes.submit(
+                self._write_timestamp,
+                embeddings,
+                timestamps,
+                filenames,
+                clip_lengths,
+                padded_length,
+            )
+        else:
+            raise ValueError(
+                f"Unknown embedding type: {self.metadata['embedding_type']}"
+            )
+
+    def _write_scene(self, embeddings: np.ndarray, filenames: List[str]):
+        labels = [self.split_data[file] for file in filenames]
+        with self.timer.stage("write"):
+            self.writer.write_scene(embeddings, labels, filenames)
+
+    def _write_timestamp(
+        self,
+        embeddings: np.ndarray,
+        timestamps: np.ndarray,
+        filenames: List[str],
+        clip_lengths: torch.Tensor,
+        padded_length: int,
+    ):
+        labels = [self.split_data[file] for file in filenames]
+        if any(clip_lengths < padded_length):
+            # Drop the frames of padding past the end of each file
+            with self.timer.stage("trim"):
+                embeddings, timestamps = trim_timestamp_embeddings(
+                    embeddings, timestamps, clip_lengths, self.embedding.sample_rate
+                )
+        with self.timer.stage("label_alignment"):
+            labels = get_labels_for_timestamps(labels, timestamps)
+        assert len(labels) == len(filenames)
+        assert len(labels[0]) == len(timestamps[0])
+        with self.timer.stage("write"):
+            self.writer.write_timestamp(embeddings, timestamps, labels, filenames)
+
+    def finish(self, prng: Optional[random.Random]):
+        """
+        Shuffle the split's embeddings into their final memmap, and mark
+        the split as done. Without a prng, e.g. for a shard of the split,
+        the unshuffled embeddings and their manifest are kept instead, to
+        be merged with the other shards by heareval.embeddings.shards.
+        """
+        with self.timer.stage("write"):
+            self.writer.close()
+        if self.cache is not None:
+            print(
+                f"Embedding cache for {self.name}: "
+                f"{self.cache.hits - self.cache_hits} hits, "
+                f"{self.cache.misses - self.cache_misses} misses"
+            )
+
+        if prng is not None:
+            with self.timer.stage("memmap"):
+                memmap_embeddings(
+                    self.writer,
+                    prng,
+                    self.metadata,
+                    self.split,
+                    self.embed_task_dir,
+                    self.split_data,
+                    storage_dtype=self.storage_dtype,
+                )
+        self.profile = self.timer.summary()
+        open(self.embed_task_dir.joinpath(f".done.{self.split}.embeddings"), "wt")
+
+
+def task_embeddings(
+    embeddings: Sequence[Union[Embedding, ReplicaEmbedding]],
+    task_path: Union[Path, PurePosixPath],
+    embed_task_dirs: List[Path],
+    caches: Optional[List[Optional[EmbeddingCache]]] = None,
+    batch_size: Optional[int] = None,
+    memory_fraction: float = 0.8,
+    max_padding: float = 0.1,
+    decode_workers: int = 0,
+    decode_worker_type: str = THREAD,
+    prefetch: int = 2,
+    pin_memory: bool = False,
+    archive: Optional[TaskArchive] = None,
+    max_pending_writes: int = 4,
+    replicas: Optional[ReplicaPool] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    storage_dtype: str = "float32",
+    window_seconds: Optional[float] = None,
+    window_overlap: float = 1.0,
+    precision_tolerance: float = 0.02,
+) -> List[Dict[str, Any]]:
+    """
+    Compute the embeddings for every split of a task, with one or more
+    models of the same sample rate. The audio is decoded once, and each
+    batch is fed to every model.
+
+    Returns the profile of each model, with the timings of every split it
+    computed embeddings for (see heareval.embeddings.profiling).
+
+    Args:
+        embeddings: the embedding models, or with replicas, their
+            ReplicaEmbeddings
+        task_path: the task directory, or the task's directory in archive
+        embed_task_dirs: directory to write the embeddings of each model to
+        caches: an optional embedding cache for each model to consult before
+            inference
+        batch_size: a fixed batch size. If None, the batch size of each model
+            is tuned to use memory_fraction of the GPU (or host) memory. For
+            tasks with variable-length audio, this is the batch size of the
+            longest file
+        memory_fraction: see batch_size
+        max_padding: for event tasks with variable-length audio, files in a
+            batch are at most this fraction longer than the shortest file
+        decode_workers: number of threads or processes decoding audio
+        decode_worker_type: "thread" or "process"
+        prefetch: number of batches to decode ahead of the model
+        pin_memory: return batches of audio in pinned memory
+        archive: read the task from this archive instead of a directory
+        max_pending_writes: most batches of embeddings waiting to be written,
+            after which the models wait for writing to catch up
+        replicas: compute the embeddings in these CPU worker processes, each
+            with its own replica of the models, instead of in this process
+        shard: (i, n) to only embed the i-th of n shards of each split, see
+            shard_split_data(). The shard's embeddings are left unshuffled,
+            to be merged by heareval.embeddings.shards
+        storage_dtype: dtype to store the embeddings as: float32, float16,
+            bfloat16 or int8, see heareval.embeddings.storage
+        window_seconds: for event tasks, compute the timestamp embeddings of
+            longer audio in windows of this many seconds, overlapping by
+            window_overlap seconds, see heareval.embeddings.windowing. The
+            batch size is then tuned for the window
+        window_overlap: see window_seconds
+        precision_tolerance: before embedding a task with a model in reduced
+            precision, refuse to continue if the relative RMS error of its
+            embeddings of a few clips is more than this, see
+            Embedding.check_precision
+    """
+    assert len(embeddings) == len(embed_task_dirs)
+    if caches is None:
+        caches = [None] * len(embeddings)
+    assert len(caches) == len(embeddings)
+    sample_rates = {embedding.sample_rate for embedding in embeddings}
+    if len(sample_rates) != 1:
+        raise ValueError(f"Models have different sample rates: {sample_rates}")
+    sample_rate = embeddings[0].sample_rate
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype: {storage_dtype}")
+
+    # The profile of every split each model computed embeddings for
+    profiles: List[Dict[str, Any]] = [{} for _ in embeddings]
+
+    # One prng per model, so that every model's embeddings are shuffled as
+    # if it was the only model
+    prngs = []
+    for _ in embeddings:
+        prng = random.Random()
+        prng.seed(0)
+        prngs.append(prng)
 
     # wandb.init(project="heareval", tags=["embedding", task_name])
 
     # Copy these two files to the embeddings directory,
     # so we have everything we need in embeddings for doing downstream
     # prediction and evaluation.
-    if not os.path.exists(embed_task_dir):
-        os.makedirs(embed_task_dir)
-    shutil.copy(metadata_path, embed_task_dir)
-    shutil.copy(label_vocab_path, embed_task_dir)
+    for embed_task_dir in embed_task_dirs:
+        if not os.path.exists(embed_task_dir):
+            os.makedirs(embed_task_dir)
+
+    def copy_to_embed_task_dirs(filename: str) -> Path:
+        path = copy_task_file(task_path, filename, embed_task_dirs[0], archive)
+        for embed_task_dir in embed_task_dirs[1:]:
+            shutil.copy(path, embed_task_dir)
+        return path
+
+    metadata_path = copy_to_embed_task_dirs("task_metadata.json")
+    metadata = json.load(metadata_path.open())
+    copy_to_embed_task_dirs("labelvocabulary.csv")
+    # Reduced precision is checked on the first split of the task
+    for embedding in embeddings:
+        embedding.precision_check = None
+
+    embed_window: Optional[Tuple[int, int]] = None
+    if window_seconds is not None and metadata["embedding_type"] == "event":
+        embed_window = (
+            int(round(window_seconds * sample_rate)),
+            int(round(window_overlap * sample_rate)),
+        )
+        # Check the window and overlap
+        window_starts(embed_window[0], *embed_window)
+    elif window_seconds is not None:
+        print("Scene embeddings are computed on whole clips, not in windows")
 
     for split in metadata["splits"]:
         print(f"Getting embeddings for split: {split}")
 
-        split_path = task_path.joinpath(f"{split}.json")
-        assert split_path.is_file()
-
         # Copy over the ground truth labels as they may be needed for evaluation
-        shutil.copy(split_path, embed_task_dir)
+        split_path = copy_to_embed_task_dirs(f"{split}.json")
+        split_data = json.load(split_path.open())
+        if shard is not None:
+            split_data = shard_split_data(split_data, *shard)
+
+        embedders: List[SplitEmbedder] = []
+        split_prngs: List[random.Random] = []
+        split_models: List[int] = []
+        for i, (embedding, embed_task_dir, cache, prng) in enumerate(
+            zip(embeddings, embed_task_dirs, caches, prngs)
+        ):
+            done_split = embed_task_dir.joinpath(f".done.{split}.embeddings")
+            if os.path.exists(done_split):
+                # A previous run already finished this split. Shuffle anyway, so
+                # that the prng is in the same state for the following splits.
+                prng.shuffle(list(split_data.keys()))
+                continue
+            embedders.append(
+                SplitEmbedder(
+                    embedding,
+                    cache,
+                    embed_task_dir,
+                    split,
+                    metadata,
+                    split_data,
+                    storage_dtype,
+                    embed_window,
+                )
+            )
+            split_prngs.append(prng)
+            split_models.append(i)
+        if not embedders:
+            continue
 
         # Root directory for audio files for this split
-        audio_dir = task_path.joinpath(str(embedding.sample_rate), split)
-
-        # TODO: We might consider skipping files that already
-        # have embeddings on disk, for speed.
-        # This was based upon futzing with various models
-        # on the dcase task.
-        # Unforunately, this is not tuned per model and is based upon the largest
-        # model and largest audio files we have.
+        audio_dir = task_path.joinpath(str(sample_rate), split)
+
+        # Batches are made from all the files of the split, so that a resumed
+        # run batches and pads every file exactly as a fresh run would. Only
+        # the batches with files that any of the models still needs are
+        # decoded, see below.
+        window: Optional[int] = None
+        worker_type = decode_worker_type
+        if archive is None:
+            dataset = get_audio_dataset(split_data, audio_dir, sample_rate)
+        else:
+            dataset = TarAudioDataset(split_data, archive, audio_dir, sample_rate)
+            if archive.compressed:
+                # Keep reads of the gzipped archive sequential: bucket files
+                # only within windows of files, and decode in threads sharing
+                # the dataset's reader rather than processes with one each.
+                window = READ_WINDOW
+                worker_type = THREAD
+                if decode_worker_type == PROCESS:
+                    print("Decoding a gzipped archive in threads, not processes")
+
+        for embedder in embedders:
+            if (
+                embedder.embedding.precision != "float32"
+                and embedder.embedding.precision_check is None
+                and len(dataset) > 0
+            ):
+                audios, _, _ = pad_collate(
+                    [
+                        dataset[i]
+                        for i in range(min(len(dataset), PRECISION_CHECK_CLIPS))
+                    ]
+                )
+                if embed_window is not None:
+                    audios = audios[:, : embed_window[0]]
+                embedder.embedding.check_precision(
+                    audios, metadata["embedding_type"], precision_tolerance
+                )
+
+        # Batches are decoded with the largest batch size of any of the
+        # models, and split into smaller batches for the other models.
         estimated_batch_size: int
+        batch_sampler: Optional[LengthBucketBatchSampler] = None
         if metadata["sample_duration"] is not None:
+            nsamples = int(round(metadata["sample_duration"] * sample_rate))
+            if embed_window is not None:
+                # The models only ever see one window at a time
+                nsamples = min(nsamples, embed_window[0])
+            for embedder in embedders:
+                embedder.tune_batch_size(batch_size, nsamples, memory_fraction)
+                print(
+                    f"Estimated batch size = {embedder.batch_size} "
+                    f"for {embedder.name}"
+                )
             estimated_batch_size = max(
-                1,
-                int(
-                    # 0.9
-                    # One of the submissions needs smaller batches
-                    0.7
-                    * (120 / metadata["sample_duration"])
-                    * (16000 / embedding.sample_rate)
-                ),
+                embedder.batch_size for embedder in embedders  # type: ignore
             )
         else:
-            # If the sample duration is None, we use a batch size of 1 as the audio
-            # files will of different length and the model cannot be run with
-            # batch size > 1
-            estimated_batch_size = 1
-        print(f"Estimated batch size = {estimated_batch_size}")
-        split_data = json.load(split_path.open())
-        dataloader = get_dataloader_for_embedding(
-            split_data, audio_dir, embedding, batch_size=estimated_batch_size
-        )
-
-        outdir = embed_task_dir.joinpath(split)
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-
-        for audios, filenames in tqdm(dataloader):
-            labels = [split_data[file] for file in filenames]
-
-            if metadata["embedding_type"] == "scene":
-                embeddings = embedding.get_scene_embedding_as_numpy(audios)
-                save_scene_embedding_and_labels(embeddings, labels, filenames, outdir)
-
-            elif metadata["embedding_type"] == "event":
-                embeddings, timestamps = embedding.get_timestamp_embedding_as_numpy(
-                    audios
-                )
-                labels = get_labels_for_timestamps(labels, timestamps)
-                assert len(labels) == len(filenames)
-                assert len(labels[0]) == len(timestamps[0])
-                save_timestamp_embedding_and_labels(
-                    embeddings, timestamps, labels, filenames, outdir
+            # If the sample duration is None, the audio files have different
+            # lengths. Batch together files of similar length, with a batch size
+            # that fits the longest file.
+            lengths = dataset.lengths()
+            max_length = max(lengths, default=1)
+            if embed_window is not None:
+                # A batch has about as many windows as its batch size. Files
+                # longer than that are batched alone.
+                max_length = min(max_length, embed_window[0])
+            for embedder in embedders:
+                embedder.tune_batch_size(batch_size, max_length, memory_fraction)
+            estimated_batch_size = max(
+                embedder.batch_size for embedder in embedders  # type: ignore
+            )
+            batch_sampler = LengthBucketBatchSampler(
+                lengths,
+                max_samples=estimated_batch_size * max_length,
+                # Scene embeddings of padded audio can't be trimmed,
+                # so only batch together scene files of equal length
+                max_padding=max_padding if metadata["embedding_type"] == "event" else 0,
+                window=window,
+            )
+            for embedder in embedders:
+                print(
+                    f"Estimated batch size = {embedder.batch_size} for the longest "
+                    f"file for {embedder.name}"
                 )
+            print(f"{len(batch_sampler)} batches of files of similar length")
 
+        # The indices of the files of every batch
+        if batch_sampler is not None:
+            batches = list(batch_sampler)
+        else:
+            batches = [
+                list(range(start, min(start + estimated_batch_size, len(dataset))))
+                for start in range(0, len(dataset), estimated_batch_size)
+            ]
+        # Skip the batches that a previous, interrupted run already embedded.
+        # The files of a partly embedded batch are decoded with the rest of
+        # the batch, and the models skip them.
+        remaining = set().union(*(embedder.remaining for embedder in embedders))
+        batches = [
+            batch
+            for batch in batches
+            if any(dataset.filenames[i] in remaining for i in batch)
+        ]
+        # Throughput is timed from here, after tuning batch sizes and checking
+        # precision
+        for embedder in embedders:
+            embedder.timer.end_setup()
+
+        if replicas is None:
+            local_embeddings: List[Embedding] = []
+            for embedder in embedders:
+                assert isinstance(embedder.embedding, Embedding)
+                local_embeddings.append(embedder.embedding)
+            loader: Iterable
+            if all(embedding.type == TENSORFLOW for embedding in local_embeddings):
+                # Decode with tf.data rather than torch, for tensorflow models
+                loader = TFDataLoader(dataset, batches, decode_workers, prefetch)
             else:
-                raise ValueError(
-                    f"Unknown embedding type: {metadata['embedding_type']}"
+                loader = get_dataloader_for_embedding(
+                    dataset,
+                    local_embeddings[0],
+                    batch_size=estimated_batch_size,
+                    batch_sampler=batches,
+                    num_workers=decode_workers,
+                    worker_type=worker_type,
+                    prefetch=prefetch,
+                    pin_memory=pin_memory,
                 )
+            if embed_window is None and all(
+                embedding.type == TORCH
+                and embedding.device == "cuda"
+                and embedder.cache is None
+                for embedding, embedder in zip(local_embeddings, embedders)
+            ):
+                # Copy the next batch to the GPU while the models run on this
+                # one. (The cache needs the audio on the host, and windows
+                # are cut on the host.)
+                loader = DevicePrefetcher(loader, local_embeddings[0].transfer)
+            loader_timer = LoaderTimer(loader)
+            progress = tqdm(loader_timer)
+            with BackgroundStage(max_pending_writes) as writes:
+                for audios, filenames, clip_lengths in progress:
+                    for embedder in embedders:
+                        embedder.embed(audios, filenames, clip_lengths, writes)
+                    progress.set_postfix_str(loader_timer.summary(), refresh=False)
+            for embedder in embedders:
+                embedder.timer.add("decode", loader_timer.decode_time)
+        else:
+            # The replicas decode their own shard of the batches and run every
+            # model on them. Here, the "decode" time is waiting for replicas.
+            models = [
+                (embedder.name, embedder.batch_size, embedder.remaining)
+                for embedder in embedders
+            ]
+            replica_batches = replicas.embed_batches(
+                dataset, batches, metadata["embedding_type"], models, embed_window
+            )
+            loader_timer = LoaderTimer(replica_batches)
+            progress = tqdm(loader_timer, total=len(batches))
+            try:
+                with BackgroundStage(max_pending_writes) as writes:
+                    for decode_time, outputs in progress:
+                        for embedder, output in zip(embedders, outputs):
+                            chunks, cache_counts, times, latency = output
+                            for chunk in chunks:
+                                embedder.submit(*chunk, writes)
+                            if cache_counts is not None:
+                                embedder.cache.hits += cache_counts[0]
+                                embedder.cache.misses += cache_counts[1]
+                            embedder.timer.add("decode", decode_time)
+                            embedder.timer.add_times(times)
+                            if chunks:
+                                embedder.add_batch(
+                                    latency,
+                                    sum(len(chunk[2]) for chunk in chunks),
+                                    sum(int(chunk[3].sum()) for chunk in chunks),
+                                )
+                        progress.set_postfix_str(loader_timer.summary(), refresh=False)
+            finally:
+                # If this failed, stop the replicas, which are still computing
+                # the rest of the batches
+                replica_batches.close()
+        print(f"Split {split} was {loader_timer.summary()}")
+        print(
+            f"Inference {loader_timer.compute_time - writes.blocked_time:.1f}s, "
+            f"{writes.summary()}"
+        )
+
+        for embedder, prng, i in zip(embedders, split_prngs, split_models):
+            embedder.finish(prng if shard is None else None)
+            profiles[i][split] = embedder.profile
 
-        memmap_embeddings(outdir, prng, metadata, split, embed_task_dir, split_data)
+    return profiles
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+A tensorflow-native path for tensorflow embedding models.
+
+TracedModel wraps a model's get_scene_embeddings and
+get_timestamp_embeddings in tf.function, traced once for an input
+signature of float32 audio of any batch size and length, so that new
+batch shapes (e.g. the last, shorter batch) don't retrace the model.
+Models that can't be traced without static shapes are instead traced
+for each audio length, with short batches zero-padded to the largest
+batch of that length, so that only new lengths are traced. Models that
+can't be traced at all, or whose traced functions fail, are called
+eagerly instead, as they are with trace=False.
+
+TFDataLoader decodes batches of audio with a tf.data pipeline, in
+parallel and ahead of the model, instead of a torch DataLoader.
+
+tensorflow is only imported once these are used.
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from heareval.embeddings.batch_size import is_out_of_memory
+from heareval.embeddings.bucketing import pad_collate
+
+
+class TracedModel:
+    """
+    The embedding functions of a tensorflow model's module, traced with
+    tf.function. Call scene(audio) or timestamp(audio) with a float32
+    tensor of shape (batch size, length).
+
+    Args:
+        trace: if False, call the embedding functions eagerly
+    """
+
+    def __init__(self, module: Any, model: Any, trace: bool = True):
+        self.module = module
+        self.model = model
+        self.functions: Dict[str, Callable] = {}
+        # The kinds of embedding that are called eagerly
+        self.eager: Set[str] = set() if trace else {"scene", "timestamp"}
+        # Whether each kind of embedding is traced for each audio length
+        self.static_shapes: Dict[str, bool] = {}
+        # (kind, length) -> largest batch size so far
+        self.batch_sizes: Dict[Tuple[str, int], int] = {}
+
+    def _function(self, kind: str) -> Callable:
+        if kind in self.functions:
+            return self.functions[kind]
+        import tensorflow as tf
+
+        get_embeddings = getattr(self.module, f"get_{kind}_embeddings")
+
+        def embed(audio):
+            return get_embeddings(audio, self.model)
+
+        function = tf.function(
+            embed, input_signature=[tf.TensorSpec([None, None], tf.float32)]
+        )
+        try:
+            function.get_concrete_function()
+            self.static_shapes[kind] = False
+        except Exception as e:
+            print(
+                f"{self.module.__name__}.get_{kind}_embeddings can't be traced for "
+                f"audio of any shape ({e}), tracing it for each audio length"
+            )
+            function = tf.function(embed)
+            self.static_shapes[kind] = True
+        self.functions[kind] = function
+        return function
+
+    def _call_eagerly(self, kind: str, audio) -> Any:
+        get_embeddings = getattr(self.module, f"get_{kind}_embeddings")
+        return get_embeddings(audio, self.model)
+
+    def _call_traced(self, kind: str, audio) -> Any:
+        import tensorflow as tf
+
+        function = self._function(kind)
+        if not self.static_shapes[kind]:
+            return function(audio)
+
+        nclips, length = audio.shape
+        batch_size = max(self.batch_sizes.get((kind, length), 0), nclips)
+        self.batch_sizes[(kind, length)] = batch_size
+        if batch_size > nclips:
+            audio = tf.pad(audio, [[0, batch_size - nclips], [0, 0]])
+        return tf.nest.map_structure(lambda x: x[:nclips], function(audio))
+
+    def _call(self, kind: str, audio) -> Any:
+        if kind in self.eager:
+            return self._call_eagerly(kind, audio)
+        try:
+            return self._call_traced(kind, audio)
+        except Exception as e:
+            # Running out of memory is handled by reducing the batch size
+            if is_out_of_memory(e):
+                raise
+            print(
+                f"{self.module.__name__}.get_{kind}_embeddings failed with "
+                f"tf.function ({type(e).__name__}: {e}), calling it eagerly"
+            )
+            self.eager.add(kind)
+            return self._call_eagerly(kind, audio)
+
+    def scene(self, audio) -> Any:
+        return self._call("scene", audio)
+
+    def timestamp(self, audio) -> Any:
+        return self._call("timestamp", audio)
+
+
+class TFDataLoader:
+    """
+    Decodes batches of (audio, filename) items of a dataset with a tf.data
+    pipeline, as (audio, filenames, clip lengths) batches like pad_collate.
+    Batches are decoded in order by num_parallel_calls threads, up to
+    prefetch batches ahead.
+
+    Args:
+        batches: the indices of the items of each batch
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batches: List[List[int]],
+        num_parallel_calls: int,
+        prefetch: int,
+    ):
+        self.dataset = dataset
+        self.batches = batches
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def _decode(self, i: np.int64) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        audios, filenames, clip_lengths = pad_collate(
+            [self.dataset[j] for j in self.batches[int(i)]]
+        )
+        return (
+            audios.numpy(),
+            np.array([filename.encode("utf-8") for filename in filenames]),
+            clip_lengths.numpy().astype(np.int64),
+        )
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, List[str], torch.Tensor]]:
+        import tensorflow as tf
+
+        batches = tf.data.Dataset.range(len(self.batches)).map(
+            lambda i: tf.numpy_function(
+                self._decode, [i], [tf.float32, tf.string, tf.int64]
+            ),
+            num_parallel_calls=max(self.num_parallel_calls, 1),
+            deterministic=True,
+        )
+        for audios, filenames, clip_lengths in batches.prefetch(
+            self.prefetch
+        ).as_numpy_iterator():
+            # Arrays from tensorflow may be read-only
+            if not audios.flags.writeable:
+                audios = audios.copy()
+            yield (
+                torch.from_numpy(audios),
+                [filename.decode("utf-8") for filename in filenames],
+                torch.tensor(clip_lengths),
+            )
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Moving batches of audio to a model's device with as few copies as
+possible.
+
+On CPU, arrays are handed to torch with torch.from_numpy, without a
+copy. On GPU, audio that is not already in pinned memory is staged in
+pinned buffers that are reused across batches (two by default, so one
+can be filled while the other is being copied), and copied on a side
+stream. DevicePrefetcher starts the copy of the next batch before the
+models run on the current one, so that the copy overlaps with compute.
+
+Tensorflow models get torch tensors through DLPack, which shares their
+memory, falling back to a single copy.
+"""
+
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+
+class DeviceTransfer:
+    """
+    Copies audio to device, through nbuffers reusable pinned staging
+    buffers when it is a GPU.
+    """
+
+    def __init__(self, device: str, nbuffers: int = 2):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.buffers: List[Optional[torch.Tensor]] = [None] * nbuffers
+        # The copy out of each buffer that must finish before it is refilled
+        self.copies: List[Optional[torch.cuda.Event]] = [None] * nbuffers
+        self.next_buffer = 0
+
+    def _stage(self, x: torch.Tensor) -> Tuple[torch.Tensor, int]:
+        """
+        Copy x into the next pinned staging buffer.
+        """
+        k = self.next_buffer
+        self.next_buffer = (k + 1) % len(self.buffers)
+        copy = self.copies[k]
+        if copy is not None:
+            copy.synchronize()
+        buffer = self.buffers[k]
+        if buffer is None or buffer.dtype != x.dtype or buffer.numel() < x.numel():
+            buffer = torch.empty(x.numel(), dtype=x.dtype, pin_memory=True)
+            self.buffers[k] = buffer
+        staged = buffer[: x.numel()].view(x.shape)
+        staged.copy_(x)
+        return staged, k
+
+    def start(
+        self, x: Union[np.ndarray, torch.Tensor]
+    ) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """
+        Start copying x to the device. Returns the tensor on the device,
+        and on GPU the event to wait() for before using it.
+        """
+        if isinstance(x, np.ndarray):
+            # Shares memory with the array, unless it is read-only
+            x = torch.from_numpy(x if x.flags.writeable else x.copy())
+        elif not isinstance(x, torch.Tensor):
+            raise TypeError(
+                "Input must be one of np.ndarray or torch.Tensor for "
+                f"torch audio embedding models. Received: {type(x)}"
+            )
+        if not self.cuda or x.device.type == "cuda":
+            return x.to(self.device), None
+
+        assert self.stream is not None
+        buffer = None
+        if not x.is_pinned():
+            x, buffer = self._stage(x)
+        with torch.cuda.stream(self.stream):
+            on_device = x.to(self.device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        if buffer is not None:
+            self.copies[buffer] = copied
+        return on_device, copied
+
+    @staticmethod
+    def wait(
+        on_device: torch.Tensor, copied: Optional[torch.cuda.Event]
+    ) -> torch.Tensor:
+        """
+        Make the current stream wait for a copy started by start().
+        """
+        if copied is not None:
+            torch.cuda.current_stream().wait_event(copied)
+            # Allocated on the side stream, but used on the current one
+            on_device.record_stream(torch.cuda.current_stream())
+        return on_device
+
+    def to_device(self, x: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+        return self.wait(*self.start(x))
+
+
+class DevicePrefetcher:
+    """
+    Wraps a loader of (audio, filenames, clip lengths) batches to yield
+    them with their audio on the device, copying the audio of the next
+    batch while the current one is used.
+    """
+
+    def __init__(self, loader: Iterable, transfer: DeviceTransfer):
+        self.loader = loader
+        self.transfer = transfer
+
+    def __len__(self) -> int:
+        return len(self.loader)  # type: ignore
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, List[str], torch.Tensor]]:
+        pending = None
+        for audios, filenames, clip_lengths in self.loader:
+            started = self.transfer.start(audios)
+            if pending is not None:
+                yield self._ready(*pending)
+            pending = (started, filenames, clip_lengths)
+        if pending is not None:
+            yield self._ready(*pending)
+
+    def _ready(self, started, filenames, clip_lengths):
+        return self.transfer.wait(*started), filenames, clip_lengths
+
+
+def to_tensorflow(x: Union[np.ndarray, torch.Tensor]):
+    """
+    A tensorflow tensor of x, sharing the memory of torch tensors through
+    DLPack when tensorflow supports it.
+    """
+    import tensorflow as tf
+
+    if isinstance(x, torch.Tensor):
+        x = x.detach().contiguous()
+        try:
+            return tf.experimental.dlpack.from_dlpack(torch.utils.dlpack.to_dlpack(x))
+        except (AttributeError, ValueError, tf.errors.OpError):
+            # e.g. older tensorflow, or memory tensorflow can't share
+            x = x.cpu().numpy()
+    return tf.convert_to_tensor(x)
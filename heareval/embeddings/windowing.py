@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Timestamp embeddings of long audio, computed window by window.
+
+Running a model on a whole hour-long recording needs activations for the
+whole recording. Instead, audio longer than the window is cut into
+fixed-length windows that overlap by `overlap` samples, and the windows
+(of every clip in the batch) are fed to the model in batches. The
+timestamps of each window are offset by the window's start, and the
+embeddings of the windows are stitched back together.
+
+Frames near the edges of a window see less context, so in each overlap
+the frames of the first half come from the earlier window, and the frames
+of the second half from the later window. Every timestamp is kept
+exactly once. For the timestamps to match those of the whole clip, the
+window and overlap should be multiples of the model's hop size.
+"""
+
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+
+
+def window_starts(length: int, window: int, overlap: int) -> List[int]:
+    """
+    The start of every window of audio of this length, the last of which
+    ends at or past the end of the audio.
+    """
+    if not 0 <= overlap < window:
+        raise ValueError(f"Overlap {overlap} should be less than the window {window}")
+    hop = window - overlap
+    starts = [0]
+    while starts[-1] + window < length:
+        starts.append(starts[-1] + hop)
+    return starts
+
+
+def windowed_timestamp_embeddings(
+    get_embedding: Callable[[torch.Tensor], Tuple[np.ndarray, np.ndarray]],
+    audios: torch.Tensor,
+    window: int,
+    overlap: int,
+    sample_rate: int,
+    batch_size: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Timestamp embeddings and timestamps of a batch of audio, computed by
+    get_embedding on batches of at most batch_size windows. Audio no longer
+    than the window is passed to get_embedding as is.
+    """
+    nclips, length = audios.shape
+    if length <= window:
+        return get_embedding(audios)
+
+    starts = window_starts(length, window, overlap)
+    # Timestamps are in milliseconds
+    starts_ms = [start / sample_rate * 1000 for start in starts]
+    end_ms = length / sample_rate * 1000
+    half_overlap_ms = overlap / 2 / sample_rate * 1000
+    # The range of timestamps kept from each window
+    keep_from = [0.0] + [start + half_overlap_ms for start in starts_ms[1:]]
+    keep_until = keep_from[1:] + [np.inf]
+
+    # Every (clip, window), in order
+    windows = [(i, k) for i in range(nclips) for k in range(len(starts))]
+    clip_embeddings: List[List[np.ndarray]] = [[] for _ in range(nclips)]
+    clip_timestamps: List[List[np.ndarray]] = [[] for _ in range(nclips)]
+    for batch_start in range(0, len(windows), batch_size):
+        batch = windows[batch_start : batch_start + batch_size]
+        # The last window is zero-padded past the end of the audio
+        window_audios = torch.zeros((len(batch), window), dtype=audios.dtype)
+        for j, (i, k) in enumerate(batch):
+            chunk = audios[i, starts[k] : starts[k] + window]
+            window_audios[j, : len(chunk)] = chunk
+        embeddings, timestamps = get_embedding(window_audios)
+        for j, (i, k) in enumerate(batch):
+            window_timestamps = timestamps[j] + starts_ms[k]
+            keep = (
+                (window_timestamps >= keep_from[k])
+                & (window_timestamps < keep_until[k])
+                & (window_timestamps <= end_ms)
+            )
+            clip_embeddings[i].append(embeddings[j][keep])
+            clip_timestamps[i].append(window_timestamps[keep])
+
+    # Every clip of the batch has the same (padded) length, so the same
+    # number of frames
+    return (
+        np.stack([np.concatenate(e) for e in clip_embeddings]),
+        np.stack([np.concatenate(t) for t in clip_timestamps]),
+    )
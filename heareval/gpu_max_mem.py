@@ -1,62 +1,70 @@
 #!/usr/bin/env python3
 """
 Profile GPU maximum memory usage.
+
+GPUs are probed (which imports torch and initializes NVML) the first
+time a function here is called, rather than when this module is imported.
 """
 
 from typing import Optional
 
-import torch
+_gpu_available: Optional[bool] = None
+max_memory_used: Optional[float] = None
 
-if torch.cuda.is_available():
-    if torch.cuda.device_count() > 1:
-        print("WARNING: gpu_max_mem measures the *first* GPU, but you have several.")
 
-    from pynvml import (
-        NVMLError,
-        nvmlDeviceGetHandleByIndex,
-        nvmlDeviceGetMemoryInfo,
-        nvmlDeviceGetName,
-        nvmlInit,
-    )
+def gpu_available() -> bool:
+    global _gpu_available
+    if _gpu_available is None:
+        import torch
 
-    nvmlInit()
+        _gpu_available = torch.cuda.is_available()
+        if _gpu_available:
+            if torch.cuda.device_count() > 1:
+                print(
+                    "WARNING: gpu_max_mem measures the *first* GPU, but you have "
+                    "several."
+                )
 
-    max_memory_used: Optional[float] = None
+            from pynvml import nvmlInit
 
-    def reset():
-        global max_memory_used
-        max_memory_used = None
+            nvmlInit()
+    return _gpu_available
 
-    def measure() -> Optional[float]:
-        """
-        Measure max memory used ONLY for the first GPU.
-        """
-        global max_memory_used
-        if torch.cuda.is_available():
-            try:
-                h = nvmlDeviceGetHandleByIndex(0)
-                info = nvmlDeviceGetMemoryInfo(h)
-                # Convert to GB
-                memory_used: float = info.used / 1024 / 1024 / 1024
-                if max_memory_used is None or memory_used > max_memory_used:
-                    max_memory_used = memory_used
-            except NVMLError:
-                # Happens on Ubuntu 20.04 running on WSL2.
-                pass
-        return max_memory_used
 
-    def device_name(device_index: int = 0) -> str:
-        handle = nvmlDeviceGetHandleByIndex(device_index)
-        return nvmlDeviceGetName(handle).decode("utf-8")
+def reset():
+    global max_memory_used
+    max_memory_used = None
 
 
-else:
+def measure() -> Optional[float]:
+    """
+    Measure max memory used ONLY for the first GPU.
+    """
+    global max_memory_used
+    if gpu_available():
+        from pynvml import (
+            NVMLError,
+            nvmlDeviceGetHandleByIndex,
+            nvmlDeviceGetMemoryInfo,
+        )
 
-    def reset():
-        pass
+        try:
+            h = nvmlDeviceGetHandleByIndex(0)
+            info = nvmlDeviceGetMemoryInfo(h)
+            # Convert to GB
+            memory_used: float = info.used / 1024 / 1024 / 1024
+            if max_memory_used is None or memory_used > max_memory_used:
+                max_memory_used = memory_used
+        except NVMLError:
+            # Happens on Ubuntu 20.04 running on WSL2.
+            pass
+    return max_memory_used
 
-    def measure() -> Optional[float]:
-        return None
 
-    def device_name(device_index: int = 0) -> str:
+def device_name(device_index: int = 0) -> str:
+    if not gpu_available():
         return "cpu"
+    from pynvml import nvmlDeviceGetHandleByIndex, nvmlDeviceGetName
+
+    handle = nvmlDeviceGetHandleByIndex(device_index)
+    return nvmlDeviceGetName(handle).decode("utf-8")
@@ -2,6 +2,9 @@
 """
 Downstream training, using embeddings as input features and learning
 predictions.
+
+torch and the training libraries are only imported once there is a task
+to compute predictions for.
 """
 
 import json
@@ -13,12 +16,10 @@ from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
 import click
-import torch
 from tqdm import tqdm
 
 import heareval.gpu_max_mem as gpu_max_mem
-from heareval.predictions.task_predictions import task_predictions
-
+from heareval.resources import ResourceSampler
 
 # Cache this so the logger object isn't recreated,
 # and we get accurate "relativeCreated" times.
@@ -63,7 +64,7 @@ def get_logger(task_name: str, log_path: Path) -> logging.Logger:
 )
 @click.option(
     "--gpus",
-    default=None if not torch.cuda.is_available() else "[0]",
+    default=None,
     help='GPUs to use, as JSON string (default: "[0]" if any '
     "are available, none if not). "
     "See https://pytorch-lightning.readthedocs.io/en/stable/advanced/multi_gpu.html#select-gpu-devices",  # noqa
@@ -93,15 +94,25 @@ def get_logger(task_name: str, log_path: Path) -> logging.Logger:
     help="Shuffle tasks? (Default: False)",
     type=click.BOOL,
 )
+@click.option(
+    "--sample-interval",
+    default=1.0,
+    help="Seconds between samples of GPU memory, RSS, CPU and I/O, saved in "
+    "resources.predictions.json for each task. 0 to not sample. (Default: 1)",
+    type=float,
+)
 def runner(
     task_dirs: List[str],
     grid_points: int = 8,
-    gpus: Any = None if not torch.cuda.is_available() else "[0]",
+    gpus: Any = None,
     in_memory: bool = True,
     deterministic: bool = True,
     grid: str = "default",
     shuffle: bool = False,
+    sample_interval: float = 1.0,
 ) -> None:
+    # If gpus is not given, GPUs are probed when the first task is run
+    probe_gpus = gpus is None
     if gpus is not None:
         gpus = json.loads(gpus)
 
@@ -134,8 +145,18 @@ def runner(
         if len(set(embedding_sizes)) != 1:
             raise ValueError("Embedding dimension mismatch among JSON files")
 
+        # Imported here, because it imports all the training libraries
+        from heareval.predictions.task_predictions import task_predictions
+
+        if probe_gpus:
+            gpus = [0] if gpu_max_mem.gpu_available() else None
+            probe_gpus = False
+
         start = time.time()
         gpu_max_mem.reset()
+        sampler = ResourceSampler(sample_interval) if sample_interval > 0 else None
+        if sampler is not None:
+            sampler.start()
 
         task_predictions(
             embedding_path=task_path,
@@ -149,6 +170,9 @@ def runner(
         )
         sys.stdout.flush()
         gpu_max_mem_used = gpu_max_mem.measure()
+        if sampler is not None:
+            sampler.stop()
+            sampler.save(task_path.joinpath("resources.predictions.json"))
         logger.info(
             f"DONE took {time.time() - start} seconds to complete task_predictions"
             f"(embedding_path={task_path}, embedding_size={embedding_size}, "
@@ -41,10 +41,16 @@ from sklearn.model_selection import ParameterGrid
 from torch.utils.data import ConcatDataset, DataLoader, Dataset
 from tqdm.auto import tqdm
 
+from heareval.embeddings.sidecars import (
+    FrameMetadata,
+    load_filename_timestamps,
+    load_labels,
+)
+from heareval.embeddings.storage import EmbeddingStorage
+from heareval.embeddings.store import EmbeddingStore, store_path
 from heareval.score import (
     ScoreFunction,
     available_scores,
-    label_to_binary_vector,
     label_vocab_as_dict,
     validate_score_return_type,
 )
@@ -536,6 +542,13 @@ class SplitMemmapDataset(Dataset):
     """
     Embeddings are memmap'ed, unless in-memory = True.
 
+    Embeddings stored in reduced precision (see heareval.embeddings.storage)
+    are kept in reduced precision, in memory or on disk, and dequantized
+    to float32 as they are read.
+
+    If the split has a {split}.embeddings.store (see
+    heareval.embeddings.store), it is read instead of the memmap.
+
     WARNING: Don't shuffle this or access will be SLOW.
     """
 
@@ -560,38 +573,41 @@ class SplitMemmapDataset(Dataset):
                 open(embedding_path.joinpath(f"{split_name}.embedding-dimensions.json"))
             )
         )
-        self.embeddings = np.memmap(
-            filename=embedding_path.joinpath(f"{split_name}.embeddings.npy"),
-            dtype=np.float32,
-            mode="r",
-            shape=self.dim,
-        )
-        if in_memory:
+        if store_path(embedding_path, split_name).exists():
+            store = EmbeddingStore(store_path(embedding_path, split_name))
+            assert store.shape == self.dim
+            self.storage = store.storage
+            # Decompress the whole store at once, in parallel
+            self.embeddings = store.read_all() if in_memory else store
+        else:
+            self.storage = EmbeddingStorage.load(embedding_path, split_name)
+            self.embeddings = np.memmap(
+                filename=embedding_path.joinpath(f"{split_name}.embeddings.npy"),
+                dtype=self.storage.numpy_dtype,
+                mode="r",
+                shape=self.dim,
+            )
+        if in_memory and self.storage.dtype != "float32":
+            # np.asarray would keep a memmap, and read it from disk every epoch
+            if isinstance(self.embeddings, np.memmap):
+                self.embeddings = np.array(self.embeddings)
+        elif in_memory:
             self.embeddings = torch.stack(
                 [torch.tensor(e) for e in tqdm(self.embeddings)]
             )
             nandim = self.embeddings.isnan().sum().tolist()
             infdim = self.embeddings.isinf().sum().tolist()
             assert nandim == 0 and infdim == 0
-        self.labels = pickle.load(
-            open(embedding_path.joinpath(f"{split_name}.target-labels.pkl"), "rb")
-        )
+        self.labels = load_labels(embedding_path, split_name)
         # Only used for event-based prediction, for validation and test scoring,
         # For timestamp (event) embedding tasks,
         # the metadata for each instance is {filename: , timestamp: }.
+        self.metadata: Optional[FrameMetadata] = None
         if self.embedding_type == "event" and metadata:
-            filename_timestamps_json = embedding_path.joinpath(
-                f"{split_name}.filename-timestamps.json"
-            )
-            self.metadata = [
-                {"filename": filename, "timestamp": timestamp}
-                for filename, timestamp in json.load(open(filename_timestamps_json))
-            ]
-        else:
-            self.metadata = [{}] * self.dim[0]
+            self.metadata = load_filename_timestamps(embedding_path, split_name)
+            assert len(self.labels) == len(self.metadata)
         assert len(self.labels) == self.dim[0]
         assert len(self.labels) == len(self.embeddings)
-        assert len(self.labels) == len(self.metadata)
         assert self.embeddings[0].shape[0] == self.dim[1]
 
         """
@@ -599,19 +615,29 @@ class SplitMemmapDataset(Dataset):
         This allows us to have tensors that are all the same shape.
         Later we reduce this with an argmax to get the vocabulary indices.
         """
-        ys = []
-        for idx in tqdm(range(len(self.labels))):
-            labels = [self.label_to_idx[str(label)] for label in self.labels[idx]]
-            y = label_to_binary_vector(labels, self.nlabels)
-            ys.append(y)
-        self.y = torch.stack(ys)
-        assert self.y.shape == (len(self.labels), self.nlabels)
+        # The vocabulary index of every distinct label of the split
+        vocabulary_ids = np.array(
+            [self.label_to_idx[str(label)] for label in self.labels.names],
+            dtype=np.int64,
+        )
+        self.y = torch.zeros((len(self.labels), self.nlabels))
+        self.y[
+            torch.from_numpy(self.labels.rows()),
+            torch.from_numpy(vocabulary_ids[self.labels.ids]),
+        ] = 1.0
 
     def __len__(self) -> int:
         return self.dim[0]
 
     def __getitem__(self, idx) -> Tuple[torch.Tensor, torch.Tensor, Dict[str, Any]]:
-        return self.embeddings[idx], self.y[idx], self.metadata[idx]
+        metadata: Dict[str, Any] = {}
+        if self.metadata is not None:
+            filename, timestamp = self.metadata[idx]
+            metadata = {"filename": filename, "timestamp": timestamp}
+        if self.storage.dtype != "float32":
+            embedding = torch.from_numpy(self.storage.decode(self.embeddings[idx]))
+            return embedding, self.y[idx], metadata
+        return self.embeddings[idx], self.y[idx], metadata
 
 
 def create_events_from_prediction(
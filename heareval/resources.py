@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Sample resource usage in a background thread.
+
+Every interval seconds, a ResourceSampler records:
+    * the memory used on every visible GPU (from NVML)
+    * the RSS of this process, and of all its child processes (e.g.
+      DataLoader workers or CPU replicas)
+    * the CPU utilization of this process and its children, and of the
+      whole host
+    * the bytes read and written by this process and its children since
+      sampling started, including children that have since exited
+
+Unlike gpu_max_mem, which reads the first GPU when measure() is called,
+samples are taken regardless of what the main thread is doing. On hosts
+without GPUs (or without NVML), samples have the same fields, with no
+GPUs.
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psutil
+
+GB = 1024 * 1024 * 1024
+
+
+def _nvml_handles() -> List[Any]:
+    """
+    NVML handles of every visible GPU, or none if NVML is unavailable.
+    """
+    try:
+        from pynvml import (
+            NVMLError,
+            nvmlDeviceGetCount,
+            nvmlDeviceGetHandleByIndex,
+            nvmlInit,
+        )
+    except ImportError:
+        return []
+    try:
+        nvmlInit()
+        return [nvmlDeviceGetHandleByIndex(i) for i in range(nvmlDeviceGetCount())]
+    except NVMLError:
+        return []
+
+
+class ResourceSampler:
+    """
+    Samples resource usage every interval seconds, from start() until
+    stop(), or within a with block.
+
+    Args:
+        interval: seconds between samples
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.gpus = _nvml_handles()
+        self.timeline: List[Dict[str, Any]] = []
+        self.peak: Dict[str, Any] = {}
+        self.start_time = time.time()
+        self.start_io: Optional[List[int]] = None
+        # Processes seen so far, by pid, see _cpu_percent()
+        self._known: Dict[int, psutil.Process] = {}
+        # Last I/O counters and parent pid of every running process, and
+        # the I/O of exited children, see _io_bytes()
+        self._io: Dict[psutil.Process, Tuple[int, int]] = {}
+        self._ppid: Dict[psutil.Process, int] = {}
+        self._exited_io = [0, 0]
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _processes(self) -> List[psutil.Process]:
+        try:
+            return [self.process] + self.process.children(recursive=True)
+        except psutil.Error:
+            return [self.process]
+
+    def _io_bytes(self, processes: List[psutil.Process]) -> Optional[List[int]]:
+        # io_counters is not available on every platform, e.g. macOS
+        if not hasattr(self.process, "io_counters"):
+            return None
+        for process in processes:
+            try:
+                io = process.io_counters()
+                if process not in self._ppid:
+                    self._ppid[process] = process.ppid()
+            except psutil.Error:
+                continue
+            self._io[process] = (io.read_bytes, io.write_bytes)
+        # Keep the last counters of children that have exited. On Linux,
+        # a child's counters are added to its parent's when it is reaped,
+        # so they are dropped instead if its parent is still running.
+        running = set(self._processes())
+        running_pids = {process.pid for process in running}
+        for process in list(self._io):
+            if process in running:
+                continue
+            read_bytes, write_bytes = self._io.pop(process)
+            ppid = self._ppid.pop(process, None)
+            if not (psutil.LINUX and ppid in running_pids):
+                self._exited_io[0] += read_bytes
+                self._exited_io[1] += write_bytes
+        read_bytes, write_bytes = self._exited_io
+        for io in self._io.values():
+            read_bytes += io[0]
+            write_bytes += io[1]
+        return [read_bytes, write_bytes]
+
+    def _cpu_percent(self, processes: List[psutil.Process]) -> float:
+        # The first call for a process is always 0, after which it is the
+        # utilization since the previous call, so cache the Process objects.
+        percent = 0.0
+        for process in processes:
+            process = self._known.setdefault(process.pid, process)
+            try:
+                percent += process.cpu_percent()
+            except psutil.Error:
+                pass
+        return percent
+
+    def _gpu_memory(self) -> List[float]:
+        if not self.gpus:
+            return []
+        from pynvml import NVMLError, nvmlDeviceGetMemoryInfo
+
+        memory = []
+        for handle in self.gpus:
+            try:
+                memory.append(nvmlDeviceGetMemoryInfo(handle).used / GB)
+            except NVMLError:
+                # Happens on Ubuntu 20.04 running on WSL2.
+                memory.append(0.0)
+        return memory
+
+    def sample(self) -> Dict[str, Any]:
+        processes = self._processes()
+        rss = []
+        for process in processes:
+            try:
+                rss.append(process.memory_info().rss)
+            except psutil.Error:
+                rss.append(0)
+        sample = {
+            "time": time.time() - self.start_time,
+            "gpu_mem": self._gpu_memory(),
+            "rss": rss[0] / GB,
+            "children_rss": sum(rss[1:]) / GB,
+            "cpu_percent": self._cpu_percent(processes),
+            "host_cpu_percent": psutil.cpu_percent(),
+            "read_bytes": None,
+            "write_bytes": None,
+        }
+        io_bytes = self._io_bytes(processes)
+        if io_bytes is not None and self.start_io is not None:
+            sample["read_bytes"] = io_bytes[0] - self.start_io[0]
+            sample["write_bytes"] = io_bytes[1] - self.start_io[1]
+        return sample
+
+    def _record(self):
+        sample = self.sample()
+        self.timeline.append(sample)
+        for key, value in sample.items():
+            if key == "time" or value is None:
+                continue
+            if key == "gpu_mem":
+                peak = self.peak.get(key, [0.0] * len(value))
+                self.peak[key] = [max(p, v) for p, v in zip(peak, value)]
+            else:
+                self.peak[key] = max(self.peak.get(key, value), value)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._record()
+
+    def start(self) -> "ResourceSampler":
+        self.start_time = time.time()
+        self.start_io = self._io_bytes(self._processes())
+        self._cpu_percent(self._processes())
+        psutil.cpu_percent()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling, after a final sample.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self._record()
+
+    def __enter__(self) -> "ResourceSampler":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Peak values of every sampled field, and the timeline of samples.
+        Memory is in GB and times are in seconds since sampling started.
+        """
+        return {
+            "interval": self.interval,
+            "gpus": len(self.gpus),
+            "peak": self.peak,
+            "timeline": self.timeline,
+        }
+
+    def save(self, path: Path):
+        # Not indented, since the timeline of a long run is long
+        open(path, "wt").write(json.dumps(self.summary()))
@@ -28,11 +28,11 @@ setup(
     install_requires=[
         "click",
         "dcase_util",
-        "intervaltree",
         "more-itertools",
         # for tf 2.6.0
         "numpy==1.19.2",
         "pandas",
+        "psutil",
         "pynvml",
         "pytorch-lightning>=1.6",
         "python-slugify",
@@ -51,6 +51,7 @@ setup(
     ],
     extras_require={
         "test": [
+            "intervaltree",  # Reference implementation of label alignment
             "pytest",
             "pytest-cov",
             "pytest-env",
@@ -58,6 +59,7 @@ setup(
         "dev": [
             "pre-commit",
             "black",  # Used in pre-commit hooks
+            "intervaltree",
             "pytest",
             "pytest-cov",
             "pytest-env",
@@ -0,0 +1,48 @@
+"""
+Tests that the decoding loaders return every batch, in order, with the
+fewest batches decoded ahead.
+"""
+
+import pytest
+from click.testing import CliRunner
+from torch.utils.data import Dataset
+
+from heareval.embeddings.decoding import PROCESS, THREAD, decoding_dataloader
+from heareval.embeddings.runner import runner
+
+
+class RangeDataset(Dataset):
+    def __init__(self, n: int):
+        self.n = n
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, idx: int) -> int:
+        return idx
+
+
+def collate(items):
+    return list(items)
+
+
+@pytest.mark.parametrize(
+    "num_workers,worker_type", [(0, THREAD), (2, THREAD), (1, PROCESS)]
+)
+@pytest.mark.parametrize("prefetch", [1, 2])
+def test_loader_returns_every_batch(num_workers, worker_type, prefetch):
+    loader = decoding_dataloader(
+        RangeDataset(10),
+        collate,
+        batch_size=3,
+        num_workers=num_workers,
+        worker_type=worker_type,
+        prefetch=prefetch,
+    )
+    assert list(loader) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+
+def test_runner_rejects_no_prefetch():
+    result = CliRunner().invoke(runner, ["stubmodel", "--prefetch", "0"])
+    assert result.exit_code == 2
+    assert "--prefetch" in result.output
@@ -0,0 +1,114 @@
+"""
+Tests that the vectorized alignment of event labels to timestamps matches
+the IntervalTree implementation it replaced.
+"""
+
+import random
+from typing import Dict, List
+
+import numpy as np
+import pytest
+from intervaltree import IntervalTree
+
+from heareval.embeddings.task_embeddings import (
+    get_labels_for_timestamps,
+    get_multihot_for_timestamps,
+)
+
+LABELS = ["a", "b", "c", 1]
+
+
+def interval_tree_labels(labels: List, timestamps: List[np.ndarray]) -> List:
+    """
+    The labels of each timestamp of each file, as aligned before with one
+    IntervalTree per file, with the labels of each timestamp sorted.
+    """
+    labels_for_files = []
+    for file_labels, file_timestamps in zip(labels, timestamps):
+        tree = IntervalTree()
+        for event in file_labels:
+            tree.addi(event["start"], event["end"] + 0.0001, event["label"])
+        labels_for_files.append(
+            [
+                sorted((interval.data for interval in tree[t]), key=str)
+                for t in file_timestamps
+            ]
+        )
+    return labels_for_files
+
+
+def random_batch(prng: random.Random) -> Dict[str, List]:
+    """
+    Files with duplicate, overlapping and zero-length events, events on
+    timestamps, and sorted or shuffled float32 timestamps.
+    """
+    labels = []
+    timestamps = []
+    for _ in range(prng.randint(1, 5)):
+        file_timestamps = np.arange(prng.choice([0, 1, 5, 50])) * prng.choice(
+            [10.0, 25.0, 12.5]
+        )
+        if prng.random() < 0.3:
+            prng.shuffle(file_timestamps)
+        timestamps.append(file_timestamps.astype(np.float32))
+        events = []
+        for _ in range(prng.choice([0, 1, 3, 8])):
+            if len(file_timestamps) and prng.random() < 0.4:
+                start, end = sorted(
+                    float(prng.choice(file_timestamps)) for _ in range(2)
+                )
+            else:
+                start = prng.uniform(-20, 600)
+                end = start + prng.choice([0, prng.uniform(0, 300)])
+            event = {"start": start, "end": end, "label": prng.choice(LABELS)}
+            events.append(event)
+            if prng.random() < 0.2:
+                events.append(dict(event))
+        labels.append(events)
+    return {"labels": labels, "timestamps": timestamps}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_labels_match_interval_tree(seed):
+    prng = random.Random(seed)
+    for _ in range(50):
+        batch = random_batch(prng)
+        assert get_labels_for_timestamps(
+            batch["labels"], batch["timestamps"]
+        ) == interval_tree_labels(batch["labels"], batch["timestamps"])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_labels_do_not_depend_on_batching(seed):
+    prng = random.Random(seed)
+    batch = random_batch(prng)
+    together = get_labels_for_timestamps(batch["labels"], batch["timestamps"])
+    for i, (file_labels, file_timestamps) in enumerate(
+        zip(batch["labels"], batch["timestamps"])
+    ):
+        assert get_labels_for_timestamps([file_labels], [file_timestamps]) == [
+            together[i]
+        ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_multihot_matches_interval_tree(seed):
+    prng = random.Random(seed)
+    label_to_idx = {str(label): i for i, label in enumerate(LABELS)}
+    for _ in range(50):
+        batch = random_batch(prng)
+        multihot = get_multihot_for_timestamps(
+            batch["labels"], batch["timestamps"], label_to_idx
+        )
+        expected = interval_tree_labels(batch["labels"], batch["timestamps"])
+        for file_multihot, file_labels in zip(multihot, expected):
+            for row, timestamp_labels in zip(file_multihot, file_labels):
+                assert {LABELS[i] for i in np.nonzero(row)[0]} == set(timestamp_labels)
+
+
+def test_event_ending_before_start_raises():
+    with pytest.raises(ValueError):
+        get_labels_for_timestamps(
+            [[{"start": 10.0, "end": 5.0, "label": "a"}]],
+            [np.arange(3, dtype=np.float32) * 10],
+        )
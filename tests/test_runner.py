@@ -0,0 +1,53 @@
+"""
+Tests of embed_tasks that don't need a real model or task.
+"""
+
+import threading
+from typing import List
+
+import pytest
+
+import heareval.embeddings.runner as runner
+from heareval.embeddings.runner import LoadedModels, embed_tasks
+from heareval.resources import ResourceSampler
+
+STUB_MODEL = """
+import torch
+
+
+class Model(torch.nn.Module):
+    sample_rate = 16000
+
+
+def load_model(model_file_path=""):
+    return Model()
+"""
+
+
+def test_failed_task_stops_sampler(tmp_path, monkeypatch):
+    tmp_path.joinpath("sampler_stub_model.py").write_text(STUB_MODEL)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    threads: List[threading.Thread] = []
+
+    class RecordingSampler(ResourceSampler):
+        def start(self) -> ResourceSampler:
+            super().start()
+            assert self.thread is not None
+            threads.append(self.thread)
+            return self
+
+    monkeypatch.setattr(runner, "ResourceSampler", RecordingSampler)
+
+    loaded = LoadedModels(["sampler_stub_model"], [None], [{}], ["stub"])
+    for _ in range(3):
+        # The task does not exist, so task_embeddings fails
+        with pytest.raises(FileNotFoundError):
+            embed_tasks(
+                loaded,
+                [tmp_path.joinpath("tasks", "missing")],
+                [tmp_path.joinpath("embeddings", "stub")],
+                sample_interval=0.01,
+            )
+    assert len(threads) == 3
+    assert not any(thread.is_alive() for thread in threads)
@@ -0,0 +1,59 @@
+"""
+Tests that SplitMemmapDataset reads embeddings stored in reduced
+precision into memory with in_memory=True.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from heareval.embeddings.sidecars import SplitLabels
+from heareval.embeddings.storage import NUMPY_DTYPES, EmbeddingStorage
+from heareval.predictions.task_predictions import SplitMemmapDataset
+
+
+def write_split(embedding_path: Path, dtype: str) -> np.ndarray:
+    embeddings = np.random.RandomState(0).randn(10, 4).astype(np.float32)
+    storage = EmbeddingStorage.fit(dtype, [embeddings])
+    stored = np.memmap(
+        embedding_path.joinpath("test.embeddings.npy"),
+        dtype=storage.numpy_dtype,
+        mode="w+",
+        shape=embeddings.shape,
+    )
+    stored[:] = storage.encode(embeddings)
+    stored.flush()
+    storage.save(embedding_path, "test")
+    open(embedding_path.joinpath("test.embedding-dimensions.json"), "wt").write(
+        json.dumps(list(embeddings.shape))
+    )
+    SplitLabels.from_lists([["a"]] * 5 + [["b"]] * 5).save(embedding_path, "test")
+    return embeddings
+
+
+@pytest.mark.parametrize("dtype", ["float16", "bfloat16", "int8"])
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_reduced_precision_in_memory(tmp_path, dtype, in_memory):
+    embeddings = write_split(tmp_path, dtype)
+    dataset = SplitMemmapDataset(
+        embedding_path=tmp_path,
+        label_to_idx={"a": 0, "b": 1},
+        nlabels=2,
+        split_name="test",
+        embedding_type="scene",
+        in_memory=in_memory,
+        metadata=False,
+    )
+    # np.asarray of a memmap is not an np.memmap, but is still a view of it
+    in_ram = (
+        not isinstance(dataset.embeddings, np.memmap)
+        and dataset.embeddings.flags.owndata
+    )
+    assert in_ram == in_memory
+    assert dataset.embeddings.dtype == NUMPY_DTYPES[dtype]
+    for i in range(len(dataset)):
+        embedding, y, _ = dataset[i]
+        np.testing.assert_allclose(embedding.numpy(), embeddings[i], atol=0.05)
+        assert y.tolist() == ([1.0, 0.0] if i < 5 else [0.0, 1.0])